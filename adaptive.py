@@ -0,0 +1,98 @@
+# adaptive.py
+
+import time
+
+# ==========================
+# Configuração
+# ==========================
+
+TARGET_FPS = 20
+
+QUALITY_MIN = 20
+QUALITY_MAX = 80
+QUALITY_STEP = 10
+
+# Fatores de redução de resolução, do melhor para o pior
+SCALES = (1.0, 0.75, 0.5, 0.35)
+
+EVAL_INTERVAL = 0.5   # segundos entre decisões
+EWMA_ALPHA = 0.3      # peso da medição nova nas médias móveis
+UPGRADE_HEADROOM = 1.5  # só melhora se o link aguenta 1.5x o fps alvo
+UPGRADE_STREAK = 3      # ... por várias avaliações seguidas
+
+
+class AdaptiveController:
+    """
+    Ajusta qualidade JPEG e fator de escala a partir do tempo e do tamanho
+    de cada send_frame (backpressure do socket).
+
+    - Vazão estimada = bytes enviados / tempo bloqueado em send (média móvel).
+    - fps possível = vazão / bytes médios por frame.
+    - Abaixo do alvo: reduz qualidade; na qualidade mínima, reduz a escala.
+    - Com folga por algumas avaliações: aumenta escala, depois qualidade.
+
+    record_send() é chamado pela thread de envio e settings() pela de
+    codificação; os campos são escritos atomicamente (GIL).
+    """
+
+    def __init__(self, target_fps: int = TARGET_FPS, quality: int = 50):
+        self.target_fps = target_fps
+        self.quality = quality
+        self.scale_index = 0
+
+        self._throughput = None  # bytes/s
+        self._frame_bytes = None
+        self._last_eval = time.monotonic()
+        self._upgrade_streak = 0
+
+    @property
+    def scale(self) -> float:
+        return SCALES[self.scale_index]
+
+    def settings(self):
+        """(qualidade, escala) atuais."""
+        return self.quality, self.scale
+
+    def _ewma(self, old, new):
+        return new if old is None else old + EWMA_ALPHA * (new - old)
+
+    def record_send(self, nbytes: int, seconds: float) -> None:
+        """Registra um envio e, de tempos em tempos, reavalia a configuração."""
+        self._frame_bytes = self._ewma(self._frame_bytes, nbytes)
+        if seconds > 0:
+            self._throughput = self._ewma(self._throughput, nbytes / seconds)
+
+        now = time.monotonic()
+        if now - self._last_eval >= EVAL_INTERVAL:
+            self._last_eval = now
+            self._evaluate()
+
+    def estimated_fps(self):
+        if not self._throughput or not self._frame_bytes:
+            return None
+        return self._throughput / self._frame_bytes
+
+    def _evaluate(self):
+        fps = self.estimated_fps()
+        if fps is None:
+            return
+
+        if fps < self.target_fps * 0.9:
+            self._upgrade_streak = 0
+            if self.quality > QUALITY_MIN:
+                self.quality = max(QUALITY_MIN, self.quality - QUALITY_STEP)
+            elif self.scale_index < len(SCALES) - 1:
+                self.scale_index += 1
+            return
+
+        if fps > self.target_fps * UPGRADE_HEADROOM:
+            self._upgrade_streak += 1
+            if self._upgrade_streak < UPGRADE_STREAK:
+                return
+            self._upgrade_streak = 0
+            if self.scale_index > 0:
+                self.scale_index -= 1
+            elif self.quality < QUALITY_MAX:
+                self.quality = min(QUALITY_MAX, self.quality + QUALITY_STEP)
+        else:
+            self._upgrade_streak = 0
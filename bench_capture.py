@@ -0,0 +1,142 @@
+# bench_capture.py
+#
+# Micro-benchmark do caminho captura -> conversão -> JPEG, sem display:
+# compara o caminho antigo (np.array sobre o screenshot, cvtColor/resize
+# alocando o destino, imencode + tobytes) com o atual (np.frombuffer sobre o
+# buffer cru, conversão e resize em buffers do FramePool, JPEG como memoryview).
+#
+# O screenshot é falso mas tem a mesma interface do mss (raw, width, height,
+# __array_interface__), então mede tudo a partir do buffer cru. O frame
+# anterior fica referenciado durante a captura seguinte, como o
+# FrameScheduler faz, para o pool precisar de mais de um buffer.
+# A memória vem do tracemalloc (o NumPy registra suas alocações nele):
+# pico acima do que já estava alocado, por frame.
+#
+# Uso: python bench_capture.py [--size 3840x2160] [--scale 0.5] [--frames 60]
+
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from capture import FramePool, capture_screen_mss, release_frame
+from content import encode_jpeg
+
+QUALITY = 50
+
+
+class FakeShot:
+    """Mesma interface de mss.screenshot.ScreenShot (BGRA em raw)."""
+
+    def __init__(self, raw: bytearray, width: int, height: int):
+        self.raw = raw
+        self.width = width
+        self.height = height
+
+    @property
+    def __array_interface__(self):
+        return {"version": 3, "shape": (self.height, self.width, 4),
+                "typestr": "|u1", "data": self.raw}
+
+
+class FakeMss:
+    """Imita mss.mss(): grab() devolve sempre o mesmo buffer cru."""
+
+    def __init__(self, width: int, height: int):
+        self.monitors = [None, {"left": 0, "top": 0, "width": width, "height": height}]
+        frame = np.random.default_rng(0).integers(0, 256, (height, width, 4), dtype=np.uint8)
+        cv2.GaussianBlur(frame, (9, 9), 0, dst=frame)  # menos ruído: JPEG de tamanho realista
+        self._shot = FakeShot(bytearray(frame.tobytes()), width, height)
+
+    def grab(self, monitor):
+        return self._shot
+
+
+# ==========================
+# Caminhos comparados
+# ==========================
+
+def legacy_capture(sct, size):
+    screenshot = sct.grab(sct.monitors[1])
+    frame = cv2.cvtColor(np.array(screenshot), cv2.COLOR_BGRA2BGR)
+    if size is not None:
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def legacy_jpeg(frame):
+    ok, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, QUALITY])
+    return buffer.tobytes()
+
+
+def make_current_capture(sct, size):
+    width, height = sct.monitors[1]["width"], sct.monitors[1]["height"]
+    pool = FramePool((height, width, 3))
+    scaled = FramePool((size[1], size[0], 3)) if size is not None else None
+
+    def capture(sct, size):
+        frame, _, _ = capture_screen_mss(sct, pool.acquire())
+        if scaled is not None:
+            full = frame
+            frame = cv2.resize(full, size, dst=scaled.acquire(), interpolation=cv2.INTER_AREA)
+            release_frame(full)
+        return frame
+    return capture
+
+
+# ==========================
+# Medição
+# ==========================
+
+def measure(name, capture, sct, size, frames):
+    prev = capture(sct, size)  # aquece (alocações do pool, tabelas do cv2)
+    encode = legacy_jpeg if name == "antigo" else (lambda frame: encode_jpeg(frame, QUALITY))
+    encode(prev)
+
+    stages = {"captura": 0.0, "jpeg": 0.0}
+    peaks = {"captura": 0, "jpeg": 0}
+    for _ in range(frames):
+        for stage in ("captura", "jpeg"):
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            t0 = time.perf_counter()
+            if stage == "captura":
+                frame = capture(sct, size)
+            else:
+                data = encode(frame)
+            stages[stage] += time.perf_counter() - t0
+            peaks[stage] += tracemalloc.get_traced_memory()[1] - base
+        release_frame(prev)
+        prev = frame  # o frame anterior continua com dono (pacing)
+        del data
+
+    print(f"  {name}:")
+    for stage in ("captura", "jpeg"):
+        ms = stages[stage] / frames * 1000
+        print(f"    {stage:8s} {ms:7.1f} ms/frame  {peaks[stage] / frames / 2**20:7.2f} MiB alocados/frame")
+    return prev
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Alocação e vazão do caminho de captura")
+    parser.add_argument("--size", default="3840x2160")
+    parser.add_argument("--scale", type=float, default=1.0, help="resize depois da conversão")
+    parser.add_argument("--frames", type=int, default=60)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split("x"))
+    size = (int(width * args.scale), int(height * args.scale)) if args.scale != 1.0 else None
+    sct = FakeMss(width, height)
+    print(f"Tela {width}x{height}" + (f" -> {size[0]}x{size[1]}" if size else "")
+          + f", {args.frames} frames:")
+
+    tracemalloc.start()
+    measure("antigo", legacy_capture, sct, size, args.frames)
+    measure("atual", make_current_capture(sct, size), sct, size, args.frames)
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# bench_cursor.py
+#
+# Custo de mexer o mouse, sem display: o servidor de verdade
+# (server.handle_mux_conn) captura a cena sintética "idle" e um cliente
+# headless manda EV_MOVE a --rate Hz num círculo, pelo CH_INPUT, por
+# --seconds. Reporta a latência do movimento até a posição voltar pelo canal
+# do cursor (CH_CURSOR) e quanto vídeo o movimento gerou (frames, bytes e
+# CPU do processo por segundo; servidor e cliente rodam juntos).
+#
+# Com --in-frame, o cursor volta a fazer parte da captura (a fonte desenha a
+# seta na posição do ponteiro, server.CURSOR_CHANNEL desligado): cada
+# movimento vira um frame codificado, e a latência passa a ser do movimento
+# até a chegada do próximo frame de vídeo (sem o decode).
+#
+# Uso: python bench_cursor.py [--seconds 5] [--rate 60] [--in-frame]
+
+import argparse
+import json
+import math
+import threading
+import time
+
+import metrics
+import server
+from capture import SyntheticCapture
+from cursor import CURSOR_POS, MSG_CURSOR_POS, virtual_pointer
+from input_protocol import EV_MOVE, pack_events
+from mux import MuxConnection, CH_VIDEO, CH_INPUT, CH_CURSOR
+from protocol import create_server_socket, create_client_socket, MSG_INFO
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latência e custo do cursor")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--rate", type=float, default=60.0, help="movimentos por segundo")
+    parser.add_argument("--in-frame", action="store_true",
+                        help="cursor desenhado na captura em vez do canal próprio")
+    args = parser.parse_args()
+
+    server.CAPTURE_BACKEND = "synthetic:idle"
+    server.CURSOR_CHANNEL = not args.in_frame
+    pointer = (lambda: virtual_pointer.position) if args.in_frame else None
+    server.warm_capture = server.WarmCapture(backend=SyntheticCapture("idle", pointer=pointer))
+    metrics.default.reset()
+
+    listener = create_server_socket("127.0.0.1", 0)
+    port = listener.getsockname()[1]
+
+    def serve():
+        conn, addr = listener.accept()
+        listener.close()
+        server.handle_mux_conn(conn, addr)
+
+    threading.Thread(target=serve, daemon=True).start()
+    mux = MuxConnection(create_client_socket("127.0.0.1", port))
+    video, cursor = mux.channel(CH_VIDEO), mux.channel(CH_CURSOR)
+    info = json.loads(bytes(memoryview(video.recv_frame())[1:]).decode("utf-8"))
+    width, height = info["width"], info["height"]
+
+    moves = {}         # (x, y) -> instante do envio
+    pending = []       # instantes de movimentos ainda sem frame (--in-frame)
+    latencies = []
+    counts = {"frames": 0, "bytes": 0}
+    lock = threading.Lock()
+
+    def read_cursor():
+        while True:
+            data = cursor.recv_frame()
+            if not data:
+                return
+            if data[0] == MSG_CURSOR_POS:
+                x, y, _ = CURSOR_POS.unpack_from(data, 1)
+                with lock:
+                    sent = moves.pop((x, y), None)
+                if sent is not None:
+                    latencies.append(time.perf_counter() - sent)
+
+    def read_video():
+        while True:
+            data = video.recv_frame()
+            if not data:
+                return
+            if data[0] == MSG_INFO:
+                continue
+            now = time.perf_counter()
+            with lock:
+                counts["frames"] += 1
+                counts["bytes"] += len(data)
+                latencies.extend(now - sent for sent in pending)
+                pending.clear()
+
+    threading.Thread(target=read_cursor, daemon=True).start()
+    threading.Thread(target=read_video, daemon=True).start()
+
+    time.sleep(1.0)  # primeiro frame completo e keyframes fora da medida
+    with lock:
+        counts.update(frames=0, bytes=0)
+    cpu, started = time.process_time(), time.perf_counter()
+    inputs = mux.channel(CH_INPUT)
+    interval = 1.0 / args.rate
+    step = 0
+    while time.perf_counter() - started < args.seconds:
+        angle = step * 2 * math.pi / args.rate
+        x = int(width / 2 + width / 4 * math.cos(angle))
+        y = int(height / 2 + height / 4 * math.sin(angle))
+        with lock:
+            if args.in_frame:
+                pending.append(time.perf_counter())
+            else:
+                moves[(x, y)] = time.perf_counter()
+        inputs.send_frame(pack_events([(EV_MOVE, 0, x, y, 0)]))
+        step += 1
+        time.sleep(max(0.0, started + step * interval - time.perf_counter()))
+    time.sleep(0.2)  # últimas respostas
+    elapsed = time.perf_counter() - started
+    cpu = (time.process_time() - cpu) / elapsed
+    mux.close()
+
+    snapshot = metrics.default.snapshot()
+    mode = "cursor na captura" if args.in_frame else "canal do cursor"
+    print(f"{mode}: {step} movimentos em {elapsed:.1f} s ({args.rate:g} Hz)")
+    print(f"  latência movimento -> {'frame' if args.in_frame else 'cursor'}"
+          f"  p50 {percentile(latencies, 0.5) * 1000:6.1f} ms"
+          f"  p95 {percentile(latencies, 0.95) * 1000:6.1f} ms  ({len(latencies)} amostras)")
+    print(f"  vídeo                  {counts['frames'] / elapsed:6.1f} fps"
+          f"  {counts['bytes'] * 8 / elapsed / 1e6:7.3f} Mbit/s")
+    updates = snapshot.get("cursor_updates", {}).get("total", 0)
+    print(f"  cursor                 {updates / elapsed:6.1f} posições/s")
+    print(f"  CPU                    {cpu * 100:6.1f} % de um núcleo")
+
+
+if __name__ == "__main__":
+    main()
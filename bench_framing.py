@@ -0,0 +1,115 @@
+# bench_framing.py
+#
+# Micro-benchmark do framing via loopback: compara as funções antigas
+# (header + payload concatenados, recv em bytearray + cópia para bytes,
+# utils.recv_msg com "data += packet") com o framing atual de protocol.py
+# (sendmsg scatter-gather, recv_into em buffer reaproveitado).
+#
+# Uso: python bench_framing.py [nº de frames]
+
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from protocol import send_frame, recv_frame, FrameReader, HAS_SENDMSG
+
+SIZES = (64 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+
+# ==========================
+# Implementações antigas (referência)
+# ==========================
+
+def legacy_send_frame(sock, payload):
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+
+def legacy_recv_all(sock, nbytes):
+    data = bytearray()
+    while len(data) < nbytes:
+        chunk = sock.recv(nbytes - len(data))
+        if not chunk:
+            raise ConnectionError("Conexão encerrada durante recv_all")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def legacy_recv_frame(sock):
+    (size,) = struct.unpack(">I", legacy_recv_all(sock, 4))
+    return legacy_recv_all(sock, size)
+
+
+def legacy_utils_recv_msg(sock):
+    raw_header = b''
+    while len(raw_header) < 4:
+        raw_header += sock.recv(4 - len(raw_header))
+    msg_size = struct.unpack('>L', raw_header)[0]
+    data = b''
+    while len(data) < msg_size:
+        data += sock.recv(min(4096, msg_size - len(data)))
+    return data
+
+
+# ==========================
+# Execução
+# ==========================
+
+def socket_pair():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return client, conn
+
+
+def run(name, send, make_recv, payload, count):
+    tx, rx = socket_pair()
+    recv = make_recv(rx)
+
+    def sender():
+        for _ in range(count):
+            send(tx, payload)
+
+    t = threading.Thread(target=sender)
+    started = time.perf_counter()
+    t.start()
+    for _ in range(count):
+        data = recv()
+        # Mesmo uso do cliente: vira array NumPy sem copiar
+        np.frombuffer(data, dtype=np.uint8)
+    elapsed = time.perf_counter() - started
+    t.join()
+    tx.close()
+    rx.close()
+
+    mb = len(payload) * count / (1024 * 1024)
+    print(f"  {name:<28} {mb / elapsed:9.1f} MB/s  {elapsed / count * 1000:7.3f} ms/frame")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"sendmsg disponível: {HAS_SENDMSG}")
+
+    for size in SIZES:
+        payload = np.random.randint(0, 256, size, dtype=np.uint8).tobytes()
+        n = count if size < 4 * 1024 * 1024 else max(1, count // 4)
+        n_slow = max(1, n // 10)  # utils.recv_msg é quadrático, roda menos vezes
+        print(f"\nPayload de {size // 1024} KiB:")
+        run("antigo (protocol)", legacy_send_frame,
+            lambda s: lambda: legacy_recv_frame(s), payload, n)
+        run(f"antigo (utils) x{n_slow}", legacy_send_frame,
+            lambda s: lambda: legacy_utils_recv_msg(s), payload, n_slow)
+        run("atual recv_frame", send_frame,
+            lambda s: lambda: recv_frame(s), payload, n)
+        run("atual FrameReader", send_frame,
+            lambda s: FrameReader(s).read_frame, payload, n)
+
+
+if __name__ == "__main__":
+    main()
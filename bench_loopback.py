@@ -0,0 +1,432 @@
+# bench_loopback.py
+#
+# Benchmark de ponta a ponta via loopback, sem display: o servidor de verdade
+# (server.stream_video) captura de uma fonte sintética e um cliente headless
+# (client.FrameDecoder, sem janela) decodifica. Reporta fps, bytes por frame,
+# tempo de encode e decode e percentis de latência captura -> frame decodificado.
+#
+# Encode e os demais estágios do servidor vêm do registro de metrics.py
+# (janela das últimas amostras de cada histograma).
+# A latência vem do número que a fonte sintética grava no canto do frame
+# (capture.write_stamp): servidor e cliente rodam no mesmo processo, então
+# o instante da captura e o da decodificação usam o mesmo relógio.
+#
+# Com --reconnect, cada cena ganha uma segunda conexão curta sobre o mesmo
+# server.WarmCapture (backend aberto + último keyframe), para comparar o tempo
+# até o primeiro frame de uma conexão nova com o de uma reconexão.
+#
+# Com --udp, o vídeo passa para o UDP (hello com o token, como o cliente faz)
+# através de um udp.LossyRelay que perde --loss dos datagramas e atrasa cada
+# um em --delay ± --jitter s.
+#
+# Com --bandwidth, o TCP passa por um SlowLink: o servidor escreve sem
+# bloquear e o cliente recebe a no máximo N Mbit/s, --delay s depois (o resto
+# espera no relay, como nos buffers de um link lento). Com --no-flow, sem a
+# janela de crédito (flow.py), a latência cresce com o que fica na fila.
+#
+# Na cena "read" (rola 1 s, para 1 s), "refino" é o tempo da parada até cada
+# mensagem sem conteúdo novo (o refinamento) e o PSNR compara o framebuffer
+# do cliente com a fonte: frames novos vs. depois de refinados (--no-refine
+# para comparar).
+#
+# Com --shm, o vídeo vai pela memória compartilhada (shm.py), como para um
+# cliente local: frames crus, sem encode nem decode. O uso de CPU do processo
+# (servidor e cliente juntos) é reportado sempre, para comparar.
+#
+# Uso: python bench_loopback.py [--scene scroll|video|idle|switch|read|all] [--seconds 10]
+#                               [--replay arquivo.npy] [--json saida.json] [--reconnect]
+#                               [--udp [--loss 0.01] [--delay 0.005] [--jitter 0.001]]
+#                               [--bandwidth 2 [--delay 0.1] [--no-flow]] [--no-refine] [--shm]
+#                               [--session-dir pasta]   # grava as sessões (server.RECORD_DIR)
+#      python bench_loopback.py --record arquivo.npy --scene scroll --frames 300
+
+import argparse
+import collections
+import json
+import queue
+import select
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import metrics
+import server
+from capture import SyntheticCapture, SCENES, read_stamp, record
+import client
+from client import FrameDecoder, receive_loop, start_udp_video
+from protocol import (
+    create_server_socket, create_client_socket, send_message, send_frame,
+    recv_frame, recv_message, FrameReader, MSG_INFO,
+)
+from udp import LossyRelay, create_udp_socket, MSG_LOST
+from shm import MSG_SHM
+
+
+def ms_stats(values, percentiles=(50, 90, 99)) -> dict:
+    if not values:
+        return {}
+    arr = np.asarray(values) * 1000
+    stats = {"mean": float(arr.mean()), "max": float(arr.max())}
+    for p in percentiles:
+        stats[f"p{p}"] = float(np.percentile(arr, p))
+    return stats
+
+
+class SlowLink:
+    """
+    Relay TCP que entrega ao cliente a no máximo mbps, delay s depois: o
+    que o servidor escreve é lido na hora e espera aqui (fila sem limite,
+    como os buffers de um link lento). O controle, no sentido contrário,
+    passa direto.
+    """
+
+    CHUNK = 16 * 1024
+
+    def __init__(self, target, mbps: float, delay: float = 0.0):
+        self.target = target
+        self.rate = mbps * 1e6 / 8  # bytes/s
+        self.delay = delay
+        self.max_queued = 0
+        self._queue = collections.deque()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._listener = create_server_socket("127.0.0.1", 0)
+        self.addr = self._listener.getsockname()
+        self._socks = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        client_sock, _ = self._listener.accept()
+        self._listener.close()
+        server_sock = create_client_socket(*self.target)
+        self._socks = [client_sock, server_sock]
+        threading.Thread(target=self._pump, args=(client_sock, server_sock), daemon=True).start()
+        threading.Thread(target=self._read, args=(server_sock,), daemon=True).start()
+        threading.Thread(target=self._write, args=(client_sock,), daemon=True).start()
+
+    def _pump(self, src, dst):
+        try:
+            while data := src.recv(65536):
+                dst.sendall(data)
+        except OSError:
+            pass
+        self.close()
+
+    def _read(self, src):
+        try:
+            while data := src.recv(65536):
+                with self._cond:
+                    self._queue.append((time.monotonic() + self.delay, data))
+                    self._queued += len(data)
+                    self.max_queued = max(self.max_queued, self._queued)
+                    self._cond.notify()
+        except OSError:
+            pass
+        self.close()
+
+    def _write(self, dst):
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._queue or not self._socks)
+                    if not self._socks:
+                        return
+                    due, data = self._queue.popleft()
+                    if len(data) > self.CHUNK:
+                        self._queue.appendleft((due, data[self.CHUNK:]))
+                        data = data[:self.CHUNK]
+                    self._queued -= len(data)
+                time.sleep(max(len(data) / self.rate, due - time.monotonic()))
+                dst.sendall(data)
+        except OSError:
+            self.close()
+
+    def close(self):
+        with self._cond:
+            socks, self._socks = self._socks, []
+            self._cond.notify_all()
+        for sock in socks:
+            sock.close()
+
+
+def run(capture: SyntheticCapture, seconds: float, viewport=None, warm=None, udp=None,
+        bandwidth=None, delay: float = 0.0, shm: bool = False) -> dict:
+    """
+    warm: server.WarmCapture sobre capture, para reaproveitar entre conexões.
+    udp: argumentos do LossyRelay (loss, delay, jitter) para o vídeo ir por UDP.
+    bandwidth: Mbit/s de um SlowLink entre servidor e cliente (TCP), com delay s.
+    shm: pede o vídeo pela memória compartilhada, como um cliente local.
+    """
+    metrics.default.reset()
+    listener = create_server_socket("127.0.0.1", 0)
+    port = listener.getsockname()[1]
+    session = server.new_session()
+    udp_sock = relay = None
+    if udp is not None:
+        udp_sock = create_udp_socket("127.0.0.1", 0)
+        threading.Thread(target=server.serve_udp, args=(udp_sock,), daemon=True).start()
+        relay = LossyRelay(udp_sock.getsockname(), **udp)
+
+    def serve():
+        conn, addr = listener.accept()
+        listener.close()
+        try:
+            server.stream_video(
+                lambda msg_type, body: send_message(conn, msg_type, body),
+                addr,
+                lambda: recv_frame(conn),
+                session,
+                capture=warm or capture,
+            )
+        finally:
+            conn.close()
+
+    server_thread = threading.Thread(target=serve, daemon=True)
+    server_thread.start()
+
+    link = SlowLink(("127.0.0.1", port), bandwidth, delay) if bandwidth else None
+    sock = create_client_socket(*(link.addr if link is not None else ("127.0.0.1", port)))
+    reader = FrameReader(sock)
+    msg_type, body = reader.read_message()
+    info = json.loads(bytes(body).decode("utf-8"))
+    client.server_w, client.server_h = info["width"], info["height"]
+    inbox = queue.Queue()
+    decoder = FrameDecoder(info["width"], info["height"],
+                           lambda msg: send_frame(sock, json.dumps(msg).encode("utf-8")),
+                           notify=(lambda: inbox.put((MSG_SHM, b""))) if shm else None)
+
+    if shm:
+        # Como o cliente local: o socket só traz o controle, os frames vêm do anel
+        decoder.request_shm()
+        threading.Thread(target=receive_loop, args=(lambda: recv_message(sock), inbox),
+                         daemon=True).start()
+    elif relay is not None:
+        # Como o cliente com UDP_VIDEO: as duas vias numa fila, o TCP só até o UDP começar
+        receiver = start_udp_video(relay.addr, info["token"], inbox)
+
+        def recv_tcp_video():
+            while True:
+                msg_type, body = recv_message(sock)
+                if not receiver.packets or msg_type in (None, MSG_INFO):
+                    return msg_type, body
+
+        threading.Thread(target=receive_loop, args=(recv_tcp_video, inbox), daemon=True).start()
+
+    def next_message():
+        """Próxima mensagem de vídeo, ou (MSG_INFO, None) se nada chegou em 0,1 s."""
+        if relay is not None or shm:
+            try:
+                return inbox.get(timeout=0.1) or (None, b"")
+            except queue.Empty:
+                return MSG_INFO, None
+        # select antes de ler: na cena "idle" pode não chegar nada por um tempo
+        if not select.select([sock], [], [], 0.1)[0]:
+            return MSG_INFO, None
+        return reader.read_message()
+    if viewport is not None:
+        # Como a janela do cliente faria: o servidor reduz para esse tamanho
+        decoder.send_control({"type": "viewport", "width": viewport[0], "height": viewport[1]})
+
+    frames = 0
+    nbytes = 0
+    decode_times = []
+    latencies = []
+    refine_ms = []                # mensagens sem conteúdo novo: refinamento do que parou
+    mse = {"new": [], "refined": []}  # erro do framebuffer do cliente contra a fonte
+    last_stamp = None
+
+    started = time.perf_counter()
+    cpu = time.process_time()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        msg_type, body = next_message()
+        if body is None:
+            continue
+        if msg_type is None:
+            break
+        if msg_type not in (MSG_INFO, MSG_LOST, MSG_SHM):
+            frames += 1
+            nbytes += len(body)
+
+        t0 = time.perf_counter()
+        changed = decoder.process([(msg_type, body)])
+        now = time.perf_counter()
+        if msg_type in (MSG_INFO, MSG_LOST) or msg_type == MSG_SHM and not changed:
+            continue
+        if msg_type == MSG_SHM:
+            frames += 1  # o sinal só vira frame se havia um novo no anel
+        decode_times.append(now - t0)
+
+        if changed and capture.stamp and decoder.framebuffer is not None:
+            stamp = read_stamp(decoder.framebuffer, capture.width)
+            refined = stamp == last_stamp and stamp in capture.timestamps
+            if stamp != last_stamp and stamp in capture.timestamps:
+                latencies.append(now - capture.timestamps[stamp])
+                last_stamp = stamp
+            elif refined:
+                refine_ms.append(now - capture.timestamps[stamp])
+            # Fidelidade do que o cliente mostra, quando é o conteúdo atual da fonte
+            source = capture.last
+            if stamp == capture.version and source is not None \
+                    and source.shape == decoder.framebuffer.shape:
+                diff = cv2.absdiff(decoder.framebuffer, source).astype(np.float32)
+                mse["refined" if refined else "new"].append(float(np.mean(diff * diff)))
+    elapsed = time.perf_counter() - started
+    cpu = (time.process_time() - cpu) / elapsed
+
+    sock.close()
+    if link is not None:
+        link.close()
+    server_thread.join(timeout=2.0)
+    if relay is not None:
+        receiver.sock.close()
+        relay.close()
+        udp_sock.close()
+    # Servidor e cliente rodam no mesmo processo: as métricas do UDP (do
+    # receptor) e os resyncs (do FrameDecoder) estão no mesmo registro
+    server_metrics = metrics.snapshot()
+
+    return {
+        "scene": capture.scene,
+        "size": [capture.width, capture.height],
+        "stream": [decoder.stream_w, decoder.stream_h],
+        "seconds": elapsed,
+        "fps": frames / elapsed,
+        "frames": frames,
+        "cpu": cpu,
+        "bytes_per_frame": nbytes / frames if frames else 0,
+        "encode_ms": server_metrics.get("encode_ms", {}),
+        "decode_ms": ms_stats(decode_times),
+        "latency_ms": ms_stats(latencies),
+        "refine_ms": ms_stats(refine_ms),
+        # PSNR do erro médio (infinito = sem perda)
+        "psnr_db": {kind: 10 * np.log10(255 ** 2 / np.mean(values)) if values and np.mean(values) else
+                    (float("inf") if values else None) for kind, values in mse.items()},
+        "first_frame_ms": server_metrics.get("first_frame_ms", {}).get("mean"),
+        "cache_mb": decoder.cache.nbytes / 2**20,
+        "udp": udp,
+        "shm": shm,
+        "bandwidth": bandwidth,
+        "link_queue_kb": link.max_queued / 1024 if link is not None else None,
+        "server_metrics": server_metrics,
+    }
+
+
+def print_report(result: dict) -> None:
+    def fmt(stats, keys):
+        return " / ".join(f"{stats[k]:.1f}" for k in keys) if "mean" in stats else "-"
+
+    w, h = result["size"]
+    sw, sh = result["stream"]
+    stream = f" -> {sw}x{sh}" if (sw, sh) != (w, h) else ""
+    transport = ", memória compartilhada" if result["shm"] else ""
+    print(f"\nCena {result['scene']} ({w}x{h}{stream}, {result['seconds']:.1f} s{transport}):")
+    print(f"  fps decodificados       {result['fps']:8.1f}")
+    print(f"  CPU (servidor+cliente)  {result['cpu'] * 100:8.1f} % de um núcleo")
+    print(f"  bytes/frame             {result['bytes_per_frame'] / 1024:8.1f} KiB")
+    print(f"  encode ms  média/p90    {fmt(result['encode_ms'], ('mean', 'p90'))}")
+    print(f"  decode ms  média/p90    {fmt(result['decode_ms'], ('mean', 'p90'))}")
+    print(f"  latência ms p50/p90/p99 {fmt(result['latency_ms'], ('p50', 'p90', 'p99'))}")
+    if "mean" in result["refine_ms"]:
+        snap = result["server_metrics"]
+        print(f"  refino ms (após parar)  {fmt(result['refine_ms'], ('p50', 'p90', 'p99'))}"
+              f"  ({snap.get('tiles_refined', {}).get('total', 0)} tiles)")
+    new, refined = result["psnr_db"]["new"], result["psnr_db"]["refined"]
+    if new is not None:
+        print(f"  PSNR dB novo/refinado   {new:.1f} / " + (f"{refined:.1f}" if refined is not None else "-"))
+    if result["first_frame_ms"] is not None:
+        print(f"  primeiro frame          {result['first_frame_ms']:8.1f} ms")
+    if "reconnect_first_frame_ms" in result:
+        print(f"  primeiro frame (reconexão) {result['reconnect_first_frame_ms']:5.1f} ms")
+    if result["udp"] is not None:
+        snap = result["server_metrics"]
+        total = lambda name: snap.get(name, {}).get("total", 0)
+        print(f"  udp: perda {snap.get('udp_loss_pct', {}).get('value', 0.0):.1f} %"
+              f" ({result['udp']['loss']:.1%} simulada), {total('udp_recovered')} fragmentos"
+              f" reconstruídos, {total('udp_frames_lost')} frames perdidos, {total('resyncs')} resyncs")
+    if result["bandwidth"] is not None:
+        credits = result["server_metrics"].get("credits", {}).get("value")
+        print(f"  link {result['bandwidth']:g} Mbit/s: fila máx. {result['link_queue_kb']:.0f} KiB"
+              + (f", janela {credits:.0f} frames" if credits is not None else ", sem janela"))
+    hits = result["server_metrics"].get("cache_hits", {}).get("total", 0)
+    misses = result["server_metrics"].get("cache_misses", {}).get("total", 0)
+    if hits + misses:
+        print(f"  cache de tiles          {100 * hits / (hits + misses):8.1f} % acertos"
+              f" ({result['cache_mb']:.1f} MB no cliente)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ponta a ponta via loopback")
+    parser.add_argument("--scene", default="all", choices=SCENES + ("all",))
+    parser.add_argument("--replay", help="reproduz um .npy gravado com --record")
+    parser.add_argument("--record", help="grava a cena num .npy e sai")
+    parser.add_argument("--frames", type=int, default=300, help="frames gravados por --record")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--viewport", help="janela do cliente (LxA): o servidor reduz para ela")
+    parser.add_argument("--no-delta", action="store_true")
+    parser.add_argument("--no-adaptive", action="store_true")
+    parser.add_argument("--no-pacing", action="store_true")
+    parser.add_argument("--no-parallel", action="store_true")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--no-flow", action="store_true", help="sem janela de crédito (acks)")
+    parser.add_argument("--no-refine", action="store_true", help="sem refinamento do que parou")
+    parser.add_argument("--workers", type=int, help="threads do encode em faixas")
+    parser.add_argument("--reconnect", action="store_true",
+                        help="mede também o primeiro frame de uma reconexão")
+    parser.add_argument("--udp", action="store_true", help="vídeo por UDP, via LossyRelay")
+    parser.add_argument("--loss", type=float, default=0.0, help="fração de datagramas perdidos")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="atraso de cada datagrama, ou do --bandwidth (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="variação do atraso (s)")
+    parser.add_argument("--bandwidth", type=float, help="link lento de N Mbit/s (TCP)")
+    parser.add_argument("--shm", action="store_true", help="vídeo pela memória compartilhada")
+    parser.add_argument("--session-dir", help="grava cada sessão nesta pasta (player.py toca)")
+    parser.add_argument("--json", help="salva os resultados neste arquivo")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split("x"))
+    viewport = tuple(int(v) for v in args.viewport.split("x")) if args.viewport else None
+    scenes = SCENES if args.scene == "all" else (args.scene,)
+
+    if args.record:
+        record(SyntheticCapture(scenes[0], width, height, stamp=False), args.record, args.frames)
+        print(f"{args.frames} frames de '{scenes[0]}' gravados em {args.record}")
+        return
+
+    server.DELTA_MODE = not args.no_delta
+    server.ADAPTIVE_MODE = not args.no_adaptive
+    server.PACING_MODE = not args.no_pacing
+    server.PARALLEL_ENCODE = not args.no_parallel
+    server.CACHE_MODE = not args.no_cache
+    server.FLOW_CONTROL = not args.no_flow
+    server.REFINE_MODE = not args.no_refine
+    server.RECORD_DIR = args.session_dir
+    if args.workers:
+        server.ENCODE_WORKERS = args.workers
+
+    if args.replay:
+        captures = [SyntheticCapture(path=args.replay)]
+    else:
+        captures = [SyntheticCapture(scene, width, height) for scene in scenes]
+
+    udp = dict(loss=args.loss, delay=args.delay, jitter=args.jitter) if args.udp else None
+    results = []
+    for capture in captures:
+        warm = server.WarmCapture(backend=capture)
+        result = run(capture, args.seconds, viewport, warm, udp, args.bandwidth, args.delay, args.shm)
+        if args.reconnect:
+            again = run(capture, 1.0, viewport, warm, udp, args.bandwidth, args.delay, args.shm)
+            result["reconnect_first_frame_ms"] = again["first_frame_ms"]
+        print_report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
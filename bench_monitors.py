@@ -0,0 +1,118 @@
+# bench_monitors.py
+#
+# Custo de assinar monitores, sem display: o servidor de verdade
+# (server.stream_video) captura de monitores sintéticos ("synthetic:a+b+...",
+# um por cena, lado a lado) e um cliente headless (client.StreamView) assina
+# cada combinação: só o principal, todos inteiros, o mosaico de miniaturas e
+# um monitor só. Para cada uma, reporta frames e bytes recebidos por stream e
+# o tempo de CPU do processo por segundo (servidor e cliente rodam juntos):
+# o custo deve acompanhar o que é assinado, não quantos monitores existem.
+#
+# Uso: python bench_monitors.py [--scenes scroll+video+idle] [--seconds 5]
+
+import argparse
+import json
+import queue
+import threading
+import time
+
+import client
+import server
+from client import FrameDecoder, StreamView, receive_loop
+from protocol import (
+    create_server_socket, create_client_socket, send_message, send_frame,
+    recv_frame, recv_message, unpack_stream, MSG_STREAM, MSG_INFO, STREAM_THUMBNAIL,
+)
+
+
+def measure(inbox: queue.Queue, view: StreamView, seconds: float) -> dict:
+    """Consome o vídeo por seconds; (frames, bytes) por stream e CPU em s/s."""
+    streams = {}
+    cpu, started = time.process_time(), time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        try:
+            msg = inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if msg is None:
+            break
+        msg_type, body = msg
+        sid = None
+        if msg_type == MSG_STREAM:
+            sid, inner, _ = unpack_stream(body)
+            msg_type = inner
+        if msg_type != MSG_INFO:
+            frames, nbytes = streams.get(sid, (0, 0))
+            streams[sid] = (frames + 1, nbytes + len(body))
+        view.process([msg])
+        win_w, win_h = 1280 * max(1, len(view.decoders)), 720
+        view.set_window(win_w, win_h)  # como o loop de render faria
+    elapsed = time.perf_counter() - started
+    return {"cpu": (time.process_time() - cpu) / elapsed, "seconds": elapsed, "streams": streams}
+
+
+def stream_name(sid) -> str:
+    if sid is None:
+        return "original"
+    if sid & STREAM_THUMBNAIL:
+        return f"miniatura {sid & ~STREAM_THUMBNAIL}"
+    return f"monitor {sid}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Custo por combinação de monitores assinados")
+    parser.add_argument("--scenes", default="scroll+video+idle", help="uma cena por monitor")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duração de cada combinação")
+    args = parser.parse_args()
+
+    server.CAPTURE_BACKEND = "synthetic:" + args.scenes
+    listener = create_server_socket("127.0.0.1", 0)
+    port = listener.getsockname()[1]
+
+    def serve():
+        conn, addr = listener.accept()
+        listener.close()
+        try:
+            server.stream_video(lambda msg_type, body: send_message(conn, msg_type, body),
+                                addr, lambda: recv_frame(conn))
+        finally:
+            conn.close()
+
+    server_thread = threading.Thread(target=serve, daemon=True)
+    server_thread.start()
+
+    sock = create_client_socket("127.0.0.1", port)
+    _, body = recv_message(sock)
+    info = json.loads(bytes(body).decode("utf-8"))
+    client.server_w, client.server_h = info["width"], info["height"]
+    view = StreamView(FrameDecoder(info["width"], info["height"],
+                                   lambda msg: send_frame(sock, json.dumps(msg).encode("utf-8"))),
+                      info["monitors"])
+    inbox = queue.Queue()
+    threading.Thread(target=receive_loop, args=(lambda: recv_message(sock), inbox), daemon=True).start()
+
+    indexes = [m["index"] for m in info["monitors"]]
+    steps = [
+        ("só o principal (sem subscribe)", None),
+        ("todos inteiros", lambda: view.subscribe(indexes)),
+        ("mosaico de miniaturas", view.show_mosaic),
+        (f"só o monitor {indexes[-1]}", lambda: view.subscribe(indexes[-1:])),
+    ]
+    print(f"{len(indexes)} monitores sintéticos ({args.scenes}), {args.seconds:.0f} s cada:")
+    for name, subscribe in steps:
+        if subscribe is not None:
+            subscribe()
+        measure(inbox, view, 1.0)  # troca: streams novos abrindo, keyframes
+        result = measure(inbox, view, args.seconds)
+        print(f"\n  {name}: CPU {result['cpu'] * 100:5.1f} % de um núcleo")
+        for sid, (frames, nbytes) in sorted(result["streams"].items(), key=lambda s: str(s[0])):
+            print(f"    {stream_name(sid):12s} {frames / result['seconds']:6.1f} fps"
+                  f"  {nbytes * 8 / result['seconds'] / 1e6:7.2f} Mbit/s")
+
+    sock.close()
+    server_thread.join(timeout=3.0)
+
+
+if __name__ == "__main__":
+    main()
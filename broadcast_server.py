@@ -0,0 +1,369 @@
+# broadcast_server.py
+
+import asyncio
+import json
+import secrets
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from protocol import HEADER_SIZE, MSG_INFO, KEYFRAME_TYPES, message_header
+from pipeline import FramePipeline
+from stripes import StripeEncoder, ENCODE_WORKERS
+from pacing import FrameScheduler, TARGET_FPS, MAX_FPS, IDLE_FPS
+from encoder import StreamEncoder
+from input_protocol import unpack_events
+from server import (
+    HOST, PORT, INPUT_PORT, JPEG_QUALITY, DELTA_MODE, PACING_MODE, PARALLEL_ENCODE,
+    CONTENT_MODE, MOTION_MODE, REFINE_MODE,
+    STATS_INTERVAL, METRICS_HOST, METRICS_PORT,
+    apply_events, warm_capture, first_frame,
+)
+
+# ==========================
+# Configuração
+# ==========================
+
+SUBSCRIBER_QUEUE = 4  # lotes de mensagens por viewer antes de descartar
+BACKLOG = 64          # conexões pendentes aceitas pelo listen()
+
+# pynput bloqueia (chamadas ao sistema por evento): o input é aplicado numa
+# thread própria, fora do event loop, e uma só mantém a ordem dos eventos
+_input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="input")
+
+
+# ==========================
+# Framing assíncrono
+# ==========================
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    """Versão asyncio de recv_frame. Retorna b"" se a conexão terminou."""
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+        (size,) = struct.unpack(">I", header)
+        if size == 0:
+            return b""
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return b""
+
+
+def write_message(writer: asyncio.StreamWriter, msg_type: int, body: bytes) -> None:
+    """Enfileira uma mensagem tipada no transporte (sem concatenar o corpo)."""
+    writer.write(message_header(msg_type, len(body)))
+    writer.write(body)
+
+
+# ==========================
+# Broadcast
+# ==========================
+
+class Subscriber:
+    """Um viewer: fila de envio própria e estado de sincronização do delta."""
+
+    def __init__(self, writer: asyncio.StreamWriter, token: str):
+        self.writer = writer
+        self.token = token
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE)
+        self.needs_keyframe = True  # deltas só valem depois de um frame completo
+        self.held_info = []         # MSG_INFO de lotes descartados: vão antes do próximo keyframe
+        self.reduce = 1             # redução com que o viewer decodifica
+        self.dropped = 0
+        self.joined = time.perf_counter()
+        self.waiting_first = True   # ainda sem nenhum frame (métrica first_frame_ms)
+        self.input_writer = None    # conexão de input pareada pelo token
+
+
+def _info_only(msgs) -> list:
+    return [(msg_type, body) for msg_type, body in msgs if msg_type == MSG_INFO]
+
+
+class Broadcaster:
+    """
+    Uma única captura/codificação alimentando todos os viewers.
+
+    O produtor (FramePipeline) só roda enquanto houver alguém assistindo.
+    Cada lote de mensagens vai para a fila de cada viewer; se a fila de um
+    viewer lento enche, ela é esvaziada, ele passa a ignorar deltas e o
+    codificador é avisado para gerar um frame completo que o ressincroniza.
+    """
+
+    def __init__(self):
+        self.subscribers = {}  # token -> Subscriber
+        self.screen = None     # (largura, altura)
+        self.encoder = None
+        self.pipeline = None
+        self.stripes = None
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, sub: Subscriber) -> None:
+        async with self._lock:
+            if self._task is None:
+                await self._start()
+            self.subscribers[sub.token] = sub
+            self.request_keyframe()
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        self.subscribers.pop(sub.token, None)
+        self.update_reduce()
+
+    def update_reduce(self) -> None:
+        # Cópias de scroll alinhadas à maior redução: exatas para todos os viewers
+        if self.encoder is not None:
+            self.encoder.set_client_reduce(max((s.reduce for s in self.subscribers.values()), default=1))
+
+    def request_keyframe(self) -> None:
+        # Com a tela parada o frame nem chegaria ao codificador
+        self.encoder.request_keyframe()
+        if self.pipeline is not None:
+            self.pipeline.request_frame()
+
+    def wake(self) -> None:
+        """Chegou input de algum viewer: a captura volta ao ritmo alvo."""
+        if self.pipeline is not None:
+            self.pipeline.wake()
+
+    async def _start(self):
+        loop = asyncio.get_running_loop()
+        # O backend fica aberto entre uma sessão de broadcast e outra
+        capture = await loop.run_in_executor(None, warm_capture.open)
+        server_w, server_h = capture.width, capture.height
+        print(f"[BROADCAST] Captura única com {capture.name} em {server_w}x{server_h}")
+
+        self.screen = (server_w, server_h)
+        self.stripes = StripeEncoder(ENCODE_WORKERS) if PARALLEL_ENCODE else None
+        # Sem cache de tiles: cada viewer entra (e descarta frames) num ponto
+        # diferente do stream, então não há um estado de cache comum a todos
+        self.encoder = StreamEncoder(server_w, server_h, quality=JPEG_QUALITY,
+                                     delta=DELTA_MODE, stripes=self.stripes, content=CONTENT_MODE,
+                                     motion=MOTION_MODE, refine=REFINE_MODE)
+        scheduler = FrameScheduler(TARGET_FPS, MAX_FPS, IDLE_FPS) if PACING_MODE else None
+        self.pipeline = FramePipeline(capture.grab, self._encode, capture.close, scheduler,
+                                      pending=self.encoder.refine_pending)
+        self.pipeline.start()
+        self._task = asyncio.create_task(self._produce())
+
+    def _encode(self, frame):
+        msgs = []
+        h, w = frame.shape[:2]
+        if (w, h) != self.screen:
+            # Resolução mudou: todos os viewers recomeçam na tela inteira, no tamanho novo
+            self.screen = (w, h)
+            self.encoder.set_screen(w, h)
+            msgs.append((MSG_INFO, json.dumps({"type": "screen_info", "width": w, "height": h}).encode("utf-8")))
+        return msgs + (self.encoder.encode(frame) or []) or None
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        last_stats = time.monotonic()
+        try:
+            while self.subscribers:
+                msgs = await loop.run_in_executor(None, self.pipeline.get, 0.5)
+                if msgs is None and self.pipeline.encoded.closed:
+                    break
+                if msgs is not None:
+                    self.publish(msgs)
+
+                if STATS_INTERVAL is not None and time.monotonic() - last_stats >= STATS_INTERVAL:
+                    last_stats = time.monotonic()
+                    self.publish_stats()
+        except Exception as e:
+            print(f"[BROADCAST] Erro na captura/codificação: {e}")
+            for sub in list(self.subscribers.values()):
+                sub.writer.close()
+        finally:
+            self.pipeline.close()
+            self.pipeline = None
+            if self.stripes is not None:
+                self.stripes.close()
+            self._task = None
+            print("[BROADCAST] Captura parada.")
+
+    def publish(self, msgs) -> None:
+        """Distribui um lote de mensagens para todos os viewers."""
+        is_keyframe = any(msg_type in KEYFRAME_TYPES for msg_type, _ in msgs)
+        for msg_type, body in msgs:
+            if msg_type in KEYFRAME_TYPES:
+                # Sem cache de tiles, o keyframe do broadcast é autossuficiente:
+                # serve direto de primeiro frame para quem conectar depois
+                warm_capture.set_keyframe(*self.screen, msg_type, body)
+
+        for sub in list(self.subscribers.values()):
+            if sub.needs_keyframe and not is_keyframe:
+                sub.held_info.extend(_info_only(msgs))
+                continue
+
+            if sub.queue.full():
+                # Viewer lento: joga fora o atraso e ressincroniza com frame
+                # completo. O screen_info de um lote jogado fora não pode se
+                # perder: sem ele o keyframe no tamanho novo não encaixa
+                while not sub.queue.empty():
+                    sub.held_info.extend(_info_only(sub.queue.get_nowait()))
+                    sub.dropped += 1
+                    metrics.count("subscriber_drops")
+                sub.needs_keyframe = True
+                self.request_keyframe()
+                if not is_keyframe:
+                    sub.held_info.extend(_info_only(msgs))
+                    continue
+
+            if sub.held_info:
+                sub.queue.put_nowait(sub.held_info + list(msgs))
+                sub.held_info = []
+            else:
+                sub.queue.put_nowait(msgs)
+            if is_keyframe:
+                sub.needs_keyframe = False
+
+    def publish_stats(self) -> None:
+        """Manda as métricas atuais direto para cada viewer (fora da fila de frames)."""
+        body = json.dumps({"type": "stats", "metrics": metrics.snapshot()}).encode("utf-8")
+        for sub in list(self.subscribers.values()):
+            write_message(sub.writer, MSG_INFO, body)
+
+
+# ==========================
+# Conexões
+# ==========================
+
+async def _write_loop(sub: Subscriber):
+    while True:
+        msgs = await sub.queue.get()
+        for msg_type, body in msgs:
+            write_message(sub.writer, msg_type, body)
+            if msg_type != MSG_INFO:
+                if sub.waiting_first:
+                    first_frame(sub.joined, sub.writer.get_extra_info("peername"))
+                    sub.waiting_first = False
+                metrics.count("frames_sent")
+                metrics.count("bytes_sent", len(body))
+        started = time.perf_counter()
+        await sub.writer.drain()
+        metrics.observe("send_ms", (time.perf_counter() - started) * 1000)
+
+
+async def _control_loop(broadcaster: Broadcaster, sub: Subscriber, reader):
+    """Mensagens de controle do viewer; termina quando ele desconecta."""
+    while True:
+        data = await read_frame(reader)
+        if not data:
+            return
+        msg = json.loads(data.decode("utf-8"))
+        if msg.get("type") == "keyframe_request":
+            broadcaster.request_keyframe()
+        elif msg.get("type") == "decode_reduce":
+            sub.reduce = int(msg["reduce"])
+            broadcaster.update_reduce()
+        # "viewport" é ignorado: o stream é um só, na resolução da tela, para todos
+
+
+async def handle_video(broadcaster: Broadcaster, reader, writer):
+    addr = writer.get_extra_info("peername")
+    print(f"[VÍDEO] Viewer conectado {addr}")
+    sub = Subscriber(writer, secrets.token_hex(16))
+    tasks = []
+    try:
+        await broadcaster.subscribe(sub)
+        server_w, server_h = broadcaster.screen
+        write_message(writer, MSG_INFO, json.dumps({
+            "type": "screen_info",
+            "width": server_w,
+            "height": server_h,
+            "token": sub.token,
+        }).encode("utf-8"))
+        keyframe = warm_capture.keyframe(server_w, server_h)
+        if keyframe is not None:
+            # Tela na hora; o viewer continua esperando um keyframe do stream
+            # para começar a aplicar os deltas
+            write_message(writer, *keyframe)
+            metrics.count("cached_keyframes")
+            first_frame(sub.joined, addr)
+            sub.waiting_first = False
+
+        # O viewer só manda controle pelo canal de vídeo; o EOF indica que saiu
+        tasks = [
+            asyncio.create_task(_write_loop(sub)),
+            asyncio.create_task(_control_loop(broadcaster, sub, reader)),
+        ]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            if not t.cancelled() and t.exception() is not None:
+                print(f"[VÍDEO] Conexão com {addr} encerrada: {t.exception()}")
+
+    except (ConnectionError, OSError, RuntimeError) as e:
+        print(f"[VÍDEO] Erro com {addr}: {e}")
+    finally:
+        for t in tasks:
+            t.cancel()
+        broadcaster.unsubscribe(sub)
+        if sub.input_writer is not None:
+            sub.input_writer.close()
+        writer.close()
+        print(f"[VÍDEO] Viewer desconectado {addr} (lotes descartados: {sub.dropped})")
+
+
+async def handle_input(broadcaster: Broadcaster, reader, writer):
+    addr = writer.get_extra_info("peername")
+    try:
+        # Primeira mensagem: token recebido no screen_info do canal de vídeo
+        data = await read_frame(reader)
+        hello = json.loads(data.decode("utf-8")) if data else {}
+        sub = broadcaster.subscribers.get(hello.get("token"))
+        if hello.get("type") != "hello" or sub is None:
+            print(f"[INPUT] Token de sessão inválido de {addr}, recusando.")
+            return
+
+        sub.input_writer = writer
+        print(f"[INPUT] Input de {addr} pareado com a sessão de vídeo")
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await read_frame(reader)
+            if not data:
+                break
+            events = unpack_events(data)
+            metrics.count("input_events", len(events))
+            await loop.run_in_executor(_input_executor, apply_events, events)
+            broadcaster.wake()
+
+    except Exception as e:
+        print("[INPUT] Erro:", e)
+    finally:
+        writer.close()
+        print(f"[INPUT] Cliente desconectado (input): {addr}")
+
+
+async def serve():
+    broadcaster = Broadcaster()
+    video = await asyncio.start_server(
+        lambda r, w: handle_video(broadcaster, r, w),
+        HOST, PORT, backlog=BACKLOG, reuse_address=True,
+    )
+    inputs = await asyncio.start_server(
+        lambda r, w: handle_input(broadcaster, r, w),
+        HOST, INPUT_PORT, backlog=BACKLOG, reuse_address=True,
+    )
+    print(f"[*] Servidor VÍDEO (broadcast) em {HOST}:{PORT}...")
+    print(f"[*] Servidor INPUT (broadcast) em {HOST}:{INPUT_PORT}...")
+    if METRICS_PORT is not None:
+        metrics.serve_metrics(METRICS_HOST, METRICS_PORT)
+        print(f"[*] Métricas em http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    # Backend aberto (e um keyframe pronto) antes do primeiro viewer
+    threading.Thread(target=warm_capture.prime, daemon=True).start()
+
+    async with video, inputs:
+        await asyncio.gather(video.serve_forever(), inputs.serve_forever())
+
+
+def start_broadcast_server():
+    """Servidor para vários viewers: uma captura, um encode, N conexões."""
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\n[!] Encerrando servidor...")
+
+
+if __name__ == "__main__":
+    start_broadcast_server()
@@ -0,0 +1,589 @@
+# capture.py
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import metrics
+from cursor import default_arrow, draw_shape
+
+# Captura de tela: tenta mss primeiro (rápido no Windows), depois PIL (portável para Linux)
+try:
+    import mss
+    HAS_MSS = True
+except ImportError:
+    HAS_MSS = False
+
+try:
+    from PIL import ImageGrab
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+
+# ==========================
+# Captura real
+# ==========================
+
+def capture_screen_mss(sct, dst=None, index: int = 1):
+    """
+    Captura tela usando mss (rápido no Windows).
+    index é o monitor na numeração do mss (1 = principal).
+    O buffer cru do mss é lido no lugar (np.frombuffer, sem cópia) e a
+    conversão para BGR é escrita em dst, se dado.
+    """
+    monitor = sct.monitors[index]
+    with metrics.timer("grab_ms"):
+        screenshot = sct.grab(monitor)
+    with metrics.timer("convert_ms"):
+        frame_bgra = np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(
+            screenshot.height, screenshot.width, 4)
+        frame = cv2.cvtColor(frame_bgra, cv2.COLOR_BGRA2BGR, dst=dst)
+    return frame, monitor["width"], monitor["height"]
+
+
+def capture_screen_pil(dst=None):
+    """
+    Captura tela usando PIL/Pillow (portável para Linux e macOS).
+    A conversão para BGR é escrita em dst, se dado (o PIL em si sempre copia).
+    """
+    screenshot = ImageGrab.grab()
+    frame = cv2.cvtColor(np.asarray(screenshot), cv2.COLOR_RGB2BGR, dst=dst)
+    # Usa o tamanho exato da captura (inclui DPI scaling se existir)
+    width, height = screenshot.size
+    return frame, width, height
+
+
+def get_logical_resolution_pil():
+    """
+    Obtém resolução LÓGICA (não física) no Linux.
+    PIL captura em pixels físicos com scaling, mas pynput usa lógicos.
+    """
+    try:
+        import subprocess
+        # Tenta xrandr para obter resolução lógica
+        result = subprocess.run(['xrandr', '--current'],
+                              capture_output=True, text=True, timeout=2)
+        if result.returncode == 0:
+            for line in result.stdout.split('\n'):
+                # Procura por "connected primary X"xY" ou similar
+                if 'connected primary' in line or (' connected ' in line and 'x' in line):
+                    # Parse: "HDMI-1 connected 2560x1440+0+0" -> pega "2560x1440"
+                    parts = line.split()
+                    for part in parts:
+                        if 'x' in part and part[0].isdigit():
+                            try:
+                                w_str, h_str = part.split('x')[0], part.split('x')[1].split('+')[0]
+                                w, h = int(w_str), int(h_str)
+                                if w > 0 and h > 0:
+                                    return w, h
+                            except:
+                                pass
+    except Exception:
+        pass
+
+    return None, None
+
+
+def get_screen_resolution():
+    """Obtém resolução da tela usando a biblioteca disponível."""
+    if HAS_MSS:
+        try:
+            with mss.mss() as sct:
+                monitor = sct.monitors[1]
+                return monitor["width"], monitor["height"]
+        except Exception:
+            pass
+
+    if HAS_PIL:
+        try:
+            screenshot = ImageGrab.grab()
+            return screenshot.size
+        except Exception:
+            pass
+
+    # Fallback
+    return 1920, 1080
+
+
+def _monitor(index: int, left: int, top: int, width: int, height: int) -> dict:
+    return {"index": index, "left": left, "top": top, "width": width, "height": height}
+
+
+def list_monitors(spec: str = "auto") -> list:
+    """
+    Monitores que open_capture(spec, índice) captura, com a posição de cada
+    um na área de trabalho (as coordenadas do mouse). O primeiro é o principal.
+    PIL só enxerga a tela principal; "synthetic:a+b" tem um monitor por cena.
+    """
+    if spec.startswith("synthetic:"):
+        width, height = SYNTHETIC_SIZE
+        scenes = spec.split(":", 1)[1].split("+")
+        return [_monitor(i + 1, i * width, 0, width, height) for i in range(len(scenes))]
+    if spec.startswith("replay:"):
+        height, width = np.load(spec.split(":", 1)[1], mmap_mode="r").shape[1:3]
+        return [_monitor(1, 0, 0, width, height)]
+
+    if HAS_MSS and spec in ("auto", "mss"):
+        try:
+            with mss.mss() as sct:
+                return [_monitor(i, m["left"], m["top"], m["width"], m["height"])
+                        for i, m in enumerate(sct.monitors[1:], 1)]
+        except Exception:
+            pass
+    return [_monitor(1, 0, 0, *get_screen_resolution())]
+
+
+# ==========================
+# Buffers reaproveitados
+# ==========================
+
+POOL_FRAMES = 4  # buffers por backend: o novo, o anterior (pacing), o na fila e o em encode
+
+
+class FramePool:
+    """
+    Buffers de frame pré-alocados, reaproveitados entre capturas: em 4K a
+    30 fps, alocar um frame novo por captura são ~750 MB/s de malloc + page
+    faults só para o destino da conversão de cor.
+
+    A posse é explícita: acquire() entrega o buffer com um dono (quem
+    pediu), cada estágio que guarda o frame além da chamada atual (o
+    FrameScheduler com o anterior, o LatestSlot com o que espera, o
+    codificador com o que está processando, o WarmCapture com o último)
+    chama retain_frame() ao pegar e release_frame() ao soltar, e o buffer
+    só volta para o pool quando o último dono o solta. Views de um frame
+    valem só enquanto alguém é dono dele: para guardar mais tempo, copie.
+    Se todos estão em uso, aloca um novo (contador frame_allocs).
+    """
+
+    def __init__(self, shape, count: int = POOL_FRAMES):
+        self.shape = tuple(shape)
+        self.count = count
+        self._buffers = 0  # quantos buffers o pool já criou
+        self._free = []
+
+    def acquire(self) -> np.ndarray:
+        with _leases_lock:  # duas conexões podem capturar ao mesmo tempo
+            if self._free:
+                buf = self._free.pop()
+            else:
+                buf = np.empty(self.shape, dtype=np.uint8)
+                metrics.count("frame_allocs")
+                if self._buffers >= self.count:
+                    return buf  # fora do pool: o GC cuida dele
+                self._buffers += 1
+            _leases[id(buf)] = [self, buf, 1]
+        return buf
+
+
+# Buffers de pool com dono: id -> [pool, buffer, donos]. Só entram enquanto
+# têm dono, então o id não pode ser reaproveitado por outro objeto.
+_leases = {}
+_leases_lock = threading.Lock()
+
+
+def retain_frame(frame) -> None:
+    """Mais um dono para o frame (nada acontece se ele não é de um FramePool)."""
+    if frame is None:
+        return
+    with _leases_lock:
+        lease = _leases.get(id(frame))
+        if lease is not None and lease[1] is frame:
+            lease[2] += 1
+
+
+def release_frame(frame) -> None:
+    """Um dono a menos; sem nenhum, o buffer volta para o pool dele."""
+    if frame is None:
+        return
+    with _leases_lock:
+        lease = _leases.get(id(frame))
+        if lease is None or lease[1] is not frame:
+            return
+        lease[2] -= 1
+        if lease[2] == 0:
+            del _leases[id(frame)]
+            lease[0]._free.append(frame)
+
+
+# ==========================
+# Backends
+# ==========================
+
+class CaptureBackend:
+    """
+    Fonte de frames usada pelo servidor.
+
+    grab() devolve um frame BGR (altura x largura x 3), já na resolução
+    width x height enviada ao cliente. Backends reais escrevem num buffer
+    de FramePool: quem chama grab() é dono do frame e chama release_frame()
+    quando não precisa mais dele (retain_frame() para cada dono a mais).
+
+    O backend é aberto uma vez e reaproveitado por todas as conexões
+    (server.WarmCapture): grab() é chamado pela thread de captura de cada
+    pipeline, e close() por ela ao terminar (libera só o que é da thread).
+    width/height ficam em cache: só mudam quando um grab() encontra a tela
+    com outro tamanho (mudança de resolução), via set_geometry().
+
+    Cada backend captura um monitor (monitor, na numeração de
+    list_monitors); left/top são a posição dele na área de trabalho.
+
+    Os frames não incluem o cursor (padrão do mss e do PIL): ele vai no canal
+    próprio (cursor.py) e mexer o mouse não muda a tela capturada.
+    """
+
+    name = "?"
+
+    def __init__(self, width: int, height: int, monitor: int = 1, left: int = 0, top: int = 0):
+        self.width = width
+        self.height = height
+        self.monitor = monitor
+        self.left = left
+        self.top = top
+        self.pool = FramePool((height, width, 3))
+
+    def geometry(self) -> dict:
+        return _monitor(self.monitor, self.left, self.top, self.width, self.height)
+
+    def set_geometry(self, width: int, height: int) -> bool:
+        """Atualiza a resolução em cache. Retorna True se ela mudou."""
+        if (width, height) == (self.width, self.height):
+            return False
+        print(f"[+] Resolução da tela mudou: {self.width}x{self.height} -> {width}x{height}")
+        self.width, self.height = width, height
+        self.pool = FramePool((height, width, 3))
+        return True
+
+    def grab(self) -> np.ndarray:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MssCapture(CaptureBackend):
+    name = "mss"
+
+    def __init__(self, index: int = 1):
+        # Captura de teste para garantir que funciona (falha no Linux sem X11)
+        with mss.mss() as sct:
+            if not 1 <= index < len(sct.monitors):
+                raise RuntimeError(f"Monitor {index} não existe ({len(sct.monitors) - 1} encontrados)")
+            monitor = sct.monitors[index]
+            sct.grab(monitor)
+        super().__init__(monitor["width"], monitor["height"], index, monitor["left"], monitor["top"])
+        # mss guarda handles por thread: a thread de captura abre a sua
+        # (e um handle novo enumera os monitores de novo)
+        self._tls = threading.local()
+
+    def grab(self):
+        if not hasattr(self._tls, "sct"):
+            self._tls.sct = mss.mss()
+        buf = self.pool.acquire()
+        frame, w, h = capture_screen_mss(self._tls.sct, buf, self.monitor)
+        if frame is not buf:
+            release_frame(buf)
+        if (w, h) != (self.width, self.height):
+            # O cv2 alocou um frame do tamanho novo no lugar do buffer do pool
+            self.set_geometry(w, h)
+        return frame
+
+    def close(self):
+        if hasattr(self._tls, "sct"):
+            self._tls.sct.close()
+            del self._tls.sct
+
+
+class PilCapture(CaptureBackend):
+    name = "PIL"
+
+    def __init__(self):
+        screenshot = ImageGrab.grab()
+        super().__init__(*self._logical_size(*screenshot.size))
+        self._set_physical(*screenshot.size)
+        self._lock = threading.Lock()  # _converted é um só, mesmo com duas conexões
+
+    @staticmethod
+    def _logical_size(width: int, height: int):
+        # IMPORTANTE: No Linux, PIL captura em pixels FÍSICOS (com DPI scaling)
+        # mas pynput trabalha em pixels LÓGICOS. Precisa redimensionar.
+        # Roda o xrandr: só na abertura e quando a resolução muda.
+        logical_w, logical_h = get_logical_resolution_pil()
+        if logical_w and logical_h and (logical_w != width or logical_h != height):
+            print(f"[+] Redimensionando PIL: {width}x{height} (físico) -> {logical_w}x{logical_h} (lógico)")
+            return logical_w, logical_h
+        return width, height
+
+    def _set_physical(self, width: int, height: int):
+        self._physical = (width, height)
+        # BGR em pixels físicos antes do resize: só é usado dentro de grab(),
+        # então um buffer só basta
+        self._converted = (np.empty((height, width, 3), dtype=np.uint8)
+                           if self._physical != (self.width, self.height) else None)
+
+    def grab(self):
+        with self._lock:
+            dst = self._converted if self._converted is not None else self.pool.acquire()
+            frame, w, h = capture_screen_pil(dst)
+            if (w, h) != self._physical:
+                self.set_geometry(*self._logical_size(w, h))
+                self._set_physical(w, h)
+            # Se a captura é em pixels FÍSICOS mas width/height são LÓGICOS, redimensiona
+            if frame is not dst:
+                release_frame(dst)
+            if (w, h) != (self.width, self.height):
+                src, buf = frame, self.pool.acquire()
+                frame = cv2.resize(src, (self.width, self.height), dst=buf,
+                                   interpolation=cv2.INTER_LINEAR)
+                release_frame(src)
+                if frame is not buf:
+                    release_frame(buf)
+            return frame
+
+
+# ==========================
+# Fonte sintética (sem display)
+# ==========================
+
+SCENES = ("scroll", "video", "idle", "switch", "read")
+SYNTHETIC_SIZE = (1280, 720)  # cada monitor de "synthetic:<cena>+<cena>..."
+
+STAMP_BITS = 16   # número do frame gravado no canto superior esquerdo
+STAMP_BLOCK = 16  # lado de cada bit, em pixels (sobrevive ao JPEG e à escala)
+
+
+def write_stamp(frame: np.ndarray, value: int) -> None:
+    """Grava value como uma faixa de blocos preto/branco no topo do frame."""
+    for bit in range(STAMP_BITS):
+        x = bit * STAMP_BLOCK
+        frame[:STAMP_BLOCK, x:x + STAMP_BLOCK] = 255 if (value >> bit) & 1 else 0
+
+
+def read_stamp(frame: np.ndarray, width: int) -> int:
+    """
+    Lê o número gravado por write_stamp. width é a largura original da
+    fonte; o frame pode ter chegado reduzido (escala adaptativa, decode reduzido).
+    """
+    ratio = frame.shape[1] / width
+    y = int(STAMP_BLOCK * ratio / 2)
+    value = 0
+    for bit in range(STAMP_BITS):
+        x = int((bit + 0.5) * STAMP_BLOCK * ratio)
+        if frame[y, x].mean() > 127:
+            value |= 1 << bit
+    return value
+
+
+def _desktop(width: int, height: int) -> np.ndarray:
+    """Fundo de "área de trabalho": degradê, barra de tarefas e uma janela."""
+    ramp = np.linspace(90, 160, height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:] = np.stack([ramp * 1.2, ramp * 0.8, ramp * 0.5], axis=-1).clip(0, 255).astype(np.uint8)
+    cv2.rectangle(frame, (0, height - 40), (width, height), (40, 40, 40), -1)
+    cv2.rectangle(frame, (width // 8, height // 8), (width * 7 // 8, height * 3 // 4), (240, 240, 240), -1)
+    cv2.rectangle(frame, (width // 8, height // 8), (width * 7 // 8, height // 8 + 28), (120, 80, 40), -1)
+    return frame
+
+
+class SyntheticCapture(CaptureBackend):
+    """
+    Frames gerados ou gravados, para medir sem display (benchmark, CI).
+
+    Cenas:
+    - "scroll": página de texto rolando (quase todos os tiles mudam).
+    - "video":  região de vídeo no meio de uma área de trabalho parada.
+    - "idle":   área de trabalho parada, só o cursor de texto pisca.
+    - "switch": alt-tab entre três janelas já vistas, a cada 0,5 s.
+    - "read":   a página do "scroll" rola por 1 s e fica parada 1 s (leitura).
+    - replay:   path de um .npy (N x altura x largura x 3) gravado com record().
+
+    Cada conteúdo novo recebe um número (gravado no frame se stamp=True) e
+    o instante em que foi capturado fica em timestamps, para o benchmark
+    medir a latência até o frame decodificado no cliente.
+
+    pointer() -> (x, y) ou None desenha uma seta nessa posição (coordenadas
+    da área de trabalho), como uma captura que inclui o cursor: cada
+    movimento vira um frame novo. O benchmark compara com o canal do cursor.
+    """
+
+    name = "synthetic"
+
+    def __init__(self, scene: str = "scroll", width: int = SYNTHETIC_SIZE[0],
+                 height: int = SYNTHETIC_SIZE[1], path: str = None, stamp: bool = True,
+                 monitor: int = 1, left: int = 0, pointer=None):
+        self.scene = scene
+        self.pointer = pointer
+        self.stamp = stamp
+        self.version = 0
+        self.timestamps = {}  # número do conteúdo -> time.perf_counter() da captura
+        self._rng = np.random.default_rng(0)
+        self._ticks = 0
+        self._caret_on = None
+        self._window = None
+        self._offset = 0
+        self.last = None  # último frame entregue (o benchmark compara com o do cliente)
+        self._clean = None  # último frame sem a seta do pointer
+        self._drawn = None  # posição em que a seta foi desenhada
+
+        if path is not None:
+            self.scene = "replay"
+            self._frames = np.load(path, mmap_mode="r")
+            height, width = self._frames.shape[1:3]
+        elif scene not in SCENES:
+            raise ValueError(f"Cena sintética desconhecida: {scene}")
+        super().__init__(width, height, monitor, left)
+        self.name = f"synthetic:{self.scene}"
+
+        self._background = _desktop(width, height)
+        if self.scene in ("scroll", "read"):
+            self._page = self._render_page(width, height * 3)
+        elif self.scene == "switch":
+            self._windows = [self._render_page(width, height, seed=1),
+                             self._render_page(width, height, seed=2),
+                             self._background]
+
+    @staticmethod
+    def _render_page(width: int, height: int, seed: int = 1) -> np.ndarray:
+        page = np.full((height, width, 3), 250, dtype=np.uint8)
+        rng = np.random.default_rng(seed)
+        words = ["socket", "frame", "delta", "tile", "jpeg", "buffer", "pipeline",
+                 "latência", "captura", "cliente", "servidor", "protocolo"]
+        for i, y in enumerate(range(30, height, 22)):
+            line = " ".join(rng.choice(words, size=rng.integers(4, 12)))
+            cv2.putText(page, f"{i:5d}  {line}", (20, y), cv2.FONT_HERSHEY_SIMPLEX,
+                        0.55, (30, 30, 30), 1, cv2.LINE_AA)
+        return page
+
+    def _render(self):
+        """Retorna o próximo frame, ou None se o conteúdo não mudou."""
+        h, w = self.height, self.width
+        self._ticks += 1
+
+        if self.scene == "scroll":
+            rows = (np.arange(h) + self._ticks * 6) % self._page.shape[0]
+            return self._page[rows]
+
+        if self.scene == "video":
+            frame = self._background.copy()
+            vx, vy, vw, vh = w // 4, h // 4, w // 2, h // 2
+            t = self._ticks * 0.15
+            xs = np.linspace(0, 6, vw, dtype=np.float32)[None, :]
+            ys = np.linspace(0, 4, vh, dtype=np.float32)[:, None]
+            base = 127 + 100 * np.sin(xs + t) * np.cos(ys - t * 0.7)
+            region = frame[vy:vy + vh, vx:vx + vw]
+            region[:] = np.stack([base, np.roll(base, vw // 3, axis=1), 255 - base], axis=-1).astype(np.uint8)
+            region += self._rng.integers(0, 12, size=region.shape, dtype=np.uint8)
+            return frame
+
+        if self.scene == "read":
+            # Rola por 1 s, para por 1 s; parado, nada muda
+            if int(time.monotonic()) % 2:
+                return None
+            self._offset += 6
+            rows = (np.arange(h) + self._offset) % self._page.shape[0]
+            return self._page[rows]
+
+        if self.scene == "idle":
+            # Cursor pisca a cada 0,5 s; entre as piscadas nada muda
+            caret_on = int(time.monotonic() * 2) % 2 == 0
+            if caret_on == self._caret_on:
+                return None
+            self._caret_on = caret_on
+            frame = self._background.copy()
+            if caret_on:
+                x, y = w // 8 + 40, h // 8 + 60
+                frame[y:y + 18, x:x + 2] = 0
+            return frame
+
+        if self.scene == "switch":
+            # Troca de janela a cada 0,5 s; entre as trocas nada muda
+            window = int(time.monotonic() * 2) % len(self._windows)
+            if window == self._window:
+                return None
+            self._window = window
+            return self._windows[window].copy()
+
+        # replay
+        return np.array(self._frames[(self._ticks - 1) % len(self._frames)])
+
+    def grab(self):
+        frame = self._render()
+        pointer = self.pointer() if self.pointer is not None else None
+        if frame is None:
+            if pointer == self._drawn or self._clean is None:
+                return self.last
+            frame = self._clean.copy()  # só o cursor mexeu: a tela capturada muda igual
+        elif self.pointer is not None:
+            self._clean = frame.copy()
+        self.version = (self.version + 1) % (1 << STAMP_BITS)
+        self.timestamps[self.version] = time.perf_counter()
+        if self.stamp:
+            write_stamp(frame, self.version)
+        if pointer is not None:
+            hot_x, hot_y, arrow = default_arrow()
+            draw_shape(frame, pointer[0] - self.left - hot_x, pointer[1] - self.top - hot_y, arrow)
+        self._drawn = pointer
+        self.last = frame
+        return frame
+
+
+def record(backend: CaptureBackend, path: str, count: int) -> None:
+    """Grava count frames de um backend num .npy que SyntheticCapture reproduz."""
+    frames = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8,
+                                       shape=(count, backend.height, backend.width, 3))
+    try:
+        for i in range(count):
+            frame = backend.grab()
+            frames[i] = frame
+            release_frame(frame)
+    finally:
+        backend.close()
+        frames.flush()
+
+
+# ==========================
+# Escolha do backend
+# ==========================
+
+def open_capture(spec: str = "auto", monitor: int = 1) -> CaptureBackend:
+    """
+    Abre o backend de captura de um monitor (numeração de list_monitors).
+
+    spec: "auto" (mss, depois PIL), "mss", "pil", "synthetic:<cena>[+<cena>...]"
+    (um monitor por cena) ou "replay:<arquivo.npy>".
+    """
+    if spec.startswith("synthetic:"):
+        scenes = spec.split(":", 1)[1].split("+")
+        if not 1 <= monitor <= len(scenes):
+            raise RuntimeError(f"Monitor {monitor} não existe ({len(scenes)} sintéticos)")
+        return SyntheticCapture(scenes[monitor - 1], monitor=monitor,
+                                left=(monitor - 1) * SYNTHETIC_SIZE[0])
+    if spec.startswith("replay:"):
+        return SyntheticCapture(path=spec.split(":", 1)[1])
+
+    # Tenta usar mss primeiro, depois PIL
+    if HAS_MSS and spec in ("auto", "mss"):
+        try:
+            backend = MssCapture(monitor)
+            print(f"[+] Usando mss para captura de tela (resolução: {backend.width}x{backend.height})")
+            return backend
+        except Exception as e:
+            print(f"[!] mss falhou (esperado no Linux sem X11): {e}")
+
+    # Se mss falhou ou não está disponível, tenta PIL
+    if HAS_PIL and spec in ("auto", "pil") and monitor == 1:
+        try:
+            backend = PilCapture()
+            print(f"[+] Usando PIL/Pillow para captura de tela (resolução: {backend.width}x{backend.height})")
+            return backend
+        except Exception as e:
+            print(f"[!] PIL também falhou: {e}")
+
+    # Se nenhuma funcionou, erro fatal
+    raise RuntimeError(
+        "Nenhuma biblioteca de captura funcionou! "
+        "Verifique se 'mss' (com X11/Wayland) ou 'Pillow' está instalado."
+    )
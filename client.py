@@ -3,15 +3,53 @@
 import cv2
 import numpy as np
 import json
-
-from protocol import create_client_socket, recv_frame, send_frame
+import queue
+import socket
+import threading
+import time
+
+import metrics
+from protocol import (
+    create_client_socket, send_frame, recv_message, unpack_update, unpack_stream,
+    MSG_INFO, MSG_JPEG, MSG_UPDATE, MSG_STRIPES, MSG_STREAM, KEYFRAME_TYPES, STREAM_THUMBNAIL,
+)
+from delta import apply_update, REDUCED_FLAGS
+from tilecache import TileStore, has_stores
+from mux import MuxConnection, CH_VIDEO, CH_INPUT, CH_CONTROL, CH_CURSOR
+from cursor import CursorView
+from pipeline import LatestSlot
+from udp import UdpReceiver, create_udp_socket, send_hellos, MSG_LOST
+from shm import ShmReader, is_local, MSG_SHM
+from input_protocol import (
+    InputBatcher, EV_MOVE, EV_BUTTON, EV_KEY,
+    BTN_LEFT, BTN_RIGHT, BUTTON_PRESS,
+)
 
 SERVER_HOST = "127.0.0.1"  # ajustar para IP do servidor
 SERVER_PORT = 9999         # vídeo
 INPUT_PORT = 10000         # mouse/teclado
+MUX_PORT = 9998            # modo multiplexado: tudo numa conexão só
+MUX_MODE = False           # True = usa MUX_PORT em vez de vídeo + input separados
+UDP_PORT = 9996            # vídeo por UDP
+UDP_VIDEO = False          # True = pede o vídeo por UDP (input e controle seguem no TCP)
+RESYNC_RETRY = 1.0         # s: repete o pedido de keyframe se ele também se perder no UDP
+SHM_VIDEO = "auto"         # frames crus por memória compartilhada: "auto" = se SERVER_HOST é local
+RENDER_INTERVAL_MS = 16    # ritmo do loop de render (~60 Hz)
+SHOW_STATS = True          # desenha as métricas do servidor/cliente sobre o vídeo
+METRICS_PORT = None        # endpoint local de métricas do cliente (None = desligado)
+VIEWPORT_SETTLE = 0.3      # s com a janela no mesmo tamanho antes de pedir o stream nele
+MIN_ZOOM = 32              # lado mínimo (pixels do servidor) de uma região de zoom
+MONITORS = None            # monitores assinados ao conectar (ex.: [1, 2]); None = só o principal
+MOSAIC = False             # True = começa no mosaico de miniaturas de todos os monitores
+DRAW_CURSOR = True         # pede o cursor num canal próprio e o desenha sobre o vídeo
 
 _input_sock = None
+_input_batcher = None
 _current_frame = None  # Armazena o último frame para obter dimensões reais
+_tiles = []            # (x inicial, x final, FrameDecoder) de cada stream no frame exibido
+_view = None           # StreamView ativo (streams exibidos e região de zoom de cada um)
+_zoom_start = None     # (decoder, x, y): onde começou o Ctrl+arraste de zoom (coords do monitor)
+_cursor = None         # CursorView: cursor do servidor, desenhado pelo render
 
 # resoluções do servidor (atualizadas quando conecta)
 server_w = 1920
@@ -24,41 +62,54 @@ mouse_buttons_down = {
 }
 
 
-def send_input(msg: dict):
-    """Serializa o dicionário em JSON e envia para o servidor."""
-    if _input_sock is None:
+def send_input(kind: int, arg: int = 0, x: int = 0, y: int = 0, code: int = 0):
+    """Enfileira um evento binário de input; o InputBatcher envia em lotes."""
+    if _input_batcher is None:
         return
-    try:
-        data = json.dumps(msg).encode("utf-8")
-        send_frame(_input_sock, data)
-    except Exception as e:
-        print(f"[INPUT] Erro ao enviar: {e}")
+    _input_batcher.push(kind, arg, x, y, code)
 
 
-def scale_to_server(x, y):
+def locate(x, y):
     """
-    Converte coordenadas do mouse relativas ao frame exibido
-    para as coordenadas reais da tela do servidor.
+    Acha o stream sob (x, y) do frame exibido e converte o ponto para as
+    coordenadas da tela que ele mostra (o monitor, com vários).
+    Devolve (decoder, sx, sy), ou (None, 0, 0) sem frame.
     """
-    global _current_frame, server_w, server_h
-    
-    if _current_frame is None:
-        return 0, 0
+    if _current_frame is None or not _tiles:
+        return None, 0, 0
     
     # Dimensões DO FRAME DECODIFICADO
-    frame_h, frame_w = _current_frame.shape[:2]
+    frame_h = _current_frame.shape[0]
+    x0, x1, decoder = next((t for t in _tiles if x < t[1]), _tiles[-1])
     
-    if frame_w == 0 or frame_h == 0:
-        return 0, 0
+    if x1 <= x0 or frame_h == 0:
+        return None, 0, 0
     
+    # Região da tela que o stream mostra (zoom); sem zoom é a tela inteira
+    screen_w, screen_h = decoder.screen_size
+    crop_x, crop_y, crop_w, crop_h = decoder.crop or (0, 0, screen_w, screen_h)
+
     # Converter proporcional do frame para servidor
-    sx = int(x * (server_w / frame_w))
-    sy = int(y * (server_h / frame_h))
+    sx = int(crop_x + (x - x0) * (crop_w / (x1 - x0)))
+    sy = int(crop_y + y * (crop_h / frame_h))
     
     # Garante que não sai dos limites
-    sx = max(0, min(sx, server_w - 1))
-    sy = max(0, min(sy, server_h - 1))
+    sx = max(0, min(sx, screen_w - 1))
+    sy = max(0, min(sy, screen_h - 1))
     
+    return decoder, sx, sy
+
+
+def scale_to_server(x, y):
+    """
+    Converte coordenadas do mouse relativas ao frame exibido
+    para as coordenadas reais da tela do servidor. Com vários monitores,
+    a posição é na área de trabalho: soma o canto do monitor sob o mouse.
+    """
+    decoder, sx, sy = locate(x, y)
+    if decoder is not None and decoder.monitor is not None:
+        sx += decoder.monitor["left"]
+        sy += decoder.monitor["top"]
     return sx, sy
 
 
@@ -70,152 +121,725 @@ def mouse_callback(event, x, y, flags, param):
     """
     Esse callback só é chamado quando o mouse está em cima da janela "Remote Screen".
     x, y já são coordenadas relativas à imagem da janela.
+
+    Ctrl + arrastar com o botão esquerdo escolhe uma região para ampliar;
+    Ctrl + botão direito volta para a tela inteira e, sem zoom, para o
+    mosaico de monitores. No mosaico, um clique numa miniatura mostra
+    aquele monitor. Esses cliques não vão para o servidor.
     """
-    # movimentação contínua
+    global _zoom_start
+
+    if _view is not None and _view.mosaic:
+        if event == cv2.EVENT_LBUTTONDOWN:
+            decoder, _, _ = locate(x, y)
+            if decoder is not None and decoder.monitor is not None:
+                _view.subscribe([decoder.monitor["monitor"]])
+        return  # no mosaico o mouse só escolhe o monitor
+
+    if _view is not None and (flags & cv2.EVENT_FLAG_CTRLKEY or _zoom_start is not None):
+        if event == cv2.EVENT_LBUTTONDOWN:
+            _zoom_start = locate(x, y)
+            return
+        if event == cv2.EVENT_LBUTTONUP and _zoom_start is not None:
+            decoder, x0, y0 = _zoom_start
+            _zoom_start = None
+            tile = next((t for t in _tiles if t[2] is decoder), None)
+            if tile is None:
+                return
+            # O fim do arraste conta no monitor onde ele começou
+            _, x1, y1 = locate(min(max(x, tile[0]), tile[1] - 1), y)
+            if abs(x1 - x0) >= MIN_ZOOM and abs(y1 - y0) >= MIN_ZOOM:
+                decoder.set_zoom((min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0)))
+            return
+        if event == cv2.EVENT_RBUTTONDOWN:
+            decoder, _, _ = locate(x, y)
+            if decoder is not None and decoder.zoom is not None:
+                decoder.set_zoom(None)
+            elif len(_view.monitors) > 1:
+                _view.show_mosaic()
+            return
+        if _zoom_start is not None:
+            return  # arrastando a seleção: nada de mover o mouse remoto
+
+    # movimentação contínua (fundida no InputBatcher se vier rápido demais)
     if event == cv2.EVENT_MOUSEMOVE:
         sx, sy = scale_to_server(x, y)
-        msg = {
-            "type": "mouse_move",
-            "x": sx,
-            "y": sy,
-        }
-        send_input(msg)
+        send_input(EV_MOVE, x=sx, y=sy)
+        if _cursor is not None:
+            _cursor.predict(sx, sy)  # o cursor anda já, sem esperar o servidor
 
     # botão pressionado
     elif event == cv2.EVENT_LBUTTONDOWN:
         mouse_buttons_down["left"] = True
         sx, sy = scale_to_server(x, y)
-        msg = {
-            "type": "mouse_click",
-            "x": sx,
-            "y": sy,
-            "button": "left",
-            "action": "press",
-        }
-        send_input(msg)
+        send_input(EV_BUTTON, BTN_LEFT | BUTTON_PRESS, sx, sy)
 
     elif event == cv2.EVENT_RBUTTONDOWN:
         mouse_buttons_down["right"] = True
         sx, sy = scale_to_server(x, y)
-        msg = {
-            "type": "mouse_click",
-            "x": sx,
-            "y": sy,
-            "button": "right",
-            "action": "press",
-        }
-        send_input(msg)
+        send_input(EV_BUTTON, BTN_RIGHT | BUTTON_PRESS, sx, sy)
 
     # botão solto
     elif event == cv2.EVENT_LBUTTONUP:
         if mouse_buttons_down["left"]:
             mouse_buttons_down["left"] = False
             sx, sy = scale_to_server(x, y)
-            msg = {
-                "type": "mouse_click",
-                "x": sx,
-                "y": sy,
-                "button": "left",
-                "action": "release",
-            }
-            send_input(msg)
+            send_input(EV_BUTTON, BTN_LEFT, sx, sy)
 
     elif event == cv2.EVENT_RBUTTONUP:
         if mouse_buttons_down["right"]:
             mouse_buttons_down["right"] = False
             sx, sy = scale_to_server(x, y)
-            msg = {
-                "type": "mouse_click",
-                "x": sx,
-                "y": sy,
-                "button": "right",
-                "action": "release",
-            }
-            send_input(msg)
+            send_input(EV_BUTTON, BTN_RIGHT, sx, sy)
 
     # scroll com botão do meio não vem aqui diretamente; se quiser, dá para mapear com flags.
 
 
+# ==========================
+# Decodificação
+# ==========================
+
+class FrameDecoder:
+    """
+    Aplica as mensagens de vídeo, em ordem, num framebuffer persistente.
+
+    Quando a janela é 2x/4x/8x menor que o stream, o JPEG é decodificado
+    já reduzido (cv2.IMREAD_REDUCED_COLOR_*), o que corta boa parte do custo
+    de decodificação. O fator só muda num frame completo; para não esperar,
+    o decoder pede um ao servidor pelo canal de controle.
+
+    O cache de tiles (TileStore) é preenchido pelas próprias mensagens: as
+    que guardam tiles nunca são puladas, senão os slots sairiam de sincronia
+    com o servidor.
+
+    O tamanho da janela (e a região de zoom, se houver) vai para o servidor
+    numa mensagem "viewport": ele recorta e reduz antes de codificar, e o
+    stream_config de volta diz qual região da tela o stream mostra (crop).
+
+    Com o vídeo no UDP, um MSG_LOST (mensagens perdidas) faz os deltas
+    seguintes serem ignorados até chegar o frame completo pedido ao servidor.
+
+    Depois de cada lote, um "ack" confirma ao servidor quantos frames do
+    stream já chegaram e foram aplicados (flow.py): ele só manda mais
+    alguns além disso, então a fila entre os dois nunca passa de uns frames.
+
+    Com notify (cliente na mesma máquina), o decoder pede os frames crus
+    por memória compartilhada (shm.py): o framebuffer passa a ser uma view
+    do slot do anel, sem decode nem cópia, e o zoom vira um recorte local
+    dela. notify() põe um MSG_SHM na fila do decode a cada frame novo.
+
+    monitor é a geometria (monitor, left, top, width, height) do monitor
+    de um stream assinado; None no stream original, cuja tela é a global
+    server_w x server_h.
+    """
+
+    def __init__(self, stream_w: int, stream_h: int, send_control, monitor: dict = None,
+                 notify=None):
+        self.stream_w = stream_w
+        self.stream_h = stream_h
+        self.send_control = send_control
+        self.monitor = monitor
+        self.notify = notify
+        self.shm = None          # ShmReader, com o vídeo na memória compartilhada
+        self.framebuffer = None
+        self.reduce = 1          # fator do framebuffer atual
+        self.wanted_reduce = 1   # fator ideal para o tamanho da janela
+        self.stats = {}          # última mensagem "stats" do servidor
+        self.stats_version = 0
+        self.cache = TileStore()
+        self.crop = None         # (x, y, w, h) da tela no stream; None = tela inteira
+        self.zoom = None         # região de zoom pedida
+        self._window = None
+        self._window_since = 0.0
+        self._sent_viewport = None
+        self.resync = None       # desde quando espera um frame completo depois de uma perda
+        self.frames = 0          # frames de vídeo recebidos (a numeração do ack)
+        self._acked = 0
+
+    @property
+    def screen_size(self):
+        """Tamanho da tela (ou do monitor) que o stream mostra."""
+        if self.monitor is not None:
+            return self.monitor["width"], self.monitor["height"]
+        return server_w, server_h
+
+    def _send_viewport(self) -> None:
+        w, h = self._window
+        self.send_control({"type": "viewport", "width": w, "height": h,
+                           "zoom": list(self.zoom) if self.zoom else None})
+        self._sent_viewport = (self._window, self.zoom)
+
+    def set_zoom(self, rect) -> None:
+        """Amplia a região (x, y, w, h) da tela do servidor; None volta à tela inteira."""
+        self.zoom = rect
+        if self._window is not None:
+            self._send_viewport()
+        if self.shm is not None:
+            self.notify()  # recorta o frame que já está no anel, sem esperar outro
+
+    def request_shm(self) -> None:
+        """Pede ao servidor os frames crus por memória compartilhada (só com notify)."""
+        if self.notify is not None and self.shm is None:
+            self.send_control({"type": "shm"})
+
+    def _attach_shm(self, info: dict) -> None:
+        if self.shm is not None:
+            self.shm.close()  # anel trocado (a resolução cresceu)
+        try:
+            self.shm = ShmReader(info, self.notify)
+        except (OSError, ValueError) as e:
+            # Outra máquina ou outro namespace de IPC: o vídeo segue pelo socket
+            print(f"[!] Memória compartilhada do servidor não abriu: {e}")
+            self.shm = None
+            self.send_control({"type": "shm", "enabled": False})
+            return
+        print(f"[INFO] Vídeo por memória compartilhada ({self.shm.name})")
+
+    def _apply_shm(self) -> bool:
+        """Passa a mostrar o frame mais novo do anel; True se o framebuffer mudou."""
+        frame = self.shm.acquire()
+        if frame is None:
+            if self.crop == self.zoom or self.shm.frame is None:
+                return False
+            frame = self.shm.frame  # só o zoom mudou
+        self.crop = self.zoom
+        if self.zoom is not None:
+            x, y, w, h = self.zoom
+            frame = frame[y:y + h, x:x + w]  # view: o zoom também não copia
+        self.framebuffer, self.reduce = frame, 1
+        self.stream_h, self.stream_w = frame.shape[:2]
+        self.resync = None
+        return True
+
+    def set_window(self, win_w: int, win_h: int) -> None:
+        """Chamado pelo loop de render com o tamanho atual da janela."""
+        now = time.monotonic()
+        if (win_w, win_h) != self._window:
+            self._window, self._window_since = (win_w, win_h), now
+        elif (self._window, self.zoom) != self._sent_viewport and now - self._window_since >= VIEWPORT_SETTLE:
+            # Só depois que a janela para de mudar: cada tamanho novo custa um frame completo
+            self._send_viewport()
+
+        wanted = 1
+        for factor in (8, 4, 2):
+            if self.stream_w >= win_w * factor and self.stream_h >= win_h * factor:
+                wanted = factor
+                break
+        if wanted != self.wanted_reduce:
+            self.wanted_reduce = wanted
+            # Cópias de scroll (ENC_COPY) só são exatas alinhadas à redução
+            self.send_control({"type": "decode_reduce", "reduce": wanted})
+            if self.framebuffer is not None:
+                self.send_control({"type": "keyframe_request"})
+
+    def _lost(self) -> None:
+        """Mensagens se perderam: o framebuffer só volta a valer num frame completo."""
+        self.resync = time.monotonic()
+        metrics.count("resyncs")
+        self.send_control({"type": "keyframe_request"})
+
+    def _handle_info(self, info: dict):
+        global server_w, server_h
+        if info.get("type") == "screen_info":
+            self.request_shm()  # primeira mensagem de um stream assinado
+            size = self.screen_size
+            if self.monitor is not None:
+                # Stream de um monitor: a geometria é a dele, não a global
+                self.monitor = {k: info[k] for k in ("monitor", "left", "top", "width", "height")}
+            else:
+                server_w, server_h = info["width"], info["height"]
+            if (info["width"], info["height"]) == size:
+                return  # reenviado depois de uma perda no UDP: nada mudou
+            # A resolução do servidor mudou no meio da sessão: tudo volta à
+            # tela inteira, no tamanho novo (o zoom era da tela antiga)
+            self.stream_w, self.stream_h = info["width"], info["height"]
+            self.framebuffer = None
+            self.crop = self.zoom = None
+            print(f"[INFO] Resolução do servidor mudou: {self.stream_w}x{self.stream_h}")
+        elif info.get("type") == "stream_config":
+            # O servidor mudou qualidade/escala. scale_to_server usa as dimensões
+            # do frame exibido, então basta descartar o framebuffer antigo
+            # se o tamanho mudou: o próximo frame chega completo.
+            w, h = info["width"], info["height"]
+            if (w, h) != (self.stream_w, self.stream_h):
+                self.stream_w, self.stream_h = w, h
+                self.framebuffer = None
+            self.crop = tuple(info["crop"]) if info.get("crop") else None
+            print(f"[INFO] Stream: {w}x{h}, qualidade {info['quality']}, escala {info['scale']}, "
+                  f"região {self.crop}")
+        elif info.get("type") == "stats":
+            self.stats = info["metrics"]
+            self.stats_version += 1
+        elif info.get("type") == "shm" and self.notify is not None:
+            self._attach_shm(info)
+
+    def process(self, msgs) -> bool:
+        """Aplica um lote de mensagens. Retorna True se o framebuffer mudou."""
+        started = time.perf_counter()
+        # Tudo o que veio antes do último frame completo já foi superado por ele
+        last_key = max((i for i, (t, _) in enumerate(msgs) if t in KEYFRAME_TYPES), default=0)
+
+        if self.resync is not None and time.monotonic() - self.resync >= RESYNC_RETRY:
+            self._lost()  # o frame completo não veio: o pedido (ou ele) se perdeu
+
+        changed = False
+        for i, (msg_type, body) in enumerate(msgs):
+            if msg_type == MSG_LOST:
+                if i >= last_key:
+                    self._lost()
+                continue
+            if msg_type == MSG_INFO:
+                self._handle_info(json.loads(bytes(body).decode("utf-8")))
+                continue
+            if msg_type == MSG_SHM:
+                if self.shm is not None and self._apply_shm():
+                    changed = True
+                continue
+            self.frames += 1  # pulado ou não, o frame chegou
+            if i < last_key and (msg_type == MSG_JPEG or not has_stores(body)):
+                continue
+            elif msg_type == MSG_JPEG:
+                reduce = self.wanted_reduce
+                frame = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), REDUCED_FLAGS[reduce])
+                if frame is not None:
+                    self.framebuffer, self.reduce = frame, reduce
+                    self.resync = None
+                    changed = True
+            elif msg_type == MSG_STRIPES:
+                # Frame completo em faixas: framebuffer novo, faixa por faixa
+                reduce = self.wanted_reduce
+                w, h, _ = unpack_update(body)
+                self.framebuffer = np.zeros((-(-h // reduce), -(-w // reduce), 3), dtype=np.uint8)
+                self.reduce = reduce
+                apply_update(self.framebuffer, body, reduce, self.cache)
+                self.resync = None
+                changed = True
+            elif msg_type == MSG_UPDATE and self.framebuffer is not None and self.resync is None:
+                # Delta: cola os tiles alterados sobre o framebuffer persistente
+                apply_update(self.framebuffer, body, self.reduce, self.cache)
+                changed = True
+        metrics.set_gauge("cache_bytes", self.cache.nbytes)
+        if self.frames != self._acked:
+            self._acked = self.frames
+            self.send_control({"type": "ack", "frame": self.frames,
+                               "decode_ms": round((time.perf_counter() - started) * 1000, 2)})
+        return changed
+
+
+class StreamView:
+    """
+    Os streams que a janela mostra. Começa com o stream original (o
+    monitor principal); subscribe() troca por monitores inteiros e/ou
+    miniaturas, cada um com o seu FrameDecoder, e o servidor só captura e
+    codifica o que foi assinado. compose() junta os framebuffers lado a
+    lado, numa altura comum, e diz onde ficou cada um (para o mouse).
+
+    O decoder original (primary) continua recebendo as "stats" mesmo
+    depois de sair da tela.
+    """
+
+    def __init__(self, primary: FrameDecoder, monitors=None):
+        self.primary = primary
+        self.monitors = {m["index"]: m for m in monitors or ()}
+        self.decoders = {None: primary}  # id do stream -> FrameDecoder exibido
+        self.mosaic = False
+        self._window = None
+
+    def _new_decoder(self, stream: int) -> FrameDecoder:
+        monitor = self.monitors[stream & ~STREAM_THUMBNAIL]
+        geometry = {"monitor": monitor["index"], "left": monitor["left"], "top": monitor["top"],
+                    "width": monitor["width"], "height": monitor["height"]}
+        send = self.primary.send_control
+        return FrameDecoder(monitor["width"], monitor["height"],
+                            lambda msg: send(dict(msg, stream=stream)), geometry, self.primary.notify)
+
+    def subscribe(self, monitors, thumbnails=()) -> None:
+        """Mostra esses monitores inteiros e as miniaturas desses outros."""
+        monitors = [m for m in monitors if m in self.monitors]
+        thumbnails = [m for m in thumbnails if m in self.monitors]
+        streams = monitors + [m | STREAM_THUMBNAIL for m in thumbnails]
+        # Dicionário novo, não alterado: a thread de decodificação lê sem trava
+        old, self.decoders = self.decoders, {sid: self.decoders.get(sid) or self._new_decoder(sid)
+                                             for sid in streams}
+        for sid, decoder in old.items():
+            if sid not in self.decoders and decoder.shm is not None:
+                decoder.shm.close()  # o servidor fecha o stream (e o anel) dele
+        self.mosaic = not monitors
+        self.primary.send_control({"type": "subscribe", "monitors": monitors, "thumbnails": thumbnails})
+        if self._window is not None:
+            self.set_window(*self._window)
+        print(f"[INFO] Monitores: {monitors or '-'}" + (f", miniaturas {thumbnails}" if thumbnails else ""))
+
+    def show_mosaic(self) -> None:
+        self.subscribe([], sorted(self.monitors))
+
+    def set_window(self, win_w: int, win_h: int) -> None:
+        """Cada stream exibido fica com uma fatia da largura da janela."""
+        self._window = (win_w, win_h)
+        decoders = list(self.decoders.values())
+        for decoder in decoders:
+            decoder.set_window(max(1, win_w // len(decoders)), win_h)
+
+    def process(self, msgs) -> bool:
+        """Distribui o lote pelos decoders; True se algum exibido mudou."""
+        decoders = self.decoders
+        batches = {None: []}
+        batches.update((sid, []) for sid in decoders)
+        for msg_type, body in msgs:
+            if msg_type == MSG_STREAM:
+                sid, msg_type, body = unpack_stream(body)
+                if sid in batches:
+                    batches[sid].append((msg_type, body))
+            elif msg_type in (MSG_LOST, MSG_SHM):
+                for batch in batches.values():
+                    batch.append((msg_type, body))  # a perda (ou o frame novo) pode ser de qualquer um
+            else:
+                batches[None].append((msg_type, body))
+
+        changed = False
+        for sid, batch in batches.items():
+            decoder = decoders.get(sid, self.primary if sid is None else None)
+            if decoder is not None and batch and decoder.process(batch) and sid in decoders:
+                changed = True
+        return changed
+
+    def compose(self):
+        """(frame, tiles) com os framebuffers exibidos lado a lado, ou (None, [])."""
+        decoders = list(self.decoders.values())
+        frames = [d.framebuffer for d in decoders]
+        if len(decoders) == 1:
+            frame = frames[0]
+            if frame is None:
+                return None, []
+            return frame.copy(), [(0, frame.shape[1], decoders[0])]
+        if all(f is None for f in frames):
+            return None, []
+
+        height = max(f.shape[0] for f in frames if f is not None)
+        parts, tiles, x = [], [], 0
+        for decoder, frame in zip(decoders, frames):
+            w, h = decoder.screen_size
+            width = max(1, round(height * w / h))
+            if frame is None:
+                part = np.zeros((height, width, 3), dtype=np.uint8)  # ainda sem o primeiro frame
+            elif frame.shape[0] != height:
+                width = max(1, round(frame.shape[1] * height / frame.shape[0]))
+                part = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LINEAR)
+            else:
+                part, width = frame, frame.shape[1]
+            parts.append(part)
+            tiles.append((x, x + width, decoder))
+            x += width
+        return cv2.hconcat(parts), tiles
+
+
+def receive_loop(recv_message, inbox: queue.Queue):
+    """Thread de rede: só lê mensagens e passa adiante, nunca espera decode."""
+    try:
+        while True:
+            msg_type, body = recv_message()
+            if msg_type is None:
+                break
+            inbox.put((msg_type, body))
+    except Exception as e:
+        print(f"[!] Conexão de vídeo encerrada: {e}")
+    finally:
+        inbox.put(None)
+
+
+def cursor_loop(recv_message, cursor: CursorView = None):
+    """Thread do canal do cursor: aplica posições e formas assim que chegam (sem cursor, descarta)."""
+    try:
+        while True:
+            msg_type, body = recv_message()
+            if msg_type is None:
+                break
+            if cursor is not None:
+                cursor.apply(msg_type, body)
+    except Exception:
+        pass  # o canal fecha junto com a conexão
+
+
+def start_udp_video(addr, token: str, inbox: queue.Queue) -> UdpReceiver:
+    """
+    Pede o vídeo por UDP a addr: os hellos levam o token da sessão até o primeiro
+    datagrama chegar. Enquanto isso (ou se nunca chegar) o vídeo segue no TCP.
+    """
+    receiver = UdpReceiver(create_udp_socket(), addr)
+
+    def receive():
+        first = True
+        while True:
+            msg_type, body = receiver.recv_message()
+            if msg_type is None:
+                return
+            if first:
+                # Os primeiros deltas do UDP podem partir de frames que ainda
+                # vinham pelo TCP: só o frame completo da troca é seguro
+                inbox.put((MSG_LOST, b""))
+                first = False
+            inbox.put((msg_type, body))
+
+    def hello():
+        if send_hellos(receiver.sock, addr, token, receiver):
+            print(f"[+] Vídeo por UDP de {addr[0]}:{addr[1]}")
+        else:
+            print("[!] Sem resposta no UDP, o vídeo continua no TCP")
+
+    threading.Thread(target=receive, daemon=True).start()
+    threading.Thread(target=hello, daemon=True).start()
+    return receiver
+
+
+def decode_loop(inbox: queue.Queue, view: StreamView, display: LatestSlot):
+    """
+    Thread de decodificação: pega tudo o que já chegou de uma vez, aplica
+    e publica só o frame resultante mais novo (e onde está cada stream
+    nele) para o render.
+    """
+    try:
+        while True:
+            msgs = [inbox.get()]
+            while not inbox.empty():
+                msgs.append(inbox.get_nowait())
+            done = None in msgs
+            msgs = [m for m in msgs if m is not None]
+            if not msgs:
+                changed = False
+            else:
+                with metrics.timer("decode_ms"):
+                    changed = view.process(msgs)
+            if changed:
+                frame, tiles = view.compose()
+                if frame is not None:
+                    metrics.count("frames_decoded")
+                    display.put((frame, tiles))
+            if done:
+                break
+    except Exception as e:
+        print(f"[!] Erro na decodificação: {e}")
+    finally:
+        display.close()
+
+
+# ==========================
+# Overlay de métricas
+# ==========================
+
+def stats_lines(server: dict, client: dict) -> list:
+    def hist(snap, name):
+        s = snap.get(name, {})
+        return f"{s['mean']:5.1f} / {s['p90']:5.1f} ms" if "mean" in s else "-"
+
+    def rate(snap, name):
+        return snap.get(name, {}).get("rate", 0.0)
+
+    def total(snap, name):
+        return snap.get(name, {}).get("total", 0)
+
+    looked_up = total(server, "cache_hits") + total(server, "cache_misses")
+    hit_rate = 100 * total(server, "cache_hits") / looked_up if looked_up else 0.0
+
+    lines = [
+        f"captura   {hist(server, 'capture_ms')}",
+        f"encode    {hist(server, 'encode_ms')}",
+        f"envio     {hist(server, 'send_ms')}",
+        f"enviados  {rate(server, 'frames_sent'):5.1f} fps  {rate(server, 'bytes_sent') * 8 / 1e6:6.2f} Mbit/s",
+        f"descart.  {total(server, 'frames_dropped')}  parados {total(server, 'frames_skipped')}",
+        f"input     {rate(server, 'input_events'):5.0f} ev/s",
+        f"cache     {hit_rate:5.1f}% acertos  {client.get('cache_bytes', {}).get('value', 0) / 2**20:6.1f} MB",
+        f"decode    {hist(client, 'decode_ms')}",
+        f"exibidos  {rate(client, 'frames_shown'):5.1f} fps",
+    ]
+    if "udp_loss_pct" in client:
+        lines.append(f"udp       {client['udp_loss_pct']['value']:4.1f}% perda  "
+                     f"{total(client, 'udp_recovered')} recup.  {total(client, 'resyncs')} resync")
+    return lines
+
+
+def draw_stats(frame: np.ndarray, lines: list) -> None:
+    """Desenha as linhas no canto superior esquerdo, sobre fundo opaco."""
+    line_h = 16
+    cv2.rectangle(frame, (0, 0), (330, line_h * len(lines) + 8), (0, 0, 0), -1)
+    for i, line in enumerate(lines):
+        cv2.putText(frame, line, (6, line_h * (i + 1)), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.42, (0, 255, 0), 1, cv2.LINE_AA)
+
+
 # ==========================
 # Loop principal
 # ==========================
 
 def start_client():
-    global _input_sock, _current_frame, server_w, server_h
-
-    # 1) Conecta no socket de vídeo
-    sock = create_client_socket(SERVER_HOST, SERVER_PORT)
-    print(f"[+] Conectado ao servidor (vídeo) {SERVER_HOST}:{SERVER_PORT}")
+    global _input_sock, _input_batcher, _current_frame, _tiles, _view, _cursor, server_w, server_h
+
+    mux = None
+    if MUX_MODE:
+        # 1) Uma conexão só, com canais de vídeo, input e controle
+        sock = create_client_socket(SERVER_HOST, MUX_PORT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        mux = MuxConnection(sock)
+        video = mux.channel(CH_VIDEO)
+        control = mux.channel(CH_CONTROL)
+        print(f"[+] Conectado ao servidor (multiplexado) {SERVER_HOST}:{MUX_PORT}")
+
+        def recv_video():
+            data = video.recv_frame()
+            return (data[0], memoryview(data)[1:]) if data else (None, b"")
+
+        def send_control(msg: dict):
+            control.send_frame(json.dumps(msg).encode("utf-8"))
+    else:
+        # 1) Conecta no socket de vídeo
+        sock = create_client_socket(SERVER_HOST, SERVER_PORT)
+        print(f"[+] Conectado ao servidor (vídeo) {SERVER_HOST}:{SERVER_PORT}")
+
+        # Cada mensagem é lida num buffer próprio (uma alocação, sem cópias)
+        # porque ela segue para outra thread decodificar
+        def recv_video():
+            return recv_message(sock)
+
+        def send_control(msg: dict):
+            # Controle vai pelo próprio socket de vídeo, no sentido contrário
+            send_frame(sock, json.dumps(msg).encode("utf-8"))
 
     # 2) Recebe primeiro frame: informações da tela do servidor
-    first = recv_frame(sock)
-    info = json.loads(first.decode("utf-8"))
+    msg_type, body = recv_video()
+    info = json.loads(bytes(body).decode("utf-8")) if msg_type == MSG_INFO else {}
     if info.get("type") == "screen_info":
         server_w = info["width"]
         server_h = info["height"]
         print(f"[INFO] Resolução do servidor: {server_w}x{server_h}")
 
-    # 3) Conecta no socket de input
-    _input_sock = create_client_socket(SERVER_HOST, INPUT_PORT)
-    print(f"[+] Conectado ao servidor (input) {SERVER_HOST}:{INPUT_PORT}")
+    cursor = _cursor = CursorView() if DRAW_CURSOR else None
+    if mux is not None:
+        # 3) No modo multiplexado o input já está pareado pela própria conexão
+        _input_batcher = InputBatcher(mux.channel(CH_INPUT).send_frame)
+        # O canal do cursor é sempre lido: a fila do mux não tem limite
+        cursor_channel = mux.channel(CH_CURSOR)
+
+        def recv_cursor():
+            data = cursor_channel.recv_frame()
+            return (data[0], memoryview(data)[1:]) if data else (None, b"")
+
+        threading.Thread(target=cursor_loop, args=(recv_cursor, cursor), daemon=True).start()
+    else:
+        # 3) Conecta no socket de input e se identifica com o token da sessão
+        _input_sock = create_client_socket(SERVER_HOST, INPUT_PORT)
+        # Eventos de input são pequenos: sem Nagle eles saem na hora
+        _input_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_frame(_input_sock, json.dumps({"type": "hello", "token": info.get("token"),
+                                            "cursor": cursor is not None}).encode("utf-8"))
+        _input_batcher = InputBatcher(lambda data: send_frame(_input_sock, data))
+        print(f"[+] Conectado ao servidor (input) {SERVER_HOST}:{INPUT_PORT}")
+        if cursor is not None:
+            # O cursor vem pelo socket de input, no sentido contrário
+            threading.Thread(target=cursor_loop, args=(lambda: recv_message(_input_sock), cursor),
+                             daemon=True).start()
 
     # 4) Cria janela e registra callback de mouse
     cv2.namedWindow("Remote Screen", cv2.WINDOW_NORMAL)
     cv2.resizeWindow("Remote Screen", 800, 600)  # Tamanho inicial da janela
     cv2.setMouseCallback("Remote Screen", mouse_callback)  # só eventos dentro da janela
 
+    # 5) Recepção e decodificação em threads; esta thread só desenha
+    inbox = queue.Queue()
+    notify = None
+    if (SHM_VIDEO is True or SHM_VIDEO == "auto" and is_local(SERVER_HOST)) and not UDP_VIDEO:
+        # Servidor nesta máquina: frames crus pela memória compartilhada
+        notify = lambda: inbox.put((MSG_SHM, b""))
+    decoder = FrameDecoder(server_w, server_h, send_control, notify=notify)
+    decoder.request_shm()  # o screen_info do stream original já foi lido acima
+    view = StreamView(decoder, info.get("monitors"))
+    view.set_window(800, 600)
+    _view = view
+    # Só um servidor com vários monitores manda a lista no screen_info
+    if info.get("monitors") and MOSAIC:
+        view.show_mosaic()
+    elif info.get("monitors") and MONITORS:
+        view.subscribe(MONITORS)
+    display = LatestSlot()
+    receiver = None
+    if UDP_VIDEO and info.get("token"):
+        receiver = start_udp_video((SERVER_HOST, UDP_PORT), info["token"], inbox)
+
+    def recv_tcp_video():
+        # Com o vídeo já no UDP, frames que ainda chegam pelo TCP são antigos
+        while True:
+            msg_type, body = recv_video()
+            if receiver is None or not receiver.packets or msg_type in (None, MSG_INFO):
+                return msg_type, body
+
+    threading.Thread(target=receive_loop, args=(recv_tcp_video, inbox), daemon=True).start()
+    threading.Thread(target=decode_loop, args=(inbox, view, display), daemon=True).start()
+    if METRICS_PORT is not None:
+        metrics.serve_metrics("127.0.0.1", METRICS_PORT)
+
+    shown_stats = 0
+    shown_cursor = 0
     try:
         while True:
-            jpeg_bytes = recv_frame(sock)
-            if not jpeg_bytes:
+            shown = display.get(timeout=0)
+            if shown is not None or (_current_frame is not None and (
+                    SHOW_STATS and decoder.stats_version != shown_stats
+                    or cursor is not None and cursor.version != shown_cursor)):
+                if shown is not None:
+                    # Armazena o frame exibido para usar na conversão de coordenadas
+                    _current_frame, _tiles = shown
+                    metrics.count("frames_shown")
+                # O frame já é uma cópia só do render: o overlay vai nele mesmo,
+                # mas o cursor, que muda sem frame novo, vai numa cópia
+                frame = _current_frame
+                if cursor is not None and cursor.position is not None:
+                    frame = frame.copy()
+                    cursor.draw(frame, _tiles)
+                    shown_cursor = cursor.version
+                if SHOW_STATS:
+                    draw_stats(frame, stats_lines(decoder.stats, metrics.snapshot()))
+                    shown_stats = decoder.stats_version
+                cv2.imshow("Remote Screen", frame)
+            elif display.closed:
                 print("[!] Frame vazio ou conexão encerrada.")
                 break
 
-            arr = np.frombuffer(jpeg_bytes, dtype=np.uint8)
-            frame = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-            if frame is None:
-                continue
-
-            # Armazena o frame atual para usar na conversão de coordenadas
-            _current_frame = frame
-
-            cv2.imshow("Remote Screen", frame)
-
-            # teclado só vale enquanto a janela está ativa/focada
-            key = cv2.waitKey(10) & 0xFF
+            # teclado só vale enquanto a janela está ativa/focada;
+            # o waitKey também dita o ritmo do render (~60 Hz)
+            key = cv2.waitKey(RENDER_INTERVAL_MS) & 0xFF
 
             # janela fechada
             if cv2.getWindowProperty("Remote Screen", cv2.WND_PROP_VISIBLE) < 1:
                 break
 
+            _, _, win_w, win_h = cv2.getWindowImageRect("Remote Screen")
+            if win_w > 0 and win_h > 0:
+                view.set_window(win_w, win_h)
+
             # ESC ou 'q' para sair
             if key in (27, ord('q')):
                 break
 
             # teclas normais enviadas para o servidor
             if key != 255:  # 255 = "nenhuma tecla"
-                msg = {
-                    "type": "key_press",
-                    "key": chr(key),
-                }
-                send_input(msg)
+                send_input(EV_KEY, 1, code=key)
                 # envia também key_release logo em seguida (modelo simples)
-                msg_rel = {
-                    "type": "key_release",
-                    "key": chr(key),
-                }
-                send_input(msg_rel)
+                send_input(EV_KEY, 0, code=key)
 
     except Exception as e:
         print(f"[!] Erro no cliente: {e}")
     finally:
         try:
-            sock.close()
+            if _input_batcher is not None:
+                _input_batcher.close()
+            if _input_sock is not None:
+                _input_sock.close()
         except Exception:
             pass
         try:
-            if _input_sock is not None:
-                _input_sock.close()
+            if mux is not None:
+                mux.close()
+            sock.close()
+            if receiver is not None:
+                receiver.sock.close()
         except Exception:
             pass
 
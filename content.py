@@ -0,0 +1,134 @@
+# content.py
+
+import struct
+import zlib
+
+import cv2
+import numpy as np
+
+from protocol import ENC_JPEG, ENC_PALETTE
+
+# ==========================
+# Configuração
+# ==========================
+
+SAMPLE_STEP = 2           # classifica olhando 1 a cada 2 pixels em cada eixo
+FLAT_MAX_COLORS = 32      # até aqui é UI/fundo chapado: sempre sem perda
+TEXT_MAX_COLORS = 160     # até aqui, com bordas suficientes, é texto
+EDGE_THRESHOLD = 24       # salto de luminância que conta como borda
+TEXT_MIN_EDGES = 0.05     # fração mínima de pixels de borda para ser texto
+PALETTE_MAX_COLORS = 256  # limite do codec de paleta (índice de 1 byte)
+ZLIB_LEVEL = 6
+
+PALETTE_HEADER = struct.Struct(">B")  # nº de cores - 1
+
+
+# ==========================
+# Classificação por tile
+# ==========================
+
+def _tile_blocks(arr: np.ndarray, rows: int, cols: int, ts: int) -> np.ndarray:
+    """(altura, largura) -> (linhas, colunas, ts*ts), completando as bordas."""
+    ph, pw = rows * ts - arr.shape[0], cols * ts - arr.shape[1]
+    if ph or pw:
+        arr = np.pad(arr, ((0, ph), (0, pw)), mode="edge")
+    return arr.reshape(rows, ts, cols, ts).transpose(0, 2, 1, 3).reshape(rows, cols, ts * ts)
+
+
+def classify_tiles(frame: np.ndarray, tile: int, mask: np.ndarray = None) -> np.ndarray:
+    """
+    Máscara (linhas x colunas de tiles) com True nos tiles que devem ir sem
+    perda: poucas cores (UI, fundo chapado) ou cores moderadas com muitas
+    bordas (texto anti-aliased). Foto/vídeo tem muitas cores e fica em JPEG.
+
+    Só os tiles marcados em mask são avaliados (o resto sai False).
+    Tudo vetorizado: as cores de todos os tiles são contadas com um único
+    np.sort ao longo do eixo dos pixels.
+    """
+    h, w = frame.shape[:2]
+    rows, cols = -(-h // tile), -(-w // tile)
+    ts = tile // SAMPLE_STEP
+    if mask is None:
+        mask = np.ones((rows, cols), dtype=bool)
+    result = np.zeros((rows, cols), dtype=bool)
+    if not mask.any():
+        return result
+
+    s = frame[::SAMPLE_STEP, ::SAMPLE_STEP].astype(np.int32)
+    key = (s[..., 0] << 16) | (s[..., 1] << 8) | s[..., 2]
+    luma = s[..., 0] + 2 * s[..., 1] + s[..., 2]  # 4x a luminância aproximada
+    edges = np.zeros(luma.shape, dtype=bool)
+    edges[:, :-1] = np.abs(np.diff(luma, axis=1)) > EDGE_THRESHOLD * 4
+
+    keys = np.sort(_tile_blocks(key, rows, cols, ts)[mask], axis=-1)
+    colours = 1 + np.count_nonzero(np.diff(keys, axis=-1), axis=-1)
+    edge_ratio = _tile_blocks(edges, rows, cols, ts)[mask].mean(axis=-1)
+
+    result[mask] = (colours <= FLAT_MAX_COLORS) | (
+        (colours <= TEXT_MAX_COLORS) & (edge_ratio >= TEXT_MIN_EDGES))
+    return result
+
+
+# ==========================
+# Codecs por região
+# ==========================
+
+def encode_jpeg(img: np.ndarray, quality: int):
+    """
+    JPEG como memoryview sobre o buffer do cv2.imencode: vai para o socket
+    (ou para o pack_update) sem a cópia extra de um tobytes().
+    """
+    ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return memoryview(buffer).cast("B") if ok else None
+
+
+def encode_palette(img: np.ndarray):
+    """
+    Sem perda: [nº de cores - 1][paleta BGR][índices de 1 byte em zlib].
+    Retorna None se a região tem mais de PALETTE_MAX_COLORS cores.
+    """
+    px = img.reshape(-1, 3).astype(np.int32)
+    key = (px[:, 0] << 16) | (px[:, 1] << 8) | px[:, 2]
+    colours, index = np.unique(key, return_inverse=True)
+    if len(colours) > PALETTE_MAX_COLORS:
+        return None
+    palette = np.stack([colours >> 16, (colours >> 8) & 0xFF, colours & 0xFF], axis=-1).astype(np.uint8)
+    return b"".join((
+        PALETTE_HEADER.pack(len(colours) - 1),
+        palette.tobytes(),
+        zlib.compress(index.astype(np.uint8).tobytes(), ZLIB_LEVEL),
+    ))
+
+
+def encode_region(img: np.ndarray, enc: int, quality: int):
+    """
+    Codifica a região com o codec pedido. Retorna (codificação, dados);
+    se a paleta não couber, cai para JPEG. dados é None se o encode falhou.
+    """
+    if enc == ENC_PALETTE:
+        data = encode_palette(img)
+        if data is not None:
+            return ENC_PALETTE, data
+    return ENC_JPEG, encode_jpeg(img, quality)
+
+
+def decode_region(data, enc: int, w: int, h: int, flag: int, reduce: int = 1):
+    """Decodifica uma região em 1/reduce do tamanho. None se inválida."""
+    if enc == ENC_JPEG:
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+
+    if enc == ENC_PALETTE:
+        (n,) = PALETTE_HEADER.unpack_from(data, 0)
+        n += 1
+        offset = PALETTE_HEADER.size
+        palette = np.frombuffer(data, dtype=np.uint8, count=n * 3, offset=offset).reshape(n, 3)
+        index = np.frombuffer(zlib.decompress(data[offset + n * 3:]), dtype=np.uint8)
+        if index.size != w * h:
+            return None
+        img = palette[index.reshape(h, w)]
+        if reduce > 1:
+            # Mesmo tamanho que o JPEG reduzido teria (arredondado para cima)
+            img = cv2.resize(img, (-(-w // reduce), -(-h // reduce)), interpolation=cv2.INTER_AREA)
+        return img
+
+    return None
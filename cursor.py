@@ -0,0 +1,360 @@
+# cursor.py
+
+import struct
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+import metrics
+
+try:
+    import mss
+    HAS_MSS = True
+except ImportError:
+    HAS_MSS = False
+
+MSS_WITH_CURSOR = (8, 0)  # with_cursor (XFixes, Linux) é API pública do mss desde a 8.0
+
+# ==========================
+# Formato
+# ==========================
+# O cursor não vai nos frames: a captura o deixa de fora (padrão do mss e do
+# PIL) e ele segue num canal próprio, do servidor para o cliente: o socket de
+# input no sentido contrário (modo separado, se o hello pedir "cursor") ou
+# CH_CURSOR (modo multiplexado). Mensagens tipadas (protocol.send_message):
+#   MSG_CURSOR_POS:   [x: 4][y: 4][forma: 2]  hotspot na área de trabalho,
+#                     nas mesmas coordenadas do EV_MOVE; forma 0 = sem imagem
+#                     conhecida (o cliente desenha uma seta)
+#   MSG_CURSOR_SHAPE: [forma: 2][hot x: 2][hot y: 2][largura: 2][altura: 2]
+#                     + zlib(BGRA); vem uma vez, antes da primeira posição
+#                     que usa a forma. Depois, trocar de forma custa 2 bytes.
+
+MSG_CURSOR_POS = 1
+MSG_CURSOR_SHAPE = 2
+
+CURSOR_POS = struct.Struct(">iiH")
+CURSOR_SHAPE = struct.Struct(">HHHHH")
+
+CURSOR_FPS = 120      # consultas por segundo ao cursor do host (só o que mudou é enviado)
+MAX_SHAPES = 0xFFFF   # ids de forma por conexão; depois disso, forma 0
+PREDICT_HOLD = 0.25   # s em que o cliente ignora o eco do servidor depois de um movimento local
+SHAPE_FPS = 10        # leituras da imagem do cursor por segundo (a posição segue em CURSOR_FPS)
+SHAPE_RADIUS = 64     # px em volta do ponteiro onde a imagem do cursor é procurada
+
+
+def pack_position(x: int, y: int, shape: int) -> bytes:
+    return CURSOR_POS.pack(int(x), int(y), shape)
+
+
+def pack_shape(shape: int, hot_x: int, hot_y: int, bgra: np.ndarray) -> bytes:
+    h, w = bgra.shape[:2]
+    return CURSOR_SHAPE.pack(shape, hot_x, hot_y, w, h) + zlib.compress(np.ascontiguousarray(bgra), 6)
+
+
+def unpack_shape(body):
+    """(forma, hot x, hot y, BGRA) de um MSG_CURSOR_SHAPE; None se inválido."""
+    shape, hot_x, hot_y, w, h = CURSOR_SHAPE.unpack_from(body, 0)
+    try:
+        pixels = zlib.decompress(body[CURSOR_SHAPE.size:])
+    except zlib.error:
+        return None
+    if len(pixels) != w * h * 4:
+        return None
+    return shape, hot_x, hot_y, np.frombuffer(pixels, dtype=np.uint8).reshape(h, w, 4)
+
+
+def default_arrow():
+    """(hot x, hot y, BGRA) de uma seta, para quando a forma real não é conhecida."""
+    bgra = np.zeros((19, 12, 4), dtype=np.uint8)
+    outline = np.array([[0, 0], [0, 15], [4, 11], [7, 18], [9, 17], [6, 10], [11, 10]], dtype=np.int32)
+    cv2.fillPoly(bgra, [outline], (0, 0, 0, 255))
+    inner = np.array([[1, 2], [1, 13], [4, 10], [7, 16], [8, 16], [5, 9], [9, 9]], dtype=np.int32)
+    cv2.fillPoly(bgra, [inner], (255, 255, 255, 255))
+    return 0, 0, bgra
+
+
+def draw_shape(frame: np.ndarray, x: int, y: int, bgra: np.ndarray, clip=None) -> None:
+    """
+    Compõe a imagem BGRA com o canto em (x, y) do frame, por alpha.
+    clip = (x0, x1): só dentro dessas colunas (o stream certo no mosaico).
+    """
+    x0, x1 = clip or (0, frame.shape[1])
+    h, w = bgra.shape[:2]
+    left, top = max(x, x0), max(y, 0)
+    right, bottom = min(x + w, x1, frame.shape[1]), min(y + h, frame.shape[0])
+    if right <= left or bottom <= top:
+        return
+    src = bgra[top - y:bottom - y, left - x:right - x]
+    alpha = src[..., 3:4].astype(np.float32) / 255
+    dst = frame[top:bottom, left:right]
+    dst[:] = (src[..., :3] * alpha + dst * (1 - alpha)).astype(np.uint8)
+
+
+# ==========================
+# Servidor: leitura do cursor do host
+# ==========================
+
+class VirtualPointer:
+    """
+    Ponteiro que só acompanha o input aplicado (apply_events). É o cursor
+    das fontes sintéticas e de um servidor sem pynput.
+    """
+
+    def __init__(self):
+        self.position = None
+
+    def move(self, x: int, y: int) -> None:
+        self.position = (x, y)
+
+
+virtual_pointer = VirtualPointer()
+
+
+class CursorSource:
+    """
+    Lê o cursor do host: read() -> (x, y, imagem) ou None se não se sabe
+    onde ele está. imagem é None ou (left, top, BGRA), o canto da imagem na
+    área de trabalho.
+
+    - Posição: position() (pynput no servidor ou o ponteiro virtual).
+    - Imagem: com image=True, pela opção pública with_cursor do mss (XFixes,
+      Linux, mss >= 8.0): a região em volta do ponteiro é capturada com e
+      sem o cursor, e os pixels que mudam são a imagem. Isso custa três
+      capturas pequenas, então a imagem é relida só SHAPE_FPS vezes por
+      segundo e, entre uma leitura e outra, acompanha a posição. Sem ela
+      (Windows, macOS, mss antigo) o cliente desenha a seta padrão. Os
+      handles do mss são abertos na thread que lê.
+    """
+
+    def __init__(self, position=None, image: bool = False):
+        self.position = position
+        self._image = image and HAS_MSS
+        self._plain = self._with_cursor = None
+        self._shape = None      # (canto - ponteiro em x, em y, BGRA) da última imagem lida
+        self._next_shape = 0.0
+
+    def _open(self) -> bool:
+        if self._with_cursor is not None:
+            return True
+        version = tuple(int(p) for p in mss.__version__.split(".")[:2] if p.isdigit())
+        if version < MSS_WITH_CURSOR:
+            _warn_once(f"mss {mss.__version__} não tem with_cursor (precisa >= 8.0)")
+            return False
+        try:
+            self._with_cursor = mss.mss(with_cursor=True)
+            self._plain = mss.mss()
+        except Exception as e:
+            self.close()
+            _warn_once(f"with_cursor do mss indisponível ({e})")
+            return False
+        if not self._with_cursor.with_cursor:  # o mss o desliga sem XFixes
+            self.close()
+            _warn_once("mss sem XFixes")
+            return False
+        return True
+
+    def _grab_shape(self, x: int, y: int):
+        """(canto - ponteiro, BGRA) do cursor em (x, y), ou None se a leitura não é confiável."""
+        area = self._plain.monitors[0]
+        left, top = max(area["left"], x - SHAPE_RADIUS), max(area["top"], y - SHAPE_RADIUS)
+        right = min(area["left"] + area["width"], x + SHAPE_RADIUS)
+        bottom = min(area["top"] + area["height"], y + SHAPE_RADIUS)
+        if right <= left or bottom <= top:
+            return None
+        region = {"left": left, "top": top, "width": right - left, "height": bottom - top}
+
+        def grab(sct):
+            shot = sct.grab(region)
+            return np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+
+        before = grab(self._plain)
+        cursor = grab(self._with_cursor)
+        after = grab(self._plain)
+        if not np.array_equal(before, after) or self.position() != (x, y):
+            return None  # a tela ou o ponteiro mudou no meio: fica a imagem anterior
+        mask = np.any(cursor[..., :3] != before[..., :3], axis=2)
+        if not mask.any():
+            return None
+        ys, xs = np.nonzero(mask)
+        y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        bgra = cursor[y0:y1, x0:x1].copy()
+        bgra[~mask[y0:y1, x0:x1]] = 0  # fundo transparente: a mesma seta dá sempre a mesma forma
+        bgra[..., 3] = np.where(mask[y0:y1, x0:x1], 255, 0)
+        return left + int(x0) - x, top + int(y0) - y, bgra
+
+    def _read_image(self, x: int, y: int):
+        now = time.monotonic()
+        if now >= self._next_shape:
+            self._next_shape = now + 1.0 / SHAPE_FPS
+            if not self._open():
+                self._image = False
+                return None
+            try:
+                self._shape = self._grab_shape(x, y) or self._shape
+            except Exception as e:
+                self.close()
+                self._image = False
+                _warn_once(f"imagem do cursor indisponível ({e})")
+                return None
+        if self._shape is None:
+            return None
+        dx, dy, bgra = self._shape
+        return x + dx, y + dy, bgra
+
+    def read(self):
+        position = self.position() if self.position is not None else None
+        if position is None:
+            return None
+        x, y = position
+        image = self._read_image(x, y) if self._image else None
+        return x, y, image
+
+    def close(self) -> None:
+        for sct in (self._plain, self._with_cursor):
+            if sct is not None:
+                sct.close()
+        self._plain = self._with_cursor = None
+
+
+_warned = False
+
+
+def _warn_once(reason: str) -> None:
+    global _warned
+    if not _warned:
+        _warned = True
+        print(f"[!] {reason}; o cliente desenha uma seta no lugar da imagem do cursor")
+
+
+class CursorTracker:
+    """
+    Thread que acompanha o cursor do host CURSOR_FPS vezes por segundo e
+    manda pelo canal do cursor só o que mudou. Cada imagem nova vira uma
+    forma com id, enviada uma vez; o hotspot é fixado quando ela aparece
+    (posição do ponteiro menos o canto da imagem) e a posição enviada é
+    sempre canto + hotspot, então o cliente a desenha no lugar exato.
+
+    Nada disso passa pela captura: mexer o mouse não gera frame de vídeo.
+    """
+
+    def __init__(self, send, source: CursorSource, fps: float = CURSOR_FPS):
+        self.send = send  # (tipo, corpo); ConnectionError/OSError encerram a thread
+        self.source = source
+        self.interval = 1.0 / fps
+        self._shapes = {}  # (tamanho, crc dos pixels) -> (forma, hot x, hot y)
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cursor", daemon=True)
+        self._thread.start()
+
+    def _shape(self, x, y, image):
+        """(forma, x, y) do hotspot; registra e envia a forma se ela é nova."""
+        left, top, bgra = image
+        key = (bgra.shape, zlib.crc32(bgra))
+        known = self._shapes.get(key)
+        if known is None:
+            h, w = bgra.shape[:2]
+            hot_x = min(max(0, x - left), w - 1) if x is not None else 0
+            hot_y = min(max(0, y - top), h - 1) if y is not None else 0
+            shape = len(self._shapes) + 1
+            if shape > MAX_SHAPES:
+                return 0, left + hot_x, top + hot_y
+            known = self._shapes[key] = (shape, hot_x, hot_y)
+            self.send(MSG_CURSOR_SHAPE, pack_shape(shape, hot_x, hot_y, bgra))
+            metrics.count("cursor_shapes")
+        shape, hot_x, hot_y = known
+        return shape, left + hot_x, top + hot_y
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.wait(self.interval):
+                state = self.source.read()
+                if state is None:
+                    continue
+                x, y, image = state
+                shape = 0
+                if image is not None:
+                    shape, x, y = self._shape(x, y, image)
+                if (x, y, shape) == self._last:
+                    continue
+                self._last = (x, y, shape)
+                self.send(MSG_CURSOR_POS, pack_position(x, y, shape))
+                metrics.count("cursor_updates")
+        except (ConnectionError, OSError):
+            pass  # o canal fechou: a conexão está terminando
+        finally:
+            self.source.close()
+
+    def close(self) -> None:
+        self._stop.set()
+
+
+# ==========================
+# Cliente: cursor desenhado localmente
+# ==========================
+
+class CursorView:
+    """
+    Lado do cliente: as formas recebidas (por id), a posição atual e o
+    desenho sobre o frame exibido, feito no render a cada mudança, sem
+    esperar vídeo.
+
+    Um movimento local do mouse (predict) move o cursor na hora; durante
+    PREDICT_HOLD as posições do servidor, que são o eco de movimentos já
+    desenhados, só trocam a forma.
+    """
+
+    def __init__(self):
+        self.shapes = {0: default_arrow()}  # forma -> (hot x, hot y, BGRA)
+        self.position = None                # hotspot na área de trabalho do servidor
+        self.shape = 0
+        self.version = 0                    # muda a cada alteração visível
+        self._predicted = 0.0
+
+    def apply(self, msg_type: int, body) -> None:
+        """Aplica uma mensagem do canal do cursor (tipos desconhecidos são ignorados)."""
+        if msg_type == MSG_CURSOR_SHAPE:
+            shape = unpack_shape(body)
+            if shape is not None:
+                self.shapes[shape[0]] = shape[1:]
+        elif msg_type == MSG_CURSOR_POS:
+            x, y, shape = CURSOR_POS.unpack_from(body, 0)
+            if time.monotonic() - self._predicted >= PREDICT_HOLD:
+                self.position = (x, y)
+            self.shape = shape
+            self.version += 1
+
+    def predict(self, x: int, y: int) -> None:
+        """O mouse local mexeu (coordenadas do servidor): desenha lá sem esperar o eco."""
+        self.position = (x, y)
+        self._predicted = time.monotonic()
+        self.version += 1
+
+    def draw(self, frame: np.ndarray, tiles) -> None:
+        """
+        Desenha o cursor no stream que mostra a posição dele. tiles é a lista
+        (x inicial, x final, FrameDecoder) do frame exibido; o cursor segue a
+        escala (e o zoom) de cada stream.
+        """
+        if self.position is None:
+            return
+        hot_x, hot_y, bgra = self.shapes.get(self.shape) or self.shapes[0]
+        frame_h = frame.shape[0]
+        for x0, x1, decoder in tiles:
+            screen_w, screen_h = decoder.screen_size
+            left, top = (decoder.monitor["left"], decoder.monitor["top"]) if decoder.monitor else (0, 0)
+            sx, sy = self.position[0] - left, self.position[1] - top
+            crop_x, crop_y, crop_w, crop_h = decoder.crop or (0, 0, screen_w, screen_h)
+            if not (crop_x <= sx < crop_x + crop_w and crop_y <= sy < crop_y + crop_h):
+                continue
+            scale = frame_h / crop_h
+            image = bgra
+            if abs(scale - 1.0) > 0.05:
+                size = (max(1, round(bgra.shape[1] * scale)), max(1, round(bgra.shape[0] * scale)))
+                image = cv2.resize(bgra, size, interpolation=cv2.INTER_AREA)
+            fx = x0 + (sx - crop_x) * (x1 - x0) / crop_w
+            fy = (sy - crop_y) * scale
+            draw_shape(frame, round(fx - hot_x * scale), round(fy - hot_y * scale), image, (x0, x1))
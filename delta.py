@@ -0,0 +1,474 @@
+# delta.py
+
+import cv2
+import numpy as np
+
+import metrics
+from content import classify_tiles, encode_jpeg, encode_region, decode_region
+from protocol import (
+    MSG_JPEG, MSG_UPDATE, MSG_STRIPES, ENC_JPEG, ENC_PALETTE, ENC_CACHED, ENC_STORE, ENC_COPY,
+    pack_update, unpack_update,
+)
+from motion import COPY_SOURCE, MIN_MOVE_TILES, detect_move, align_move, copy_rect
+from tilecache import TileCache, tile_hash, slot_rects, SLOT_DTYPE
+
+# ==========================
+# Configuração
+# ==========================
+
+TILE_SIZE = 64           # lado do tile em pixels
+FULL_FRAME_RATIO = 0.5   # acima dessa fração de tiles alterados, manda o frame inteiro
+REFINE_FRAMES = 3        # frames parado até um tile em JPEG ser refinado (~250 ms com pacing)
+REFINE_QUALITY = 90      # qualidade do reenvio; JPEG já nessa qualidade não é refinado
+REFINE_TILES = 128       # máx. de tiles refinados por vaga ociosa (limita o tamanho da mensagem)
+
+
+# ==========================
+# Detecção de tiles alterados
+# ==========================
+
+def changed_tiles(prev: np.ndarray, cur: np.ndarray, tile: int = TILE_SIZE) -> np.ndarray:
+    """
+    Compara dois frames e devolve uma máscara (linhas x colunas de tiles)
+    com True nos tiles que mudaram. Tudo vetorizado no NumPy: o OR por tile
+    é um reduceat sobre os bytes de cada linha (reduzir o eixo das 3 cores
+    à parte custa ~15x mais). Tiles cortados na borda entram normalmente.
+    """
+    h = cur.shape[0]
+    diff = (prev != cur).reshape(h, -1)
+    diff = np.logical_or.reduceat(diff, np.arange(0, diff.shape[1], tile * cur.shape[2]), axis=1)
+    return np.logical_or.reduceat(diff, np.arange(0, h, tile), axis=0)
+
+
+def tile_runs(mask: np.ndarray):
+    """
+    Junta tiles alterados vizinhos na mesma linha em "corridas"
+    (linha, coluna inicial, coluna final exclusiva), para gerar menos JPEGs.
+    """
+    runs = []
+    for row in np.flatnonzero(mask.any(axis=1)):
+        line = np.concatenate(([False], mask[row], [False]))
+        edges = np.flatnonzero(line[1:] != line[:-1])
+        for start, end in zip(edges[::2], edges[1::2]):
+            runs.append((int(row), int(start), int(end)))
+    return runs
+
+
+# ==========================
+# Codificador delta
+# ==========================
+
+class DeltaEncoder:
+    """
+    Mantém o último frame enviado e gera, para cada novo frame,
+    só os tiles que mudaram (MSG_UPDATE) ou o frame inteiro (MSG_JPEG).
+    Com um StripeEncoder, o frame inteiro vira MSG_STRIPES e os
+    retângulos são codificados em paralelo.
+
+    Com content=True cada tile é classificado (content.classify_tiles):
+    texto e UI vão sem perda (ENC_PALETTE) e o resto continua em JPEG.
+    O frame inteiro vira um MSG_STRIPES com as faixas JPEG por baixo e as
+    regiões sem perda por cima.
+
+    Com cache=True, tiles que o cliente já recebeu antes (mesmo hash de
+    conteúdo, em qualquer posição da grade) vão como referência a um slot
+    do cache em vez de pixels: voltar para uma janela ou aba já vista custa
+    alguns bytes por tile. Tiles repetidos no mesmo frame também.
+
+    Com motion=True, um scroll ou arraste (motion.detect_move) vira uma
+    cópia de retângulo dentro do framebuffer do cliente (ENC_COPY) e só a
+    faixa que apareceu vai como pixels. move_align é a redução com que o
+    cliente decodifica: só saem cópias que ficam exatas no framebuffer dele.
+
+    Com refine=True o que muda sai na qualidade do stream (baixa, rápido) e,
+    numa vaga ociosa (frame sem nenhuma mudança), os tiles que saíram em
+    JPEG abaixo de REFINE_QUALITY e estão parados há REFINE_FRAMES frames
+    são reenviados uma vez em REFINE_QUALITY. O estado por tile (_lossy,
+    _age) garante que nada é refinado duas vezes: só um novo envio em
+    qualidade baixa marca o tile de novo. Enquanto a tela muda, nada extra
+    é enviado.
+    """
+
+    def __init__(self, quality: int = 50, tile: int = TILE_SIZE, stripes=None,
+                 content: bool = False, cache: bool = False, motion: bool = False,
+                 refine: bool = False):
+        self.quality = quality
+        self.tile = tile
+        self.stripes = stripes
+        self.content = content
+        self.cache = TileCache() if cache else None
+        self.motion = motion
+        self.move_align = 1
+        self.refine = refine
+        self.prev = None
+        self._force_keyframe = False
+        self._lossy = None    # por tile: o cliente tem uma versão JPEG abaixo de REFINE_QUALITY
+        self._age = None      # por tile: frames desde o último envio (satura em 255)
+        self._sharp = set()   # slots do cache com o tile em qualidade alta ou sem perda
+
+    def reset(self):
+        """Força o próximo frame a ser enviado completo."""
+        self.prev = None
+
+    def request_keyframe(self):
+        """Como reset(), mas pode ser chamado de outra thread durante encode()."""
+        self._force_keyframe = True
+
+    def _regions(self, mask: np.ndarray, enc: int, w: int, h: int) -> list:
+        """Corridas de tiles marcados -> (x, y, w, h, codificação)."""
+        t = self.tile
+        regions = []
+        for row, start, end in tile_runs(mask):
+            y, x = row * t, start * t
+            regions.append((x, y, min((end - start) * t, w - x), min(t, h - y), enc))
+        return regions
+
+    def _encode_regions(self, frame: np.ndarray, regions, quality: int = None) -> list:
+        quality = self.quality if quality is None else quality
+        if self.stripes is not None:
+            return self.stripes.encode_rects(frame, regions, quality)
+        return [encode_region(frame[y:y + h, x:x + w], enc, quality)
+                for x, y, w, h, enc in regions]
+
+    # ==========================
+    # Refinamento progressivo
+    # ==========================
+
+    def refine_pending(self) -> bool:
+        """True se ainda há tiles a refinar (a tela parada ainda tem o que enviar)."""
+        lossy = self._lossy
+        return lossy is not None and bool(lossy.any())
+
+    def _note(self, rects, quality: int) -> None:
+        """
+        Atualiza o estado de qualidade dos tiles cobertos pelos retângulos
+        enviados, na ordem da mensagem (o que vem depois cobre o que veio antes).
+        """
+        if self._lossy is None:
+            return
+        t = self.tile
+        low = quality < REFINE_QUALITY
+        for x, y, w, h, enc, data in rects:
+            if enc == ENC_COPY:
+                continue  # o estado já foi copiado junto (_moved)
+            if enc in (ENC_CACHED, ENC_STORE):
+                row, col = y // t, x // t
+                for i, slot in enumerate(np.frombuffer(data, dtype=SLOT_DTYPE).tolist()):
+                    if enc == ENC_STORE:
+                        # O slot guarda o tile como ele está no cliente agora
+                        if self._lossy[row, col + i]:
+                            self._sharp.discard(slot)
+                        else:
+                            self._sharp.add(slot)
+                    else:
+                        self._lossy[row, col + i] = slot not in self._sharp
+                        self._age[row, col + i] = 0
+                continue
+            rows, cols = slice(y // t, -(-(y + h) // t)), slice(x // t, -(-(x + w) // t))
+            self._lossy[rows, cols] = low and enc == ENC_JPEG
+            self._age[rows, cols] = 0
+
+    def _moved(self, x: int, y: int, w: int, h: int, src_x: int, src_y: int) -> None:
+        """
+        Cópia de retângulo: cada tile do destino herda a qualidade dos (até
+        2 x 2) tiles da origem que o cobrem. Tiles só em parte no destino
+        continuam baixos se já eram.
+        """
+        t = self.tile
+        n_rows, n_cols = self._lossy.shape
+        rows = np.arange(y // t, min(n_rows, -(-(y + h) // t)))
+        cols = np.arange(x // t, min(n_cols, -(-(x + w) // t)))
+        dy, dx = y - src_y, x - src_x
+        r0 = np.clip((rows * t - dy) // t, 0, n_rows - 1)
+        r1 = np.clip(((rows + 1) * t - 1 - dy) // t, 0, n_rows - 1)
+        c0 = np.clip((cols * t - dx) // t, 0, n_cols - 1)
+        c1 = np.clip(((cols + 1) * t - 1 - dx) // t, 0, n_cols - 1)
+        src = self._lossy
+        moved = (src[np.ix_(r0, c0)] | src[np.ix_(r0, c1)]
+                 | src[np.ix_(r1, c0)] | src[np.ix_(r1, c1)])
+        inside = ((rows * t >= y) & ((rows + 1) * t <= y + h))[:, None] \
+            & ((cols * t >= x) & ((cols + 1) * t <= x + w))[None, :]
+        dest = np.ix_(rows, cols)
+        self._lossy[dest] = moved | (self._lossy[dest] & ~inside)
+        self._age[dest] = 0
+
+    def _refine(self, frame: np.ndarray):
+        """
+        Vaga ociosa: reenvia até REFINE_TILES tiles JPEG parados há
+        REFINE_FRAMES frames, em REFINE_QUALITY ou, com content, sem perda
+        onde o tile é texto/UI. Com cache, o slot de cada tile
+        refinado é regravado (ENC_STORE no mesmo slot) para que um acerto
+        futuro já traga a versão boa.
+        """
+        due = self._lossy & (self._age >= REFINE_FRAMES)
+        if not due.any():
+            return None
+        tiles = np.flatnonzero(due)
+        if len(tiles) > REFINE_TILES:
+            due = np.zeros_like(due)
+            due.flat[tiles[:REFINE_TILES]] = True
+        # Marcado antes do encode: um tile que falha não é tentado de novo a cada frame
+        self._lossy[due] = False
+
+        h, w = frame.shape[:2]
+        t = self.tile
+        with metrics.timer("refine_ms"):
+            if self.content:
+                lossless = classify_tiles(frame, t, due)
+                regions = (self._regions(due & ~lossless, ENC_JPEG, w, h)
+                           + self._regions(due & lossless, ENC_PALETTE, w, h))
+            else:
+                regions = self._regions(due, ENC_JPEG, w, h)
+            rects = []
+            sent = np.zeros_like(due)
+            for (x, y, rw, rh, _), (enc, data) in zip(
+                    regions, self._encode_regions(frame, regions, REFINE_QUALITY)):
+                if data is None:
+                    continue
+                rects.append((x, y, rw, rh, enc, data))
+                sent[y // t, x // t:-(-(x + rw) // t)] = True
+            if self.cache is not None:
+                stores = {}
+                for row, col in zip(*np.nonzero(sent[:h // t, :w // t])):
+                    slot = self.cache.lookup(tile_hash(frame[row * t:(row + 1) * t, col * t:(col + 1) * t]))
+                    if slot is not None:
+                        stores[(int(row), int(col))] = slot
+                rects.extend(slot_rects(stores, ENC_STORE, t))
+        if not rects:
+            return None
+        self._note(rects, REFINE_QUALITY)
+        metrics.count("tiles_refined", int(sent.sum()))
+        return MSG_UPDATE, pack_update(w, h, rects)
+
+    def _classify(self, frame: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+        with metrics.timer("classify_ms"):
+            lossless = classify_tiles(frame, self.tile, mask)
+        changed = int(mask.sum()) if mask is not None else lossless.size
+        metrics.count("tiles_lossless", int(lossless.sum()))
+        metrics.count("tiles_jpeg", changed - int(lossless.sum()))
+        return lossless
+
+    def _lookup(self, frame: np.ndarray, mask: np.ndarray):
+        """
+        Procura no cache os tiles inteiros marcados em mask (os da borda,
+        cortados, ficam de fora). Retorna (hits, pending, todo):
+        - hits: {(linha, coluna): slot} dos tiles que o cliente já tem;
+        - pending: {hash: [(linha, coluna), ...]} dos tiles novos; só o
+          primeiro de cada hash é codificado, os repetidos viram referência;
+        - todo: mask sem os tiles que não precisam ser codificados.
+        """
+        t = self.tile
+        h, w = frame.shape[:2]
+        hits, pending = {}, {}
+        todo = mask.copy()
+        if mask.size >= self.cache.capacity:
+            # Frame com mais tiles que o cache: um tile novo poderia despejar
+            # outro usado no mesmo frame
+            return hits, pending, todo
+
+        with metrics.timer("cache_ms"):
+            for row, col in zip(*np.nonzero(mask[:h // t, :w // t])):
+                key = tile_hash(frame[row * t:(row + 1) * t, col * t:(col + 1) * t])
+                slot = self.cache.lookup(key)
+                if slot is not None:
+                    hits[(int(row), int(col))] = slot
+                elif key in pending:
+                    pending[key].append((int(row), int(col)))
+                else:
+                    pending[key] = [(int(row), int(col))]
+                    continue
+                todo[row, col] = False
+        return hits, pending, todo
+
+    def _cache_rects(self, hits: dict, pending: dict, sent: np.ndarray = None) -> list:
+        """
+        Reserva slots para os tiles novos enviados (sent; None = todos) e
+        monta os retângulos ENC_STORE seguidos dos ENC_CACHED. Vão no fim da
+        mensagem: o cliente guarda o tile depois de decodificá-lo e um tile
+        repetido no mesmo frame pode apontar para o slot recém-guardado.
+        """
+        stores = {}
+        hits = dict(hits)
+        for key, tiles in pending.items():
+            if sent is not None and not sent[tiles[0]]:
+                continue
+            slot = self.cache.insert(key)
+            stores[tiles[0]] = slot
+            for tile in tiles[1:]:
+                hits[tile] = slot
+
+        metrics.count("cache_hits", len(hits))
+        metrics.count("cache_misses", len(stores))
+        metrics.set_gauge("cache_tiles", len(self.cache))
+        return slot_rects(stores, ENC_STORE, self.tile) + slot_rects(hits, ENC_CACHED, self.tile)
+
+    def _composite(self, frame: np.ndarray):
+        """
+        Frame inteiro com JPEG onde é foto, paleta onde é texto/UI e
+        referências ao cache onde o cliente já tem o tile.
+        """
+        h, w = frame.shape[:2]
+        t = self.tile
+        todo = np.ones((-(-h // t), -(-w // t)), dtype=bool)
+        if self.cache is not None:
+            hits, pending, todo = self._lookup(frame, todo)
+        lossless = self._classify(frame, todo) if self.content else np.zeros_like(todo)
+        photo = todo & ~lossless
+        rects = []
+
+        jpeg_rows = np.flatnonzero(photo.any(axis=1))
+        sparse = photo.mean() <= FULL_FRAME_RATIO
+        if len(jpeg_rows) and not sparse:
+            # Faixas JPEG da primeira à última linha de tiles com foto. Os demais
+            # tiles dentro delas viram preto chapado (quase nenhum byte) e são
+            # cobertos depois; os blocos do JPEG não cruzam a borda do tile.
+            r0, r1 = jpeg_rows[0], jpeg_rows[-1] + 1
+            y0, y1 = r0 * t, min(h, r1 * t)
+            part = frame[y0:y1].copy()
+            flat = np.repeat(np.repeat(~photo[r0:r1], t, axis=0), t, axis=1)
+            part[flat[:y1 - y0, :w]] = 0
+            if self.stripes is not None:
+                stripe_rects = self.stripes.stripe_rects(part, self.quality, y0)
+            else:
+                data = encode_jpeg(part, self.quality)
+                stripe_rects = [(0, y0, w, y1 - y0, ENC_JPEG, data)] if data is not None else None
+            if stripe_rects is None:
+                return None
+            rects.extend(stripe_rects)
+
+        regions = self._regions(todo & lossless, ENC_PALETTE, w, h)
+        if sparse:
+            # Pouca foto: corridas de tiles JPEG, como num delta
+            regions = self._regions(photo, ENC_JPEG, w, h) + regions
+        for (x, y, rw, rh, _), (enc, data) in zip(regions, self._encode_regions(frame, regions)):
+            if data is None:
+                return None
+            rects.append((x, y, rw, rh, enc, data))
+        if self.cache is not None:
+            rects.extend(self._cache_rects(hits, pending))
+        self._note(rects, self.quality)
+        return MSG_STRIPES, pack_update(w, h, rects)
+
+    def _full(self, frame: np.ndarray):
+        """Frame inteiro: (tipo, corpo) ou None se o encode falhou."""
+        if self.refine:
+            t = self.tile
+            grid = (-(-frame.shape[0] // t), -(-frame.shape[1] // t))
+            self._lossy = np.full(grid, self.quality < REFINE_QUALITY)
+            self._age = np.zeros(grid, dtype=np.uint8)
+        if self.content or self.cache is not None:
+            msg = self._composite(frame)
+        elif self.stripes is not None:
+            msg = self.stripes.encode_frame(frame, self.quality)
+        else:
+            data = encode_jpeg(frame, self.quality)
+            msg = (MSG_JPEG, data) if data is not None else None
+        if msg is not None:
+            self.prev = frame.copy()
+        return msg
+
+    def encode(self, frame: np.ndarray):
+        """
+        Retorna (tipo, corpo) pronto para send_message,
+        ou None se nada mudou desde o último frame.
+        """
+        if self._force_keyframe:
+            self._force_keyframe = False
+            self.prev = None
+
+        if self.prev is None or self.prev.shape != frame.shape:
+            return self._full(frame)
+
+        mask = changed_tiles(self.prev, frame, self.tile)
+        if self._lossy is not None:
+            self._age[self._age < 255] += 1
+        if not mask.any():
+            return self._refine(frame) if self._lossy is not None else None
+
+        rects = []
+        if self.motion and mask.sum() >= MIN_MOVE_TILES:
+            with metrics.timer("motion_ms"):
+                move = detect_move(self.prev, frame, self.tile)
+                if move is not None and self.move_align > 1:
+                    move = align_move(move, self.move_align)
+            if move is not None:
+                # O cliente copia o bloco no framebuffer dele; a referência
+                # faz a mesma cópia e o delta sai só da faixa nova
+                x, y, rw, rh, src_x, src_y = move
+                copy_rect(self.prev, *move)
+                if self._lossy is not None:
+                    self._moved(*move)
+                rects.append((x, y, rw, rh, ENC_COPY, COPY_SOURCE.pack(src_x, src_y)))
+                metrics.count("moves")
+                mask = changed_tiles(self.prev, frame, self.tile)
+
+        if mask.mean() > FULL_FRAME_RATIO:
+            return self._full(frame)
+
+        h, w = frame.shape[:2]
+        t = self.tile
+        todo = mask
+        if self.cache is not None:
+            hits, pending, todo = self._lookup(frame, mask)
+        if self.content:
+            lossless = self._classify(frame, todo)
+            regions = (self._regions(todo & ~lossless, ENC_JPEG, w, h)
+                       + self._regions(todo & lossless, ENC_PALETTE, w, h))
+        else:
+            regions = self._regions(todo, ENC_JPEG, w, h)
+
+        sent = np.zeros_like(mask)
+        for (x, y, rw, rh, _), (enc, data) in zip(regions, self._encode_regions(frame, regions)):
+            if data is None:
+                continue
+            rects.append((x, y, rw, rh, enc, data))
+            sent[y // t, x // t:-(-(x + rw) // t)] = True
+            # Atualiza a referência só com o que foi realmente enviado
+            self.prev[y:y + rh, x:x + rw] = frame[y:y + rh, x:x + rw]
+
+        if self.cache is not None:
+            cached = self._cache_rects(hits, pending, sent)
+            rects.extend(cached)
+            for x, y, rw, rh, enc, _ in cached:
+                if enc == ENC_CACHED:
+                    self.prev[y:y + rh, x:x + rw] = frame[y:y + rh, x:x + rw]
+
+        self._note(rects, self.quality)
+        return MSG_UPDATE, pack_update(w, h, rects)
+
+
+# Flags do cv2.imdecode para decodificar o JPEG já reduzido (1/2, 1/4, 1/8)
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def apply_update(framebuffer: np.ndarray, body, reduce: int = 1, cache=None) -> None:
+    """
+    Decodifica os retângulos de um MSG_UPDATE (ou MSG_STRIPES), em ordem,
+    e os cola no framebuffer.
+    Com reduce > 1 o framebuffer está em 1/reduce da resolução do stream;
+    como os tiles começam em múltiplos de 64, as posições dividem exato.
+    cache (tilecache.TileStore) resolve os retângulos ENC_CACHED/ENC_STORE.
+    """
+    flag = REDUCED_FLAGS[reduce]
+    fb_h, fb_w = framebuffer.shape[:2]
+    _, _, rects = unpack_update(body)
+    for x, y, w, h, enc, data in rects:
+        if enc == ENC_COPY:
+            copy_rect(framebuffer, x, y, w, h, *COPY_SOURCE.unpack_from(data), reduce)
+            continue
+        if enc in (ENC_CACHED, ENC_STORE):
+            if cache is not None:
+                cache.apply(framebuffer, x, y, w, h, enc, data, reduce)
+            continue
+        tile = decode_region(data, enc, w, h, flag, reduce)
+        if tile is None:
+            continue
+        x, y = x // reduce, y // reduce
+        h = min(tile.shape[0], fb_h - y)
+        w = min(tile.shape[1], fb_w - x)
+        framebuffer[y:y + h, x:x + w] = tile[:h, :w]
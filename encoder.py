@@ -0,0 +1,173 @@
+# encoder.py
+
+import json
+
+import cv2
+import numpy as np
+
+import metrics
+from content import encode_jpeg
+from protocol import MSG_INFO, MSG_JPEG
+from delta import DeltaEncoder
+
+
+class StreamEncoder:
+    """
+    Transforma frames capturados nas mensagens do canal de vídeo:
+    recorta/reduz para a janela do cliente (set_viewport), aplica a
+    escala/qualidade atuais (fixas ou do AdaptiveController), anuncia
+    mudanças com stream_config e usa o DeltaEncoder se ativo.
+    Com stripes (StripeEncoder), os JPEGs são codificados em paralelo.
+    content=True (só com delta) manda texto/UI sem perda.
+    cache=True (só com delta) reaproveita tiles que o cliente já tem.
+    motion=True (só com delta) manda scroll/arraste como cópia de retângulo.
+    refine=True (só com delta) reenvia em qualidade alta o que parou de mudar.
+    """
+
+    def __init__(self, server_w: int, server_h: int, quality: int = 50,
+                 delta: bool = True, controller=None, stripes=None, content: bool = False,
+                 cache: bool = False, motion: bool = False, refine: bool = False):
+        self.server_w = server_w
+        self.server_h = server_h
+        self.quality = quality
+        self.scale = 1.0
+        self.crop = (0, 0, server_w, server_h)  # região da tela no stream (x, y, w, h)
+        self.size = (server_w, server_h)        # tamanho do stream
+        self._viewport = None                   # (largura, altura, recorte) pedido pelo cliente
+        self._scaled = None                     # destino reaproveitado do resize
+        self._lossy = False                     # transporte pode perder mensagens (UDP)
+        self._drop_cache = False                # desligar o cache de tiles no próximo frame
+        self._announce = False                  # reenviar stream_config no próximo frame
+        self.controller = controller
+        self.stripes = stripes
+        self.delta = (DeltaEncoder(quality=quality, stripes=stripes, content=content,
+                                   cache=cache, motion=motion, refine=refine)
+                      if delta else None)
+
+    def request_keyframe(self):
+        """Pede que o próximo frame seja enviado completo (seguro entre threads)."""
+        if self.delta is not None:
+            self.delta.request_keyframe()
+        if self._lossy:
+            # O pedido pode vir de uma perda, e o stream_config pode ter sido perdido junto
+            self._announce = True
+
+    def disable_cache(self):
+        """
+        Desliga o cache de tiles: todo keyframe passa a ser autocontido.
+        O próximo frame vai completo. Seguro entre threads.
+        """
+        self._drop_cache = True
+        self.request_keyframe()
+
+    def set_lossy(self):
+        """
+        O vídeo passou para um transporte que pode perder mensagens (UDP).
+        O cache de tiles sai (um ENC_STORE perdido dessincronizaria os slots
+        do cliente). Seguro entre threads.
+        """
+        self._lossy = True
+        self.disable_cache()
+
+    def refine_pending(self) -> bool:
+        """True se o delta ainda tem tiles a refinar (chamado da thread de captura)."""
+        return self.delta is not None and self.delta.refine_pending()
+
+    def set_client_reduce(self, reduce: int):
+        """O cliente decodifica em 1/reduce: cópias de scroll saem alinhadas a isso."""
+        if self.delta is not None:
+            self.delta.move_align = reduce
+
+    def set_screen(self, width: int, height: int):
+        """
+        A resolução da tela mudou (chamado na thread de codificação, antes do
+        encode do primeiro frame novo). O cliente recebe um screen_info e volta
+        à tela inteira, então o recorte de zoom, que era da tela antiga, cai.
+        """
+        self.server_w, self.server_h = width, height
+        self.crop = (0, 0, width, height)
+        self.size = (width, height)
+        if self._viewport is not None:
+            self._viewport = self._viewport[:2] + (self.crop,)
+        self.request_keyframe()
+
+    def set_viewport(self, width: int, height: int, zoom=None):
+        """
+        Janela do cliente (largura x altura) e, opcionalmente, o retângulo
+        (x, y, w, h) da tela que ela mostra. O frame é recortado e reduzido
+        para caber nela, mantendo a proporção e sem nunca ampliar: um zoom
+        numa janela pequena da tela chega em resolução nativa.
+        Seguro entre threads: vale a partir do próximo frame.
+        """
+        crop = (0, 0, self.server_w, self.server_h)
+        if zoom:
+            x, y, w, h = (int(v) for v in zoom)
+            x = min(max(0, x), self.server_w - 1)
+            y = min(max(0, y), self.server_h - 1)
+            crop = (x, y, min(max(1, w), self.server_w - x), min(max(1, h), self.server_h - y))
+        self._viewport = (max(1, int(width)), max(1, int(height)), crop)
+
+    def encode(self, frame):
+        """Codifica um frame; devolve a lista de mensagens a enviar (ou None)."""
+        msgs = []
+        if self._drop_cache and self.delta is not None and self.delta.cache is not None:
+            self.delta.cache = None  # aqui, na thread de codificação, entre dois frames
+        quality, scale = self.quality, self.scale
+        if self.controller is not None:
+            quality, scale = self.controller.settings()
+
+        crop, fit = (0, 0, self.server_w, self.server_h), 1.0
+        if self._viewport is not None:
+            view_w, view_h, crop = self._viewport
+            fit = min(1.0, view_w / crop[2], view_h / crop[3])
+        x, y, w, h = crop
+        if (w, h) != (self.server_w, self.server_h):
+            frame = frame[y:y + h, x:x + w]  # só uma view, nada é copiado
+        size = (max(1, int(w * fit * scale)), max(1, int(h * fit * scale)))
+
+        if size != (w, h):
+            # Ninguém guarda o frame reduzido depois do encode (o delta copia
+            # o que precisa), então o mesmo destino serve para todos os frames
+            shape = (size[1], size[0]) + frame.shape[2:]
+            if self._scaled is None or self._scaled.shape != shape:
+                self._scaled = np.empty(shape, dtype=frame.dtype)
+            with metrics.timer("resize_ms"):
+                frame = cv2.resize(frame, size, dst=self._scaled, interpolation=cv2.INTER_AREA)
+
+        if self._announce or (quality, scale, crop, size) != (self.quality, self.scale, self.crop, self.size):
+            self.quality, self.scale, self.crop, self.size = quality, scale, crop, size
+            self._announce = False
+            # Avisa o cliente antes do primeiro frame com a nova configuração
+            msgs.append((MSG_INFO, json.dumps({
+                "type": "stream_config",
+                "quality": quality,
+                "scale": scale,
+                "width": size[0],
+                "height": size[1],
+                "crop": list(crop),
+            }).encode("utf-8")))
+            # Mudança de tamanho: o DeltaEncoder manda um frame completo sozinho
+
+        if self.delta is not None:
+            # Só os tiles alterados (ou o frame inteiro, se mudou demais)
+            self.delta.quality = quality
+            with metrics.timer("encode_ms"):
+                encoded = self.delta.encode(frame)
+            if encoded is not None:
+                msgs.append(encoded)
+            return msgs or None
+
+        if self.stripes is not None:
+            # Faixas codificadas em paralelo, enviadas numa mensagem só
+            with metrics.timer("encode_ms"):
+                encoded = self.stripes.encode_frame(frame, quality)
+            if encoded is not None:
+                msgs.append(encoded)
+            return msgs or None
+
+        # Comprime em JPEG
+        with metrics.timer("encode_ms"):
+            data = encode_jpeg(frame, quality)
+        if data is not None:
+            msgs.append((MSG_JPEG, data))
+        return msgs or None
@@ -0,0 +1,136 @@
+# flow.py
+
+import collections
+import threading
+import time
+
+import metrics
+
+# ==========================
+# Configuração
+# ==========================
+# Os frames de vídeo (tudo menos MSG_INFO) de cada stream são numerados
+# implicitamente a partir de 1, na ordem de envio: o TCP entrega em ordem,
+# então o cliente conta igual. Depois de decodificar um lote, o cliente
+# confirma o último que recebeu: {"type": "ack", "frame": n, "decode_ms": ms}.
+
+MIN_CREDITS = 2      # um frame no fio e um sendo decodificado
+MAX_CREDITS = 8
+RTT_SAMPLES = 64     # a RTT base é a menor das últimas amostras (sem fila)
+QUEUE_TARGET = 0.03  # s de fila aceitos além da RTT base antes de fechar a janela
+EWMA_ALPHA = 0.2
+
+
+class FlowControl:
+    """
+    Janela de crédito do canal de vídeo: no máximo `credits` frames
+    enviados e ainda sem ack. Sem crédito o codificador espera, e a
+    captura continua sobrescrevendo o frame que ainda não foi codificado:
+    o que não cabe na janela é descartado na origem, em vez de esperar
+    segundos nos buffers do socket num link lento.
+
+    A janela se ajusta uma vez por RTT, pela RTT medida do envio ao ack
+    (sem o decode, que o cliente informa): acima da RTT base (a menor
+    recente) mais QUEUE_TARGET, há fila crescendo em algum lugar e a janela
+    diminui; se foi a janela que segurou o codificador e não há fila, ela
+    cresce. Num link lento fica no mínimo; num link longo e largo cresce
+    até caber uma RTT de frames.
+
+    Só vale depois do primeiro ack: um cliente que não confirma frames
+    (versão antiga, player) recebe tudo, como antes.
+    """
+
+    def __init__(self, min_credits: int = MIN_CREDITS, max_credits: int = MAX_CREDITS):
+        self.min_credits = min_credits
+        self.max_credits = max_credits
+        self.credits = min_credits
+        self.active = False
+        self.seq = 0       # último frame enviado
+        self.acked = 0     # último frame confirmado
+        self.decode_ms = None
+        self.rtt = None    # s do envio ao ack, sem o decode (média móvel)
+        self._sent = collections.deque()  # (número, instante do envio, bytes)
+        self._rtts = collections.deque(maxlen=RTT_SAMPLES)
+        self._last_ack = 0.0
+        self._next_adjust = 0.0
+        self._stalled = False  # a janela segurou o codificador desde o último ajuste
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def inflight(self) -> int:
+        return self.seq - self.acked
+
+    def _open(self) -> bool:
+        return not self.active or self._closed or self.inflight < self.credits
+
+    def wait(self, timeout: float = None) -> bool:
+        """Espera crédito para mais um frame; False se não veio em timeout."""
+        with self._cond:
+            if self._open():
+                return True
+            if not self._stalled:
+                self._stalled = True
+                metrics.count("credit_stalls")
+            return self._cond.wait_for(self._open, timeout)
+
+    def sent(self, nbytes: int) -> None:
+        """Um frame de vídeo saiu (chamado na ordem de envio)."""
+        with self._cond:
+            self.seq += 1
+            self._sent.append((self.seq, time.monotonic(), nbytes))
+
+    def ack(self, frame: int, decode_ms: float = None):
+        """
+        O cliente decodificou até o frame `frame`. Devolve (bytes, segundos)
+        da entrega dos frames confirmados agora, a vazão de fato que chegou
+        ao cliente, ou None se o ack não confirmou nada novo.
+        """
+        now = time.monotonic()
+        with self._cond:
+            frame = min(int(frame), self.seq)
+            if frame <= self.acked:
+                return None
+            nbytes, first_sent, last_sent = 0, None, None
+            while self._sent and self._sent[0][0] <= frame:
+                _, sent_at, size = self._sent.popleft()
+                nbytes += size
+                first_sent = sent_at if first_sent is None else first_sent
+                last_sent = sent_at
+            self.acked = frame
+            self.active = True
+            if last_sent is None:
+                self._cond.notify_all()
+                return None
+
+            if decode_ms is not None:
+                decode_ms = float(decode_ms)
+                self.decode_ms = decode_ms if self.decode_ms is None else \
+                    self.decode_ms + EWMA_ALPHA * (decode_ms - self.decode_ms)
+            decode = (self.decode_ms or 0.0) / 1000
+            rtt = now - last_sent
+            sample = max(0.0, rtt - decode)
+            self._rtts.append(sample)
+            self.rtt = sample if self.rtt is None else self.rtt + EWMA_ALPHA * (sample - self.rtt)
+            # Entrega: desde o envio, ou desde o ack anterior se o frame esperou na fila
+            elapsed = max(1e-6, now - max(first_sent, self._last_ack))
+            self._last_ack = now
+
+            if now >= self._next_adjust:
+                queue = self.rtt - min(self._rtts)
+                if queue > QUEUE_TARGET:
+                    self.credits = max(self.min_credits, self.credits - 1)
+                elif self._stalled:
+                    self.credits = min(self.max_credits, self.credits + 1)
+                self._stalled = False
+                self._next_adjust = now + self.rtt + decode
+            self._cond.notify_all()
+
+        metrics.observe("ack_rtt_ms", rtt * 1000)
+        metrics.set_gauge("credits", self.credits)
+        return nbytes, elapsed
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
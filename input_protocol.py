@@ -0,0 +1,107 @@
+# input_protocol.py
+
+import struct
+import threading
+import time
+
+# ==========================
+# Formato binário dos eventos
+# ==========================
+# Cada evento tem tamanho fixo (14 bytes, big-endian):
+#   [tipo: 1][arg: 1][x: 4][y: 4][código: 4]
+# Um frame do canal de input carrega um ou mais eventos concatenados.
+
+EVENT_STRUCT = struct.Struct(">BBiiI")
+EVENT_SIZE = EVENT_STRUCT.size
+
+EV_MOVE = 1     # x, y = posição na área de trabalho do servidor (todos os monitores)
+EV_BUTTON = 2   # arg = botão | BUTTON_PRESS se pressionado; x, y = posição
+EV_SCROLL = 3   # x, y = dx, dy
+EV_KEY = 4      # arg = 1 (press) ou 0 (release); código = codepoint da tecla
+
+BTN_LEFT = 1
+BTN_RIGHT = 2
+BTN_MIDDLE = 3
+BUTTON_PRESS = 0x80
+
+FLUSH_INTERVAL = 0.005  # intervalo mínimo entre lotes enviados pelo cliente
+
+
+def pack_events(events) -> bytes:
+    """events: lista de (tipo, arg, x, y, código)."""
+    return b"".join(EVENT_STRUCT.pack(*ev) for ev in events)
+
+
+def unpack_events(data) -> list:
+    """Desmonta um frame de input em lista de (tipo, arg, x, y, código)."""
+    usable = len(data) - len(data) % EVENT_SIZE
+    return list(EVENT_STRUCT.iter_unpack(memoryview(data)[:usable]))
+
+
+def coalesce_moves(events) -> list:
+    """
+    Mantém só o último movimento de cada sequência de movimentos seguidos.
+    Cliques, scroll e teclas continuam na ordem original, e a posição vista
+    por eles é a mesma (o último movimento antes de cada um é preservado).
+    """
+    result = []
+    for ev in events:
+        if ev[0] == EV_MOVE and result and result[-1][0] == EV_MOVE:
+            result[-1] = ev
+        else:
+            result.append(ev)
+    return result
+
+
+# ==========================
+# Envio em lotes (cliente)
+# ==========================
+
+class InputBatcher:
+    """
+    Junta eventos de input e os envia em lotes por uma thread própria.
+
+    O primeiro evento sai imediatamente; enquanto o lote anterior está
+    sendo enviado (ou dentro de FLUSH_INTERVAL) os próximos acumulam e
+    movimentos seguidos são fundidos num só. Assim o mouse rápido gera
+    poucas chamadas de send e cliques não esperam atrás de movimentos velhos.
+    """
+
+    def __init__(self, send, interval: float = FLUSH_INTERVAL):
+        self.send = send  # função que envia um frame (socket ou canal multiplexado)
+        self.interval = interval
+        self._events = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="input-batcher", daemon=True)
+        self._thread.start()
+
+    def push(self, kind: int, arg: int = 0, x: int = 0, y: int = 0, code: int = 0) -> None:
+        with self._cond:
+            ev = (kind, arg, x, y, code)
+            if kind == EV_MOVE and self._events and self._events[-1][0] == EV_MOVE:
+                self._events[-1] = ev
+            else:
+                self._events.append(ev)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._events or self._closed)
+                if self._closed and not self._events:
+                    return
+                batch, self._events = self._events, []
+            try:
+                self.send(pack_events(batch))
+            except Exception as e:
+                print(f"[INPUT] Erro ao enviar: {e}")
+                return
+            time.sleep(self.interval)
+
+    def close(self):
+        """Envia o que estiver pendente e encerra a thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=1.0)
@@ -0,0 +1,227 @@
+# metrics.py
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# ==========================
+# Configuração
+# ==========================
+
+HISTORY = 256     # amostras guardadas por histograma (janela deslizante)
+RATE_WINDOW = 5   # segundos usados no cálculo das taxas dos contadores
+PERCENTILES = (50, 90, 99)
+
+
+# ==========================
+# Histogramas e contadores
+# ==========================
+
+class Histogram:
+    """
+    Últimas HISTORY amostras num ring buffer de tamanho fixo.
+    record() só escreve uma posição do array (sem alocação no caminho quente);
+    as estatísticas são calculadas quando alguém pede o snapshot, sobre uma
+    cópia da janela tirada sob o lock.
+    """
+
+    def __init__(self, size: int = HISTORY):
+        self._values = np.zeros(size, dtype=np.float64)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, value: float) -> None:
+        with self._lock:
+            self._values[self._count % len(self._values)] = value
+            self._count += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            count = self._count
+            window = self._values[:min(count, len(self._values))].copy()
+        if count == 0:
+            return {"count": 0}
+        stats = {"count": count, "mean": float(window.mean()), "max": float(window.max())}
+        for p, value in zip(PERCENTILES, np.percentile(window, PERCENTILES)):
+            stats[f"p{p}"] = float(value)
+        return stats
+
+
+class Counter:
+    """Total acumulado + taxa por segundo nos últimos RATE_WINDOW segundos."""
+
+    def __init__(self, window: int = RATE_WINDOW):
+        self.total = 0
+        self._buckets = [0] * (window + 1)  # um balde por segundo (+ o atual)
+        self._second = int(time.monotonic())
+        self._lock = threading.Lock()
+
+    def _advance(self, now: int) -> None:
+        # Chamado com o lock. Zera os baldes dos segundos que passaram sem nenhum add()
+        for sec in range(self._second + 1, min(now, self._second + len(self._buckets)) + 1):
+            self._buckets[sec % len(self._buckets)] = 0
+        self._second = max(self._second, now)
+
+    def add(self, n: int = 1) -> None:
+        now = int(time.monotonic())
+        with self._lock:
+            if now != self._second:
+                self._advance(now)
+            self._buckets[now % len(self._buckets)] += n
+            self.total += n
+
+    def snapshot(self) -> dict:
+        now = int(time.monotonic())
+        with self._lock:
+            self._advance(now)
+            # Só segundos completos entram na taxa
+            done = sum(self._buckets) - self._buckets[now % len(self._buckets)]
+            total = self.total
+        return {"total": total, "rate": done / (len(self._buckets) - 1)}
+
+
+class Gauge:
+    """Último valor informado (ex.: memória em uso)."""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def snapshot(self) -> dict:
+        return {"value": self.value}
+
+
+class _Timer:
+    """Context manager que registra a duração do bloco em ms."""
+
+    __slots__ = ("hist", "started")
+
+    def __init__(self, hist: Histogram):
+        self.hist = hist
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.record((time.perf_counter() - self.started) * 1000)
+        return False
+
+
+class Metrics:
+    """
+    Conjunto de histogramas, contadores e gauges por nome, criados no primeiro uso.
+
+    Vários streams, o UDP e o endpoint HTTP usam as mesmas métricas ao mesmo
+    tempo: cada histograma e contador tem o seu lock (curto, sem disputa na
+    prática), e o snapshot lê cada um de uma vez, sob o lock dele.
+    """
+
+    def __init__(self):
+        self._hists = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()  # só para criar métricas novas
+
+    def histogram(self, name: str) -> Histogram:
+        hist = self._hists.get(name)
+        if hist is None:
+            with self._lock:
+                hist = self._hists.setdefault(name, Histogram())
+        return hist
+
+    def counter(self, name: str) -> Counter:
+        counter = self._counters.get(name)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(name, Counter())
+        return counter
+
+    def gauge(self, name: str) -> Gauge:
+        gauge = self._gauges.get(name)
+        if gauge is None:
+            with self._lock:
+                gauge = self._gauges.setdefault(name, Gauge())
+        return gauge
+
+    def timer(self, name: str) -> _Timer:
+        return _Timer(self.histogram(name))
+
+    def observe(self, name: str, value: float) -> None:
+        self.histogram(name).record(value)
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counter(name).add(n)
+
+    def set_gauge(self, name: str, value: float) -> None:
+        self.gauge(name).set(value)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._hists = {}
+            self._counters = {}
+            self._gauges = {}
+
+    def snapshot(self) -> dict:
+        snap = {name: hist.snapshot() for name, hist in list(self._hists.items())}
+        snap.update({name: c.snapshot() for name, c in list(self._counters.items())})
+        snap.update({name: g.snapshot() for name, g in list(self._gauges.items())})
+        return snap
+
+
+def format_text(snapshot: dict) -> str:
+    """Uma linha "nome_estatística valor" por número (fácil de raspar)."""
+    lines = []
+    for name in sorted(snapshot):
+        for stat, value in snapshot[name].items():
+            lines.append(f"{name}_{stat} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+# Registro padrão do processo (como o logger raiz do logging)
+default = Metrics()
+timer = default.timer
+observe = default.observe
+count = default.count
+set_gauge = default.set_gauge
+snapshot = default.snapshot
+
+
+# ==========================
+# Endpoint local
+# ==========================
+
+def serve_metrics(host: str, port: int, registry: Metrics = default) -> ThreadingHTTPServer:
+    """
+    Sobe um endpoint HTTP numa thread:
+    GET /metrics (texto) e GET /metrics.json (JSON).
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = format_text(registry.snapshot()).encode("utf-8")
+                content_type = "text/plain; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(registry.snapshot()).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # sem log por requisição
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    return httpd
@@ -0,0 +1,170 @@
+# motion.py
+
+import struct
+
+import cv2
+import numpy as np
+
+# ==========================
+# Configuração
+# ==========================
+
+SIGNATURE_BAND = 0.5  # fração central da largura usada nas assinaturas de linha
+SIGNATURE_STEP = 4    # dentro da faixa, 1 pixel a cada 4
+MIN_VOTES = 24        # linhas únicas casadas para aceitar um deslocamento
+MATCH_RATIO = 0.5     # fração das linhas que precisa casar numa coluna de tiles
+MIN_MOVE_TILES = 8    # área mínima (em tiles) de uma região movida
+
+COPY_SOURCE = struct.Struct(">HH")  # dados do ENC_COPY: x, y de origem
+
+_rng = np.random.default_rng(0x5C0)
+_weights = {}
+
+
+def _signature_weights(n: int) -> np.ndarray:
+    weights = _weights.get(n)
+    if weights is None:
+        weights = _rng.integers(0, 1 << 63, size=n, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        _weights[n] = weights
+    return weights
+
+
+def line_signatures(frame: np.ndarray, band: float = SIGNATURE_BAND,
+                    step: int = SIGNATURE_STEP) -> np.ndarray:
+    """
+    Uma assinatura de 64 bits por linha, calculada sobre pixels amostrados
+    na faixa central de colunas: os bytes vistos como uint64 e somados com
+    pesos ímpares aleatórios (aritmética módulo 2^64, tudo vetorizado).
+    Colisões não quebram nada: todo deslocamento é conferido pixel a pixel.
+    Aceita views transpostas (assinatura por coluna): só a amostra é copiada.
+    """
+    h, w = frame.shape[:2]
+    n = int(w * band) // step // 8 * 8  # múltiplo de 8 pixels = bytes múltiplos de 8
+    if n == 0:
+        return np.arange(h, dtype=np.uint64)  # frame estreito demais: nada casa
+    x0 = (w - n * step) // 2
+    sample = np.ascontiguousarray(frame[:, x0:x0 + n * step:step]).reshape(h, -1)
+    words = sample.view(np.uint64)
+    return (words * _signature_weights(words.shape[1])).sum(axis=1, dtype=np.uint64)
+
+
+def dominant_shift(prev_sig: np.ndarray, cur_sig: np.ndarray, min_votes: int = MIN_VOTES) -> int:
+    """
+    Deslocamento (em linhas, cur - prev) mais votado entre as linhas que
+    aparecem uma única vez no frame anterior; 0 se nenhum tem votos suficientes.
+    Linhas repetidas (em branco, bordas) não votam.
+    """
+    values, first, counts = np.unique(prev_sig, return_index=True, return_counts=True)
+    pos = np.minimum(np.searchsorted(values, cur_sig), len(values) - 1)
+    ok = (values[pos] == cur_sig) & (counts[pos] == 1)
+    shifts = np.flatnonzero(ok) - first[pos[ok]]
+    shifts = shifts[shifts != 0]
+    if len(shifts) < min_votes:
+        return 0
+    candidates, votes = np.unique(shifts, return_counts=True)
+    best = votes.argmax()
+    return int(candidates[best]) if votes[best] >= min_votes else 0
+
+
+def _longest_run(flags: np.ndarray):
+    """(início, fim) da maior sequência de True; (0, 0) se não houver."""
+    line = np.concatenate(([False], flags, [False]))
+    edges = np.flatnonzero(line[1:] != line[:-1])
+    if not len(edges):
+        return 0, 0
+    starts, ends = edges[::2], edges[1::2]
+    i = (ends - starts).argmax()
+    return int(starts[i]), int(ends[i])
+
+
+def moved_region(prev: np.ndarray, cur: np.ndarray, shift: int, tile: int, axis: int = 0):
+    """
+    Maior bloco (x, y, w, h) de cur que é igual a prev deslocado de shift
+    pixels ao longo de axis (0 = vertical, 1 = horizontal), alinhado aos
+    tiles no outro eixo. None se for pequeno demais.
+    """
+    size = cur.shape[axis]
+    a0, a1 = max(0, shift), min(size, size + shift)
+    if a1 <= a0:
+        return None
+
+    # bad[i, j]: a linha (ou coluna) a0 + i difere no j-ésimo bloco de tile.
+    # O OR por bloco é um reduceat sobre os bytes, sem reduzir o eixo das cores.
+    if axis == 0:
+        diff = (cur[a0:a1] != prev[a0 - shift:a1 - shift]).reshape(a1 - a0, -1)
+        bad = np.logical_or.reduceat(diff, np.arange(0, diff.shape[1], tile * cur.shape[2]), axis=1)
+    else:
+        diff = cur[:, a0:a1] != prev[:, a0 - shift:a1 - shift]
+        bad = np.logical_or.reduceat(diff, np.arange(0, cur.shape[0], tile), axis=0).any(axis=2).T
+    blocks = cur.shape[1 - axis] // tile  # só blocos inteiros
+    ok = ~bad[:, :blocks]
+
+    b0, b1 = _longest_run(ok.mean(axis=0) >= MATCH_RATIO)
+    l0, l1 = _longest_run(ok[:, b0:b1].all(axis=1)) if b1 > b0 else (0, 0)
+    if (b1 - b0) * tile * (l1 - l0) < MIN_MOVE_TILES * tile * tile:
+        return None
+    if axis == 0:
+        return b0 * tile, a0 + l0, (b1 - b0) * tile, l1 - l0
+    return a0 + l0, b0 * tile, l1 - l0, (b1 - b0) * tile
+
+
+def detect_move(prev: np.ndarray, cur: np.ndarray, tile: int):
+    """
+    Procura um scroll/arraste entre dois frames: primeiro vertical, depois
+    horizontal (assinaturas por coluna, sobre views transpostas).
+    Retorna (x, y, w, h, x_origem, y_origem) da cópia, ou None.
+    """
+    shift = dominant_shift(line_signatures(prev), line_signatures(cur))
+    if shift:
+        region = moved_region(prev, cur, shift, tile, axis=0)
+        if region is not None:
+            x, y, w, h = region
+            return x, y, w, h, x, y - shift
+
+    shift = dominant_shift(line_signatures(prev.transpose(1, 0, 2)),
+                           line_signatures(cur.transpose(1, 0, 2)))
+    if shift:
+        region = moved_region(prev, cur, shift, tile, axis=1)
+        if region is not None:
+            x, y, w, h = region
+            return x, y, w, h, x - shift, y
+    return None
+
+
+def align_move(move, align: int):
+    """
+    Encolhe a cópia para coordenadas múltiplas de align (a redução com que
+    o cliente decodifica), para ela ser exata no framebuffer reduzido.
+    None se o deslocamento não é múltiplo de align.
+    """
+    x, y, w, h, src_x, src_y = move
+    if (x - src_x) % align or (y - src_y) % align:
+        return None
+    x0, y0 = -(-x // align) * align, -(-y // align) * align
+    x1, y1 = (x + w) // align * align, (y + h) // align * align
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0, src_x + x0 - x, src_y + y0 - y
+
+
+def copy_rect(framebuffer: np.ndarray, x: int, y: int, w: int, h: int,
+              src_x: int, src_y: int, reduce: int = 1) -> None:
+    """
+    Copia o retângulo de origem para (x, y) dentro do próprio framebuffer.
+    Com reduce > 1 e uma cópia desalinhada (só enquanto o servidor ainda não
+    soube da redução nova), desloca com interpolação bilinear: aproxima o
+    que o frame reduzido teria até o próximo frame completo.
+    """
+    if all(v % reduce == 0 for v in (x, y, w, h, src_x, src_y)):
+        x, y, w, h = x // reduce, y // reduce, w // reduce, h // reduce
+        src_x, src_y = src_x // reduce, src_y // reduce
+        framebuffer[y:y + h, x:x + w] = framebuffer[src_y:src_y + h, src_x:src_x + w].copy()
+        return
+
+    fb_h, fb_w = framebuffer.shape[:2]
+    x0, y0 = round(x / reduce), round(y / reduce)
+    x1, y1 = min(fb_w, round((x + w) / reduce)), min(fb_h, round((y + h) / reduce))
+    shift = np.float32([[1, 0, (x - src_x) / reduce], [0, 1, (y - src_y) / reduce]])
+    moved = cv2.warpAffine(framebuffer, shift, (fb_w, fb_h), flags=cv2.INTER_LINEAR,
+                           borderMode=cv2.BORDER_REPLICATE)
+    framebuffer[y0:y1, x0:x1] = moved[y0:y1, x0:x1]
@@ -0,0 +1,229 @@
+# mux.py
+
+import queue
+import socket
+import struct
+import threading
+from collections import deque
+
+from protocol import recv_all, send_buffers
+
+# ==========================
+# Formato
+# ==========================
+# Uma única conexão TCP carrega vários canais. Cada pedaço enviado é:
+#   [canal: 1][flags: 1][tamanho: 4] + dados
+# Mensagens grandes (frames de vídeo) são quebradas em pedaços de até
+# CHUNK_SIZE; FLAG_END marca o último pedaço de cada mensagem. Mensagem vazia
+# não existe: b"" no recv() é o fim da conexão.
+
+MUX_HEADER = struct.Struct(">BBI")
+FLAG_END = 0x01
+
+CH_VIDEO = 0
+CH_INPUT = 1
+CH_CONTROL = 2
+CH_CURSOR = 3  # servidor -> cliente: posição e forma do cursor (cursor.py)
+
+# Menor número = sai primeiro. Input, cursor e controle nunca esperam um JPEG
+# inteiro, no máximo um pedaço de vídeo que já estava sendo escrito.
+PRIORITY = {
+    CH_INPUT: 0,
+    CH_CURSOR: 0,
+    CH_CONTROL: 1,
+    CH_VIDEO: 2,
+}
+
+CHUNK_SIZE = 16 * 1024
+
+
+class _Outgoing:
+    """Mensagem na fila de envio: pedaços restantes + aviso de conclusão."""
+
+    __slots__ = ("channel", "chunks", "done")
+
+    def __init__(self, channel, chunks):
+        self.channel = channel
+        self.chunks = chunks
+        self.done = threading.Event()
+
+
+class MuxConnection:
+    """
+    Multiplexa canais sobre um socket com um escalonador de prioridade.
+
+    send() quebra a mensagem em pedaços e bloqueia até o último ser escrito
+    (mesma semântica do sendall, então o backpressure continua valendo).
+    A thread de envio sempre escolhe o próximo pedaço do canal de maior
+    prioridade que tiver algo pendente. A thread de recepção remonta as
+    mensagens de cada canal e as entrega em filas separadas, sem limite:
+    ela nunca espera um leitor, senão um canal lento (input sendo aplicado)
+    pararia todos os outros, inclusive os acks do controle. Input, controle
+    e cursor são mensagens pequenas que não podem se perder (tecla solta,
+    ack, forma do cursor); o vídeo em trânsito já é limitado pela janela do
+    controle de fluxo (flow.py), que só anda com os acks do cliente.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.error = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._pending = {prio: deque() for prio in sorted(set(PRIORITY.values()))}
+        self._inbox = {ch: queue.Queue() for ch in PRIORITY}
+        self._partial = {ch: [] for ch in PRIORITY}
+
+        for target, name in ((self._send_loop, "mux-envio"), (self._recv_loop, "mux-recepção")):
+            threading.Thread(target=target, name=name, daemon=True).start()
+
+    def channel(self, channel: int) -> "MuxChannel":
+        return MuxChannel(self, channel)
+
+    # ---------- envio ----------
+
+    def send(self, channel: int, buffers) -> None:
+        """Envia uma mensagem (não vazia) formada pela sequência de buffers."""
+        chunks = deque()
+        for buf in buffers:
+            view = memoryview(buf).cast("B")
+            for i in range(0, len(view), CHUNK_SIZE):
+                chunks.append(view[i:i + CHUNK_SIZE])
+        if not chunks:
+            raise ValueError("Mensagem vazia: do outro lado ela seria lida como fim da conexão")
+
+        item = _Outgoing(channel, chunks)
+        with self._cond:
+            if self._closed:
+                raise ConnectionError("Conexão multiplexada encerrada")
+            self._pending[PRIORITY[channel]].append(item)
+            self._cond.notify()
+
+        item.done.wait()
+        if self.error is not None or item.chunks:
+            raise ConnectionError(f"Conexão multiplexada encerrada: {self.error}")
+
+    def _next_chunk(self):
+        for fifo in self._pending.values():
+            if fifo:
+                item = fifo[0]
+                chunk = item.chunks.popleft()
+                if not item.chunks:
+                    fifo.popleft()
+                return item, chunk
+        return None, None
+
+    def _send_loop(self):
+        item = None
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or any(self._pending.values()))
+                    if self._closed:
+                        return
+                    item, chunk = self._next_chunk()
+
+                last = not item.chunks
+                header = MUX_HEADER.pack(item.channel, FLAG_END if last else 0, len(chunk))
+                send_buffers(self.sock, (header, chunk))
+                if last:
+                    item.done.set()
+        except Exception as e:
+            self._fail(e)
+        finally:
+            # Libera quem estiver esperando a mensagem que ficou no meio
+            if item is not None:
+                item.done.set()
+
+    # ---------- recepção ----------
+
+    def _recv_loop(self):
+        try:
+            while True:
+                channel, flags, size = MUX_HEADER.unpack(recv_all(self.sock, MUX_HEADER.size))
+                chunk = recv_all(self.sock, size) if size else b""
+                parts = self._partial.get(channel)
+                if parts is None:
+                    continue  # canal desconhecido: ignora
+                parts.append(chunk)
+                if flags & FLAG_END:
+                    msg = parts[0] if len(parts) == 1 else b"".join(parts)
+                    self._partial[channel] = []
+                    if msg:  # vazia só viria de um par quebrado, e pareceria o fim
+                        self._inbox[channel].put_nowait(msg)
+        except Exception as e:
+            self._fail(e)
+
+    def recv(self, channel: int, timeout=None) -> bytes:
+        """
+        Próxima mensagem do canal. Retorna b"" se a conexão terminou
+        e None se deu timeout.
+        """
+        try:
+            msg = self._inbox[channel].get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if msg is None:
+            self._inbox[channel].put(None)  # mantém o aviso para outras leituras
+            return b""
+        return msg
+
+    def pending(self, channel: int) -> bool:
+        return not self._inbox[channel].empty()
+
+    # ---------- encerramento ----------
+
+    def _fail(self, e):
+        if self.error is None and not self._closed:
+            self.error = e
+        self.close()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            waiting = [item for fifo in self._pending.values() for item in fifo]
+            for fifo in self._pending.values():
+                fifo.clear()
+            self._cond.notify_all()
+        for item in waiting:
+            item.done.set()
+        for inbox in self._inbox.values():
+            inbox.put_nowait(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class MuxChannel:
+    """Um canal da MuxConnection com a mesma cara das funções de protocol.py."""
+
+    def __init__(self, mux: MuxConnection, channel: int):
+        self.mux = mux
+        self.channel = channel
+
+    def send_frame(self, payload) -> None:
+        self.mux.send(self.channel, (payload,))
+
+    def send_message(self, msg_type: int, body) -> None:
+        self.mux.send(self.channel, (bytes([msg_type]), body))
+
+    def recv_frame(self, timeout=None) -> bytes:
+        return self.mux.recv(self.channel, timeout)
+
+    def pending(self) -> bool:
+        return self.mux.pending(self.channel)
+
+    def poll_message(self):
+        """
+        Mensagem tipada já recebida, sem bloquear.
+        None se não há nada; (None, b"") se a conexão terminou.
+        """
+        data = self.mux.recv(self.channel, timeout=0)
+        if data is None:
+            return None
+        if not data:
+            return None, b""
+        return data[0], memoryview(data)[1:]
@@ -0,0 +1,84 @@
+# pacing.py
+
+import threading
+import time
+
+import numpy as np
+
+from capture import retain_frame, release_frame
+
+# ==========================
+# Configuração
+# ==========================
+
+TARGET_FPS = 30   # ritmo enquanto a tela está mudando
+MAX_FPS = 60      # teto para qualquer ajuste de TARGET_FPS
+IDLE_FPS = 2      # ritmo mínimo de "keepalive" com a tela parada
+BACKOFF = 1.5     # a cada frame igual, o intervalo cresce por esse fator
+
+
+class FrameScheduler:
+    """
+    Decide quando capturar o próximo frame.
+
+    - Tela mudando: captura no ritmo alvo (TARGET_FPS).
+    - Tela parada: o intervalo cresce a cada frame igual até IDLE_FPS, e o
+      frame repetido nem chega ao codificador.
+    - Qualquer mudança (ou wake(), chamado quando chega input) volta na hora
+      para o ritmo alvo.
+
+    A comparação é exata (np.array_equal sobre o frame cru): amostrar pixels
+    perderia mudanças finas como o cursor de texto piscando. O frame anterior
+    fica com o scheduler (retain_frame) até o próximo observe() ou forget().
+    """
+
+    def __init__(self, target_fps: float = TARGET_FPS, max_fps: float = MAX_FPS,
+                 idle_fps: float = IDLE_FPS):
+        self.max_fps = max_fps
+        self.idle_interval = 1.0 / idle_fps
+        self.set_target(target_fps)
+        self.interval = self.active_interval
+        self.skipped = 0  # frames iguais descartados antes do encode
+
+        self._wake = threading.Event()
+        self._last = time.monotonic()
+        self._next = self._last
+        self._prev = None
+
+    def set_target(self, fps: float) -> None:
+        self.target_fps = min(fps, self.max_fps)
+        self.active_interval = 1.0 / self.target_fps
+
+    def wait(self) -> None:
+        """Dorme até o instante da próxima captura (ou até wake())."""
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            self._wake.wait(delay)
+        self._wake.clear()
+        self._last = time.monotonic()
+
+    def wake(self) -> None:
+        """Volta ao ritmo alvo e libera a próxima captura imediatamente."""
+        self.interval = self.active_interval
+        self._next = time.monotonic()
+        self._wake.set()
+
+    def observe(self, frame: np.ndarray) -> bool:
+        """Registra o frame capturado. Retorna True se ele mudou."""
+        retain_frame(frame)
+        prev, self._prev = self._prev, frame
+        changed = prev is None or prev.shape != frame.shape or not np.array_equal(prev, frame)
+        release_frame(prev)
+
+        if changed:
+            self.interval = self.active_interval
+        else:
+            self.interval = min(self.interval * BACKOFF, self.idle_interval)
+            self.skipped += 1
+        self._next = self._last + self.interval
+        return changed
+
+    def forget(self) -> None:
+        """Solta o frame anterior (a captura terminou)."""
+        prev, self._prev = self._prev, None
+        release_frame(prev)
@@ -0,0 +1,200 @@
+# pipeline.py
+
+import threading
+
+import metrics
+from capture import release_frame
+
+
+# ==========================
+# Fila de uma posição
+# ==========================
+
+class LatestSlot:
+    """
+    Fila de uma posição só: put() sobrescreve o item que ainda não foi
+    consumido (o frame mais novo vence). Itens não podem ser None.
+    discard(item) é chamado com cada item que sai sem ser consumido
+    (sobrescrito, ou ainda na fila quando ela fecha).
+    """
+
+    def __init__(self, discard=None):
+        self._cond = threading.Condition()
+        self._item = None
+        self._closed = False
+        self._discard = discard
+        self.dropped = 0  # quantos itens foram descartados sem consumo
+
+    def put(self, item) -> bool:
+        """Guarda o item. Retorna True se um item antigo foi descartado."""
+        with self._cond:
+            if self._closed:
+                old, item = item, None  # ninguém mais vai consumir
+            else:
+                old, self._item = self._item, item
+            dropped = old is not None and item is not None
+            if dropped:
+                self.dropped += 1
+            self._cond.notify_all()
+        if old is not None and self._discard is not None:
+            self._discard(old)
+        return dropped
+
+    def get(self, timeout=None):
+        """Espera e retira o item. Retorna None se fechada ou no timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._item is not None or self._closed, timeout)
+            item, self._item = self._item, None
+            self._cond.notify_all()
+            return item
+
+    def wait_empty(self, timeout=None) -> bool:
+        """Espera até o item atual ser consumido (ou a fila ser fechada)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._item is None or self._closed, timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            item, self._item = self._item, None
+            self._cond.notify_all()
+        if item is not None and self._discard is not None:
+            self._discard(item)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+
+# ==========================
+# Pipeline captura -> codificação -> envio
+# ==========================
+
+class FramePipeline:
+    """
+    Roda captura e codificação em threads separadas, ligadas por LatestSlot.
+    O envio fica com quem chama get() (normalmente a thread da conexão).
+
+    - A captura roda livre e sobrescreve frames ainda não codificados.
+    - O codificador só pega um frame novo quando o envio já retirou a
+      mensagem anterior, então ele sempre codifica o frame mais recente e
+      nenhuma mensagem codificada é descartada (o delta continua válido).
+    - Com ready (controle de fluxo), o codificador também espera o envio ter
+      crédito: enquanto isso a captura segue sobrescrevendo, e o frame que
+      sai é o mais novo no momento em que ele pode ser enviado.
+    - Com pending (refinamento), frames repetidos continuam chegando ao
+      codificador enquanto ele tiver o que refinar: são as vagas ociosas.
+
+    cv2 e sockets liberam o GIL, então os três estágios se sobrepõem e o
+    fps passa a ser limitado pelo estágio mais lento, não pela soma deles.
+
+    O frame de grab() é da captura, que passa a posse para o LatestSlot e
+    dele para o codificador; encode() só pode guardar o frame (ou views
+    dele) depois de retornar com retain_frame() ou copiando.
+    """
+
+    def __init__(self, grab, encode, release=None, scheduler=None, ready=None, pending=None):
+        self.grab = grab          # () -> frame
+        self.encode = encode      # frame -> mensagem ou None (nada a enviar)
+        self.release = release    # chamado na thread de captura ao terminar
+        self.scheduler = scheduler  # FrameScheduler opcional (ritmo + tela parada)
+        self.ready = ready        # (timeout) -> True se o envio tem crédito (opcional)
+        self.pending = pending    # () -> True se o codificador ainda usa frames repetidos (opcional)
+        self._frame_requested = False
+        self.raw = LatestSlot(discard=release_frame)
+        self.encoded = LatestSlot()
+        self.stop_event = threading.Event()
+        self.error = None
+        self._threads = []
+
+    def start(self):
+        for target, name in ((self._capture_loop, "captura"), (self._encode_loop, "codificação")):
+            t = threading.Thread(target=target, name=f"pipeline-{name}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _fail(self, e):
+        if self.error is None:
+            self.error = e
+        self.close()
+
+    def _capture_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                if self.scheduler is not None:
+                    self.scheduler.wait()
+                with metrics.timer("capture_ms"):
+                    frame = self.grab()
+                if frame is None:
+                    continue
+                if self.scheduler is not None and not self.scheduler.observe(frame) \
+                        and not self._frame_requested \
+                        and not (self.pending is not None and self.pending()):
+                    # Tela parada: o frame repetido nem chega ao codificador
+                    metrics.count("frames_skipped")
+                    release_frame(frame)
+                    continue
+                self._frame_requested = False
+                if self.raw.put(frame):
+                    metrics.count("frames_dropped")
+        except Exception as e:
+            self._fail(e)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.forget()
+            if self.release is not None:
+                try:
+                    self.release()
+                except Exception:
+                    pass
+
+    def _encode_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                self.encoded.wait_empty()
+                if self.ready is not None and not self.ready(0.1):
+                    continue  # sem crédito: a captura continua sobrescrevendo
+                frame = self.raw.get()
+                if frame is None:
+                    break
+                try:
+                    msg = self.encode(frame)
+                finally:
+                    release_frame(frame)
+                if msg is not None:
+                    self.encoded.put(msg)
+        except Exception as e:
+            self._fail(e)
+
+    def wake(self):
+        """Acorda a captura (ex.: chegou input, a tela deve mudar logo)."""
+        if self.scheduler is not None:
+            self.scheduler.wake()
+
+    def request_frame(self):
+        """
+        Garante que o próximo frame capturado chegue ao codificador mesmo com
+        a tela parada (ex.: o cliente pediu um frame completo).
+        """
+        self._frame_requested = True
+        self.wake()
+
+    def get(self, timeout=None):
+        """
+        Retorna a próxima mensagem codificada.
+        Se algum estágio falhou, relança o erro dele.
+        """
+        msg = self.encoded.get(timeout)
+        if msg is None and self.error is not None:
+            raise self.error
+        return msg
+
+    def close(self):
+        self.stop_event.set()
+        self.raw.close()
+        self.encoded.close()
+
+    def join(self, timeout=None):
+        """Espera os estágios terminarem o frame em andamento (depois de close())."""
+        for t in self._threads:
+            t.join(timeout)
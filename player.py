@@ -0,0 +1,167 @@
+# player.py
+#
+# Toca uma gravação de sessão (pasta criada com RECORD_DIR no server.py) pelo
+# mesmo caminho de decodificação do cliente (client.FrameDecoder). Os
+# segmentos são lidos com mmap: nada é carregado inteiro, e uma busca vai
+# direto ao keyframe anterior pelo índice (busca binária) e refaz só os
+# deltas dali até o ponto pedido.
+#
+# Com --headless não abre janela: decodifica tudo o mais rápido possível
+# (a gravação vira carga realista para o decoder) e mede buscas aleatórias.
+#
+# Uso: python player.py pasta [--start 30] [--speed 2]
+#      python player.py pasta --headless [--seeks 20]
+# Teclas: espaço pausa, j/l voltam/avançam 10 s, q ou ESC sai
+
+import argparse
+import itertools
+import json
+import random
+import time
+
+import cv2
+
+import client
+from client import FrameDecoder
+from protocol import MSG_INFO
+from recording import Recording
+
+SEEK_STEP = 10.0  # s por j/l
+
+
+def new_decoder(msg_type, body):
+    """Como o start_client: o screen_info do começo dá o tamanho da tela."""
+    info = json.loads(bytes(body).decode("utf-8")) if msg_type == MSG_INFO else {}
+    if info.get("type") != "screen_info":
+        raise ValueError("a gravação não começa com screen_info")
+    client.server_w, client.server_h = info["width"], info["height"]
+    return FrameDecoder(info["width"], info["height"], lambda msg: None)
+
+
+def seek(recording: Recording, position: float):
+    """
+    Decoder com o estado da gravação em position e o iterador do que vem
+    depois. Tudo até position é aplicado num lote só: o process() pula o
+    que o keyframe supera.
+    """
+    messages = recording.messages(position)
+    _, msg_type, body = next(messages)
+    decoder = new_decoder(msg_type, body)
+    batch = []
+    for t, msg_type, body in messages:
+        if t > position:
+            messages = itertools.chain([(t, msg_type, body)], messages)
+            break
+        batch.append((msg_type, body))
+    decoder.process(batch)
+    return decoder, messages
+
+
+# ==========================
+# Janela
+# ==========================
+
+def draw_time(frame, t: float, duration: float) -> None:
+    text = f"{int(t) // 60:02d}:{int(t) % 60:02d} / {int(duration) // 60:02d}:{int(duration) % 60:02d}"
+    cv2.rectangle(frame, (0, frame.shape[0] - 24), (150, frame.shape[0]), (0, 0, 0), -1)
+    cv2.putText(frame, text, (6, frame.shape[0] - 7), cv2.FONT_HERSHEY_SIMPLEX,
+                0.5, (0, 255, 0), 1, cv2.LINE_AA)
+
+
+def play_from(recording: Recording, position: float, speed: float, duration: float):
+    """Toca a partir de position; devolve a próxima posição pedida, ou None para sair."""
+    decoder, messages = seek(recording, position)
+    current = position
+    base_t, base_clock = position, time.monotonic()
+    paused = False
+
+    def show():
+        if decoder.framebuffer is not None:
+            frame = decoder.framebuffer.copy()
+            draw_time(frame, current, duration)
+            cv2.imshow("Playback", frame)
+
+    show()
+    for t, msg_type, body in itertools.chain(messages, [(None, None, None)]):
+        # Espera a hora da mensagem (na velocidade pedida) atendendo as teclas;
+        # no fim da gravação, só as teclas
+        while True:
+            remaining = 1.0 if t is None else base_clock + (t - base_t) / speed - time.monotonic()
+            if not paused and remaining <= 0:
+                break
+            key = cv2.waitKey(max(1, min(16, int(remaining * 1000)))) & 0xFF
+            if key in (27, ord("q")) or cv2.getWindowProperty("Playback", cv2.WND_PROP_VISIBLE) < 1:
+                return None
+            if key == ord(" "):
+                paused = not paused
+                base_t, base_clock = current, time.monotonic()
+            elif key == ord("j"):
+                return max(0.0, current - SEEK_STEP)
+            elif key == ord("l"):
+                return min(duration, current + SEEK_STEP)
+
+        current = t
+        if decoder.process([(msg_type, body)]):
+            show()
+    return None
+
+
+# ==========================
+# Sem janela
+# ==========================
+
+def run_headless(recording: Recording, seeks: int) -> None:
+    frames = nbytes = 0
+    decoder = None
+    started = time.perf_counter()
+    for _, msg_type, body in recording.messages(0.0):
+        if decoder is None:
+            decoder = new_decoder(msg_type, body)
+            continue
+        if msg_type != MSG_INFO:
+            frames += 1
+            nbytes += len(body)
+        decoder.process([(msg_type, body)])
+    elapsed = time.perf_counter() - started
+    print(f"{frames} frames, {nbytes / 2**20:.1f} MiB em {elapsed:.2f} s: "
+          f"{frames / elapsed:.0f} frames/s, {nbytes / 2**20 / elapsed:.0f} MiB/s decodificados")
+
+    duration = recording.duration
+    rng = random.Random(0)
+    times = []
+    for _ in range(seeks):
+        t0 = time.perf_counter()
+        seek(recording, rng.uniform(0, duration))
+        times.append(time.perf_counter() - t0)
+    if times:
+        times.sort()
+        print(f"busca (até o frame no ponto pedido): mediana {times[len(times) // 2] * 1000:.1f} ms, "
+              f"máx. {times[-1] * 1000:.1f} ms em {seeks} buscas numa gravação de {duration:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Toca uma gravação de sessão")
+    parser.add_argument("path", help="pasta da gravação")
+    parser.add_argument("--start", type=float, default=0.0, help="posição inicial (s)")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--headless", action="store_true", help="decodifica sem janela e mede")
+    parser.add_argument("--seeks", type=int, default=20, help="buscas aleatórias medidas no --headless")
+    args = parser.parse_args()
+
+    recording = Recording(args.path)
+    try:
+        if args.headless:
+            run_headless(recording, args.seeks)
+            return
+        duration = recording.duration
+        cv2.namedWindow("Playback", cv2.WINDOW_NORMAL)
+        position = args.start
+        while position is not None:
+            position = play_from(recording, position, args.speed, duration)
+        cv2.destroyAllWindows()
+    finally:
+        recording.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 # protocol.py
+import json
 import socket
 import struct
 
@@ -8,6 +9,9 @@ import struct
 
 HEADER_SIZE = 4  # 4 bytes para tamanho (32 bits, big-endian)
 
+# sendmsg (scatter-gather) não existe no Windows
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
 
 # ==========================
 # Funções de baixo nível
@@ -30,20 +34,47 @@ def create_client_socket(host: str, port: int) -> socket.socket:
     return sock
 
 
-def recv_all(sock: socket.socket, nbytes: int) -> bytes:
+def recv_into_all(sock: socket.socket, view: memoryview) -> None:
+    """Preenche toda a memoryview com dados do socket (sem cópias extras)."""
+    while view:
+        n = sock.recv_into(view)
+        if n == 0:
+            # Conexão fechada pelo peer antes de receber tudo
+            raise ConnectionError("Conexão encerrada durante recv_all")
+        view = view[n:]
+
+
+def recv_all(sock: socket.socket, nbytes: int) -> bytearray:
     """
     Lê exatamente nbytes do socket.
     TCP é stream: pode retornar menos que o pedido em cada recv,
     então é preciso um loop. [web:30][web:46]
+    O buffer é alocado uma vez e preenchido com recv_into.
     """
-    data = bytearray()
-    while len(data) < nbytes:
-        chunk = sock.recv(nbytes - len(data))
-        if not chunk:
-            # Conexão fechada pelo peer antes de receber tudo
-            raise ConnectionError("Conexão encerrada durante recv_all")
-        data.extend(chunk)
-    return bytes(data)
+    data = bytearray(nbytes)
+    recv_into_all(sock, memoryview(data))
+    return data
+
+
+def send_buffers(sock: socket.socket, buffers) -> None:
+    """
+    Envia vários buffers em sequência sem concatená-los.
+    Usa sendmsg (scatter-gather) quando disponível; no Windows, que não tem
+    sendmsg, junta tudo e usa sendall.
+    """
+    views = [memoryview(b).cast("B") for b in buffers]
+    if not HAS_SENDMSG:
+        sock.sendall(b"".join(views))
+        return
+
+    while views:
+        sent = sock.sendmsg(views)
+        # Descarta o que já foi inteiramente enviado e recorta o parcial
+        while views and sent >= views[0].nbytes:
+            sent -= views[0].nbytes
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
 
 
 # ==========================
@@ -54,10 +85,11 @@ def send_frame(sock: socket.socket, payload: bytes) -> None:
     """
     Envia um frame: [4 bytes tamanho big-endian] + [payload].
     Implementa framing de tamanho fixo no cabeçalho. [web:24][web:27][web:48]
+    Aceita bytes, memoryview ou array NumPy (ex.: saída do cv2.imencode).
     """
-    size = len(payload)
+    size = memoryview(payload).nbytes
     header = struct.pack(">I", size)  # 4 bytes, big-endian
-    sock.sendall(header + payload)
+    send_buffers(sock, (header, payload))
 
 
 def recv_frame(sock: socket.socket) -> bytes:
@@ -72,3 +104,145 @@ def recv_frame(sock: socket.socket) -> bytes:
     # lê payload
     payload = recv_all(sock, size)
     return payload
+
+
+class FrameReader:
+    """
+    Lê frames de um socket para um buffer pré-alocado e reaproveitado.
+
+    read_frame()/read_message() devolvem memoryviews que apontam para esse
+    buffer: podem ir direto para np.frombuffer/cv2.imdecode, mas só valem
+    até a próxima leitura (copie se precisar guardar).
+    """
+
+    def __init__(self, sock: socket.socket, initial_size: int = 1 << 20):
+        self.sock = sock
+        self._header = bytearray(HEADER_SIZE)
+        self._buf = bytearray(initial_size)
+
+    def read_frame(self) -> memoryview:
+        recv_into_all(self.sock, memoryview(self._header))
+        (size,) = struct.unpack(">I", self._header)
+        if size > len(self._buf):
+            # Cresce com folga para não realocar a cada frame maior
+            self._buf = bytearray(max(size, 2 * len(self._buf)))
+        view = memoryview(self._buf)[:size]
+        recv_into_all(self.sock, view)
+        return view
+
+    def read_message(self):
+        """Como recv_message, mas sem alocar por mensagem."""
+        view = self.read_frame()
+        if not view:
+            return None, b""
+        return view[0], view[1:]
+
+
+# ==========================
+# Mensagens do canal de vídeo
+# ==========================
+# Todo payload do canal de vídeo começa com 1 byte indicando o tipo:
+#   MSG_INFO   -> JSON (screen_info e outras mensagens de controle)
+#   MSG_JPEG   -> frame completo em JPEG
+#   MSG_UPDATE -> lista de retângulos alterados (delta por tiles)
+#   MSG_STRIPES -> frame completo composto de retângulos (faixas JPEG
+#                  codificadas em paralelo e/ou regiões sem perda); mesmo
+#                  corpo do MSG_UPDATE, mas substitui o framebuffer inteiro
+#                  como um MSG_JPEG. Os retângulos são aplicados em ordem.
+#   MSG_STREAM -> [stream: 1][tipo: 1] + corpo: uma das mensagens acima de um
+#                 stream assinado (um monitor, ou a miniatura dele). O stream
+#                 original, de uma tela só, continua sem esse envelope.
+
+MSG_INFO = 0
+MSG_JPEG = 1
+MSG_UPDATE = 2
+MSG_STRIPES = 3
+MSG_STREAM = 4
+
+STREAM_THUMBNAIL = 0x80  # id do stream = nº do monitor | STREAM_THUMBNAIL na miniatura
+
+# Tipos que trazem um frame completo (o cliente pode recomeçar deles)
+KEYFRAME_TYPES = (MSG_JPEG, MSG_STRIPES)
+
+# Codificações possíveis de cada retângulo de um MSG_UPDATE
+ENC_JPEG = 0
+ENC_PALETTE = 1  # sem perda: paleta de até 256 cores + índices em zlib (content.py)
+# Cache de tiles (tilecache.py): o retângulo é uma fileira de tiles inteiros
+# (lado = h) e os dados são um slot de 2 bytes por tile, da esquerda para a direita.
+ENC_CACHED = 2   # cola o tile guardado em cada slot
+ENC_STORE = 3    # guarda em cada slot o tile que o framebuffer tem ali agora
+# Scroll/arraste (motion.py): copia para (x, y) o retângulo do próprio
+# framebuffer que está em [x de origem][y de origem] (2 + 2 bytes de dados).
+# Vem antes dos demais retângulos da mensagem.
+ENC_COPY = 4
+
+# MSG_UPDATE: [largura][altura][nº de retângulos] e, para cada retângulo,
+# [x][y][w][h][codificação][tamanho] seguido dos bytes codificados.
+UPDATE_HEADER = struct.Struct(">HHH")
+RECT_HEADER = struct.Struct(">HHHHBI")
+
+
+def message_header(msg_type: int, body_len: int) -> bytes:
+    """Cabeçalho completo de uma mensagem tipada: [tamanho][tipo]."""
+    return struct.pack(">IB", body_len + 1, msg_type)
+
+
+def send_message(sock: socket.socket, msg_type: int, body: bytes) -> None:
+    """Envia uma mensagem tipada (1 byte de tipo + corpo) como um frame."""
+    send_buffers(sock, (message_header(msg_type, memoryview(body).nbytes), body))
+
+
+def recv_message(sock: socket.socket):
+    """
+    Recebe uma mensagem tipada.
+    Retorna (tipo, corpo) ou (None, b"") se a conexão terminou.
+    """
+    data = recv_frame(sock)
+    if not data:
+        return None, b""
+    return data[0], memoryview(data)[1:]
+
+
+def pack_stream(stream: int, msg_type: int, body) -> bytes:
+    """Corpo de um MSG_STREAM (copia o corpo: um memcpy perto do custo do encode)."""
+    return b"".join((bytes((stream, msg_type)), memoryview(body).cast("B")))
+
+
+def unpack_stream(body):
+    """Desmonta um MSG_STREAM: (stream, tipo, corpo)."""
+    view = memoryview(body)
+    return view[0], view[1], view[2:]
+
+
+def send_json(sock: socket.socket, msg: dict) -> None:
+    """Envia um dicionário como mensagem MSG_INFO."""
+    send_message(sock, MSG_INFO, json.dumps(msg).encode("utf-8"))
+
+
+def pack_update(width: int, height: int, rects) -> bytes:
+    """
+    Monta o corpo de um MSG_UPDATE.
+    rects: lista de (x, y, w, h, codificação, dados).
+    """
+    parts = [UPDATE_HEADER.pack(width, height, len(rects))]
+    for x, y, w, h, enc, data in rects:
+        parts.append(RECT_HEADER.pack(x, y, w, h, enc, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_update(body):
+    """
+    Desmonta o corpo de um MSG_UPDATE.
+    Retorna (largura, altura, [(x, y, w, h, codificação, memoryview), ...]).
+    """
+    view = memoryview(body)
+    width, height, count = UPDATE_HEADER.unpack_from(view, 0)
+    offset = UPDATE_HEADER.size
+    rects = []
+    for _ in range(count):
+        x, y, w, h, enc, size = RECT_HEADER.unpack_from(view, offset)
+        offset += RECT_HEADER.size
+        rects.append((x, y, w, h, enc, view[offset:offset + size]))
+        offset += size
+    return width, height, rects
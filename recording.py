@@ -0,0 +1,253 @@
+# recording.py
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from protocol import MSG_INFO, KEYFRAME_TYPES
+
+# ==========================
+# Formato
+# ==========================
+# Uma gravação é uma pasta com recording.json e segmentos numerados:
+#   00000.seg  mensagens do canal de vídeo, como foram enviadas, só acrescentadas
+#              [tempo µs: 8][tipo: 1][tamanho: 4] + corpo
+#   00000.idx  uma entrada por keyframe/screen_info/stream_config do segmento
+#              [tempo µs: 8][offset: 8][tipo da entrada: 1]
+# O tempo é desde o início da gravação. Cada segmento começa com o screen_info
+# e o stream_config em vigor seguidos de um keyframe, então dá para tocá-lo
+# sozinho. O segmento só troca num keyframe, depois de SEGMENT_BYTES.
+
+RECORD_HEADER = struct.Struct(">qBI")
+INDEX_DTYPE = np.dtype([("time", ">i8"), ("offset", ">u8"), ("kind", "u1")])
+
+KIND_KEYFRAME = 1
+KIND_SCREEN = 2
+KIND_CONFIG = 3
+
+SEGMENT_BYTES = 256 << 20  # tamanho a partir do qual o próximo keyframe abre outro segmento
+KEYFRAME_INTERVAL = 10.0   # s: keyframe periódico para a busca não refazer deltas demais
+
+
+def _info_kind(body) -> int:
+    """KIND_SCREEN/KIND_CONFIG para um MSG_INFO que muda o estado do stream; 0 para o resto."""
+    try:
+        kind = json.loads(bytes(body).decode("utf-8")).get("type")
+    except (ValueError, AttributeError):
+        return 0
+    return {"screen_info": KIND_SCREEN, "stream_config": KIND_CONFIG}.get(kind, 0)
+
+
+# ==========================
+# Gravação
+# ==========================
+
+class Recorder:
+    """
+    Grava as mensagens já codificadas que o servidor envia (nada é
+    recapturado nem recodificado): um write por mensagem no arquivo do
+    segmento, e uma entrada no índice para cada ponto de busca.
+
+    Um erro de disco encerra só a gravação, nunca a sessão.
+    """
+
+    def __init__(self, path: str, meta: dict = None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_bytes = SEGMENT_BYTES
+        self.keyframe_interval = KEYFRAME_INTERVAL
+        self.bytes = 0
+        self._started = time.monotonic()
+        self._segment = -1
+        self._seg = self._idx = None
+        self._offset = 0
+        self._context = {}  # KIND_SCREEN/KIND_CONFIG -> corpo do último MSG_INFO desse tipo
+        self._last_keyframe = None
+        with open(os.path.join(path, "recording.json"), "w") as f:
+            json.dump(dict(meta or {}, started=time.time()), f)
+        self._open_segment()
+
+    def _open_segment(self) -> None:
+        self._close_segment()
+        self._segment += 1
+        name = os.path.join(self.path, f"{self._segment:05d}")
+        self._seg = open(name + ".seg", "wb")
+        self._idx = open(name + ".idx", "wb")
+        self._offset = 0
+
+    def _close_segment(self) -> None:
+        for f in (self._seg, self._idx):
+            if f is not None:
+                f.close()
+        self._seg = self._idx = None
+
+    def _append(self, now: int, msg_type: int, body, kind: int) -> None:
+        view = memoryview(body).cast("B")
+        if kind:
+            self._idx.write(np.array([(now, self._offset, kind)], dtype=INDEX_DTYPE).tobytes())
+        self._seg.write(RECORD_HEADER.pack(now, msg_type, view.nbytes))
+        self._seg.write(view)
+        self._offset += RECORD_HEADER.size + view.nbytes
+        self.bytes += RECORD_HEADER.size + view.nbytes
+
+    def write(self, msg_type: int, body) -> None:
+        """Grava uma mensagem do canal de vídeo (as "stats" não interessam)."""
+        if self._seg is None:
+            return
+        now = int((time.monotonic() - self._started) * 1e6)
+        kind = 0
+        if msg_type == MSG_INFO:
+            kind = _info_kind(body)
+            if not kind:
+                return
+            self._context[kind] = bytes(body)
+        elif msg_type in KEYFRAME_TYPES:
+            kind = KIND_KEYFRAME
+            self._last_keyframe = time.monotonic()
+        try:
+            if kind == KIND_KEYFRAME and self._offset >= self.segment_bytes:
+                # Segmento novo: começa pelo estado do stream, para tocar sozinho
+                self._open_segment()
+                for info_kind, info in sorted(self._context.items()):
+                    self._append(now, MSG_INFO, info, info_kind)
+            self._append(now, msg_type, body, kind)
+            if kind == KIND_KEYFRAME:
+                # Numa queda, no máximo os deltas desde o último keyframe se perdem
+                self._seg.flush()
+                self._idx.flush()
+        except OSError as e:
+            print(f"[!] Gravação em {self.path} interrompida: {e}")
+            self._close_segment()
+
+    def keyframe_due(self) -> bool:
+        """True se já passou KEYFRAME_INTERVAL desde o último keyframe gravado."""
+        return (self._seg is not None and self._last_keyframe is not None
+                and time.monotonic() - self._last_keyframe >= self.keyframe_interval)
+
+    def close(self) -> None:
+        try:
+            self._close_segment()
+        except OSError as e:
+            print(f"[!] Erro ao fechar a gravação {self.path}: {e}")
+
+
+# ==========================
+# Reprodução
+# ==========================
+
+class _Segment:
+    """Um segmento mapeado em memória e o seu índice (carregado inteiro: é pequeno)."""
+
+    def __init__(self, name: str):
+        with open(name + ".idx", "rb") as f:
+            data = f.read()
+        index = np.frombuffer(data[:len(data) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize],
+                              dtype=INDEX_DTYPE)
+        keys = index[index["kind"] == KIND_KEYFRAME]
+        self.key_times = keys["time"].astype(np.int64)
+        self.key_offsets = keys["offset"].astype(np.int64)
+        self.context = {kind: index[index["kind"] == kind]["offset"].astype(np.int64)
+                        for kind in (KIND_SCREEN, KIND_CONFIG)}
+        self.start = int(index["time"][0]) if len(index) else 0
+
+        self._file = open(name + ".seg", "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self.mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.view = memoryview(self.mm) if self.mm is not None else memoryview(b"")
+
+    def record(self, offset: int):
+        """(tempo µs, tipo, corpo, próximo offset), ou None no fim (ou num registro cortado)."""
+        if offset + RECORD_HEADER.size > len(self.view):
+            return None
+        t, msg_type, size = RECORD_HEADER.unpack_from(self.view, offset)
+        end = offset + RECORD_HEADER.size + size
+        if end > len(self.view):
+            return None  # gravação interrompida no meio da mensagem
+        return t, msg_type, self.view[offset + RECORD_HEADER.size:end], end
+
+    def seek(self, t: int):
+        """Offset do último keyframe até t e os MSG_INFO em vigor nele (busca binária)."""
+        k = int(np.searchsorted(self.key_times, t, side="right")) - 1
+        if k < 0:
+            return 0, []  # antes do primeiro keyframe: o segmento começa com o contexto
+        offset = int(self.key_offsets[k])
+        context = []
+        for kind in (KIND_SCREEN, KIND_CONFIG):
+            offsets = self.context[kind]
+            i = int(np.searchsorted(offsets, offset)) - 1
+            if i >= 0:
+                context.append(int(offsets[i]))
+        return offset, sorted(context)
+
+    def close(self) -> None:
+        self.view.release()
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                pass  # ainda há corpos em uso; o mmap fecha quando eles forem liberados
+        self._file.close()
+
+
+class Recording:
+    """
+    Lê uma gravação sem carregá-la: os segmentos são mapeados com mmap e os
+    corpos saem como memoryview sobre eles. messages(início) acha o
+    segmento e o keyframe por busca binária nos índices.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "recording.json")) as f:
+            self.meta = json.load(f)
+        names = sorted(n[:-4] for n in os.listdir(path) if n.endswith(".seg"))
+        self.segments = [_Segment(os.path.join(path, n)) for n in names]
+        self._starts = [s.start for s in self.segments]
+
+    @property
+    def duration(self) -> float:
+        """Tempo (s) da última mensagem gravada."""
+        for segment in reversed(self.segments):
+            offset, last = 0, None
+            if len(segment.key_offsets):
+                offset = int(segment.key_offsets[-1])
+            while True:
+                record = segment.record(offset)
+                if record is None:
+                    break
+                last, offset = record[0], record[3]
+            if last is not None:
+                return last / 1e6
+        return 0.0
+
+    def messages(self, start: float = 0.0):
+        """
+        Gera (tempo s, tipo, corpo) a partir do último keyframe antes de start,
+        precedido do screen_info/stream_config em vigor nele. Quem toca aplica
+        sem esperar tudo o que tem tempo < start.
+        """
+        t = int(start * 1e6)
+        first = max(0, bisect.bisect_right(self._starts, t) - 1)
+        offset, context = self.segments[first].seek(t) if self.segments else (0, [])
+        for info in context:
+            record = self.segments[first].record(info)
+            if record is not None:
+                yield record[0] / 1e6, record[1], record[2]
+
+        for segment in self.segments[first:]:
+            while True:
+                record = segment.record(offset)
+                if record is None:
+                    break
+                rec_t, msg_type, body, offset = record
+                yield rec_t / 1e6, msg_type, body
+            offset = 0
+
+    def close(self) -> None:
+        for segment in self.segments:
+            segment.close()
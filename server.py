@@ -3,218 +3,674 @@
 import socket
 import threading
 import json
+import os
+import secrets
+import select
 import sys
-
-import cv2
-import numpy as np
-
-# Captura de tela: tenta mss primeiro (rápido no Windows), depois PIL (portável para Linux)
-try:
-    import mss
-    HAS_MSS = True
-except ImportError:
-    HAS_MSS = False
-
+import time
+
+import metrics
+from capture import open_capture, list_monitors, retain_frame, release_frame, CaptureBackend
+from content import encode_jpeg
+from protocol import (
+    create_server_socket, recv_frame, send_message, pack_stream, FrameReader,
+    MSG_INFO, MSG_JPEG, MSG_STREAM, STREAM_THUMBNAIL,
+)
+from adaptive import AdaptiveController
+from encoder import StreamEncoder
+from input_protocol import (
+    EV_MOVE, EV_BUTTON, EV_SCROLL, EV_KEY,
+    BTN_LEFT, BTN_RIGHT, BTN_MIDDLE, BUTTON_PRESS,
+    unpack_events, coalesce_moves,
+)
+from pipeline import FramePipeline
+from pacing import FrameScheduler, TARGET_FPS, MAX_FPS, IDLE_FPS
+from stripes import StripeEncoder, ENCODE_WORKERS
+from flow import FlowControl
+from mux import MuxConnection, CH_VIDEO, CH_INPUT, CH_CONTROL, CH_CURSOR
+from cursor import CursorSource, CursorTracker, virtual_pointer
+from udp import UdpSender, create_udp_socket
+from shm import ShmWriter, is_local, HAS_SHM
+from recording import Recorder
+
+# Sem display (ex.: benchmark headless) o pynput não carrega: o vídeo funciona
+# e o input é ignorado
 try:
-    from PIL import ImageGrab
-    HAS_PIL = True
+    from pynput.mouse import Controller as MouseController, Button
+    from pynput.keyboard import Controller as KeyboardController
+    HAS_PYNPUT = True
 except ImportError:
-    HAS_PIL = False
-
-from protocol import create_server_socket, send_frame, recv_frame
-from pynput.mouse import Controller as MouseController, Button
-from pynput.keyboard import Controller as KeyboardController
+    HAS_PYNPUT = False
 
 HOST = "0.0.0.0"
 PORT = 9999          # vídeo
 INPUT_PORT = 10000   # mouse/teclado
+MUX_PORT = 9998      # vídeo + input + controle numa conexão só
+MUX_ENABLED = True
+UDP_PORT = 9996      # vídeo opcional por UDP (o cliente pede com um hello)
+UDP_ENABLED = True
+
+CAPTURE_BACKEND = "auto"  # "auto", "mss", "pil", "synthetic:<cena>[+<cena>...]", "replay:<arquivo.npy>"
+THUMBNAIL_SIZE = (320, 180)  # miniatura de um monitor no mosaico do cliente
+THUMBNAIL_FPS = 2            # ritmo de captura das miniaturas
+
+JPEG_QUALITY = 50
+DELTA_MODE = True    # envia só os tiles alterados em vez do frame inteiro
+ADAPTIVE_MODE = True # ajusta qualidade/escala conforme a vazão do socket
+PARALLEL_ENCODE = True  # JPEG em faixas/retângulos codificados num pool de threads
+CONTENT_MODE = True  # texto/UI sem perda (paleta), foto/vídeo em JPEG (requer DELTA_MODE)
+CACHE_MODE = True    # tiles que o cliente já viu vão como referência ao cache dele (requer DELTA_MODE)
+MOTION_MODE = True   # scroll/arraste vira cópia de retângulo + faixa nova (requer DELTA_MODE)
+REFINE_MODE = True   # o que parou de mudar é reenviado uma vez em qualidade alta (requer DELTA_MODE)
+INPUT_DRAIN_LIMIT = 256  # máx. de eventos juntados antes de aplicar
+PACING_MODE = True   # captura no ritmo alvo, desacelera com a tela parada
+FLOW_CONTROL = True  # no máx. uma janela de frames sem ack do cliente (latência limitada)
+CURSOR_CHANNEL = True  # cursor fora dos frames, num canal próprio; o cliente o desenha
+SHM_ENABLED = True   # cliente na mesma máquina pode pedir os frames crus por memória compartilhada
+SHM_TRUSTED = []     # além do loopback: endereços/sub-redes de containers que compartilham o /dev/shm
+
+STATS_INTERVAL = 1.0       # s entre mensagens "stats" para o cliente (None = não envia)
+METRICS_HOST = "127.0.0.1" # endpoint de métricas só local
+METRICS_PORT = 9997        # GET /metrics e /metrics.json (None = desligado)
+RECORD_DIR = None          # pasta onde cada sessão é gravada (None = não grava)
+
+mouse = MouseController() if HAS_PYNPUT else None
+keyboard = KeyboardController() if HAS_PYNPUT else None
+
+
+# ==========================
+# Sessões (pareia vídeo e input)
+# ==========================
+
+class Session:
+    """Estado compartilhado entre as conexões de vídeo e de input de um cliente."""
+
+    def __init__(self):
+        self.token = secrets.token_hex(16)  # apresentado pelo cliente no input
+        self.streams = {}                   # id -> VideoStream ativo (None = stream original)
+        self.udp = None                     # UdpSender, se o cliente pediu vídeo por UDP
+
+    def wake(self) -> None:
+        """Chegou input: a tela deve mudar logo, então a captura acorda."""
+        for stream in list(self.streams.values()):
+            stream.pipeline.wake()
+
+    def use_udp(self, sock: socket.socket, addr) -> None:
+        """O cliente pediu o vídeo por UDP: os próximos frames vão para addr."""
+        udp = self.udp
+        if udp is not None and udp.addr == addr:
+            return  # hellos repetidos até o primeiro datagrama chegar
+        self.udp = UdpSender(sock, addr)
+        for stream in list(self.streams.values()):
+            stream.encoder.set_lossy()
+            stream.pipeline.request_frame()
+        print(f"[+] Vídeo por UDP para {addr}")
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def new_session() -> Session:
+    session = Session()
+    with _sessions_lock:
+        _sessions[session.token] = session
+    return session
+
+
+def end_session(session: Session) -> None:
+    with _sessions_lock:
+        _sessions.pop(session.token, None)
+
+
+def get_session(token):
+    with _sessions_lock:
+        return _sessions.get(token)
+
+
+# ==========================
+# Captura persistente
+# ==========================
+
+class WarmCapture:
+    """
+    Backend de captura aberto uma vez e mantido entre conexões, junto com o
+    último keyframe codificado.
+
+    Abrir um backend custa uma captura de teste (mss) ou uma captura
+    inteira mais o xrandr (PIL); com ele já aberto, uma reconexão só monta
+    o pipeline. O keyframe (a tela inteira em JPEG puro, sem referências ao
+    cache de tiles de nenhum cliente) sai logo depois do screen_info: o
+    cliente vê a tela na hora, e o primeiro frame do stream, que é sempre
+    completo, corrige o que tiver mudado desde então.
+
+    Há um por monitor (monitor_capture): cada um captura na thread do
+    pipeline de quem o usa, em paralelo aos outros.
+    """
+
+    def __init__(self, spec: str = None, backend: CaptureBackend = None, monitor: int = 1):
+        self.spec = spec          # None = CAPTURE_BACKEND no momento de abrir
+        self.backend = backend
+        self.monitor = monitor
+        self._keyframe = None     # (largura, altura, tipo, corpo)
+        self._last_frame = None   # último frame codificado, para store_keyframe()
+        self._lock = threading.Lock()
+
+    def open(self) -> CaptureBackend:
+        with self._lock:
+            if self.backend is None:
+                self.backend = open_capture(self.spec or CAPTURE_BACKEND, self.monitor)
+            return self.backend
+
+    def prime(self) -> None:
+        """Abre o backend e deixa um keyframe pronto antes do primeiro cliente."""
+        try:
+            backend = self.open()
+            try:
+                frame = backend.grab()
+            finally:
+                backend.close()  # handles desta thread, que termina aqui
+            if frame is not None:
+                self.remember(frame)
+                release_frame(frame)
+                self.store_keyframe()
+        except Exception as e:
+            print(f"[!] Captura não pôde ser aberta antecipadamente: {e}")
+
+    def keyframe(self, width: int, height: int):
+        """(tipo, corpo) do último keyframe, se ele é dessa resolução."""
+        keyframe = self._keyframe
+        if keyframe is not None and keyframe[:2] == (width, height):
+            return keyframe[2:]
+        return None
+
+    def set_keyframe(self, width: int, height: int, msg_type: int, body) -> None:
+        """Keyframe já codificado (e autossuficiente) de um stream na resolução da tela."""
+        self._keyframe = (width, height, msg_type, body)
+
+    def remember(self, frame) -> None:
+        """Guarda o frame que acabou de ser codificado (mais um dono dele)."""
+        retain_frame(frame)
+        with self._lock:  # dois streams do mesmo monitor
+            frame, self._last_frame = self._last_frame, frame
+        release_frame(frame)
+
+    def store_keyframe(self, stripes=None) -> None:
+        """Codifica o último frame lembrado como keyframe (ao fim de uma conexão)."""
+        with self._lock:
+            frame, self._last_frame = self._last_frame, None
+        if frame is None:
+            return
+        try:
+            if stripes is not None:
+                msg = stripes.encode_frame(frame, JPEG_QUALITY)
+            else:
+                data = encode_jpeg(frame, JPEG_QUALITY)
+                msg = (MSG_JPEG, data) if data is not None else None
+        finally:
+            release_frame(frame)
+        if msg is not None:
+            self.set_keyframe(frame.shape[1], frame.shape[0], *msg)
 
-mouse = MouseController()
-keyboard = KeyboardController()
 
+warm_capture = WarmCapture()  # monitor principal
+_monitor_captures = {1: warm_capture}
+_monitor_captures_lock = threading.Lock()
 
-def capture_screen_mss(sct):
-    """Captura tela usando mss (rápido no Windows)."""
-    monitor = sct.monitors[1]  # monitor principal
-    screenshot = sct.grab(monitor)
-    frame_bgra = np.array(screenshot)
-    frame = cv2.cvtColor(frame_bgra, cv2.COLOR_BGRA2BGR)
-    return frame, monitor["width"], monitor["height"]
 
+def monitor_capture(index: int) -> WarmCapture:
+    """WarmCapture de um monitor de CAPTURE_BACKEND (criado no primeiro uso)."""
+    with _monitor_captures_lock:
+        warm = _monitor_captures.get(index)
+        if warm is None:
+            warm = _monitor_captures[index] = WarmCapture(monitor=index)
+        return warm
 
-def capture_screen_pil():
-    """Captura tela usando PIL/Pillow (portável para Linux e macOS)."""
-    screenshot = ImageGrab.grab()
-    frame = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-    # Usa o tamanho exato da captura (inclui DPI scaling se existir)
-    width, height = screenshot.size
-    return frame, width, height
 
+def screen_info(width: int, height: int, token: str, **extra) -> bytes:
+    """extra: "monitors" no começo da conexão; monitor/left/top num stream de monitor."""
+    return json.dumps(dict({
+        "type": "screen_info",
+        "width": width,
+        "height": height,
+        "token": token,
+    }, **extra)).encode("utf-8")
 
-def get_logical_resolution_pil():
+
+def first_frame(started: float, addr) -> None:
+    """Registra o tempo da conexão até o primeiro frame enviado."""
+    ms = (time.perf_counter() - started) * 1000
+    metrics.observe("first_frame_ms", ms)
+    print(f"[+] Primeiro frame para {addr} em {ms:.0f} ms")
+
+
+def open_recorder(addr, session: Session, suffix: str = ""):
     """
-    Obtém resolução LÓGICA (não física) no Linux.
-    PIL captura em pixels físicos com scaling, mas pynput usa lógicos.
+    Recorder da sessão em RECORD_DIR, ou None (gravação desligada ou pasta
+    inacessível). Cada stream de monitor grava na sua pasta (suffix).
     """
+    if RECORD_DIR is None:
+        return None
+    path = os.path.join(RECORD_DIR, time.strftime("%Y%m%d-%H%M%S-") + session.token[:8] + suffix)
     try:
-        import subprocess
-        # Tenta xrandr para obter resolução lógica
-        result = subprocess.run(['xrandr', '--current'], 
-                              capture_output=True, text=True, timeout=2)
-        if result.returncode == 0:
-            for line in result.stdout.split('\n'):
-                # Procura por "connected primary X"xY" ou similar
-                if 'connected primary' in line or (' connected ' in line and 'x' in line):
-                    # Parse: "HDMI-1 connected 2560x1440+0+0" -> pega "2560x1440"
-                    parts = line.split()
-                    for part in parts:
-                        if 'x' in part and part[0].isdigit():
-                            try:
-                                w_str, h_str = part.split('x')[0], part.split('x')[1].split('+')[0]
-                                w, h = int(w_str), int(h_str)
-                                if w > 0 and h > 0:
-                                    return w, h
-                            except:
-                                pass
-    except Exception:
-        pass
-    
-    return None, None
-
-
-def get_screen_resolution():
-    """Obtém resolução da tela usando a biblioteca disponível."""
-    if HAS_MSS:
-        try:
-            with mss.mss() as sct:
-                monitor = sct.monitors[1]
-                return monitor["width"], monitor["height"]
-        except Exception:
-            pass
-    
-    if HAS_PIL:
-        try:
-            screenshot = ImageGrab.grab()
-            return screenshot.size
-        except Exception:
-            pass
-    
-    # Fallback
-    return 1920, 1080
-
+        recorder = Recorder(path, {"addr": str(addr)})
+    except OSError as e:
+        print(f"[!] A sessão de {addr} não será gravada: {e}")
+        return None
+    print(f"[+] Gravando a sessão de {addr} em {path}")
+    return recorder
 
-def capture_and_send_loop(conn: socket.socket, addr):
-    """Captura a tela e envia frames JPEG + info de resolução."""
-    print(f"[+] Cliente conectado (vídeo): {addr}")
 
-    # Tenta usar mss primeiro, depois PIL
-    use_mss = False
-    use_pil = False
-    sct = None
-    
+def control_loop(recv_control, handlers: dict) -> None:
+    """
+    Trata mensagens de controle (JSON) que o cliente manda de volta.
+    recv_control() devolve o próximo frame, ou vazio quando a conexão fecha.
+    handlers: tipo da mensagem -> função que recebe a mensagem.
+    Tipos desconhecidos são ignorados.
+    """
     try:
-        # Tenta inicializar mss
-        if HAS_MSS:
-            try:
-                sct = mss.mss()
-                monitor = sct.monitors[1]
-                server_w = monitor["width"]
-                server_h = monitor["height"]
-                
-                # Tenta fazer uma captura de teste para garantir que funciona
-                test_screenshot = sct.grab(monitor)
-                use_mss = True
-                print(f"[+] Usando mss para captura de tela (resolução: {server_w}x{server_h})")
-            except Exception as e:
-                print(f"[!] mss falhou (esperado no Linux sem X11): {e}")
-                if sct:
-                    sct.close()
-                    sct = None
-                use_mss = False
-        
-        # Se mss falhou ou não está disponível, tenta PIL
-        if not use_mss and HAS_PIL:
-            try:
-                screenshot = ImageGrab.grab()
-                server_w, server_h = screenshot.size
-                
-                # IMPORTANTE: No Linux, PIL captura em pixels FÍSICOS (com DPI scaling)
-                # mas pynput trabalha em pixels LÓGICOS. Precisa redimensionar.
-                logical_w, logical_h = get_logical_resolution_pil()
-                if logical_w and logical_h and (logical_w != server_w or logical_h != server_h):
-                    print(f"[+] Redimensionando PIL: {server_w}x{server_h} (físico) -> {logical_w}x{logical_h} (lógico)")
-                    server_w, server_h = logical_w, logical_h
-                
-                use_pil = True
-                print(f"[+] Usando PIL/Pillow para captura de tela (resolução: {server_w}x{server_h})")
-            except Exception as e:
-                print(f"[!] PIL também falhou: {e}")
-                use_pil = False
-        
-        # Se nenhuma funcionou, erro fatal
-        if not use_mss and not use_pil:
-            raise RuntimeError(
-                "Nenhuma biblioteca de captura funcionou! "
-                "Verifique se 'mss' (com X11/Wayland) ou 'Pillow' está instalado."
-            )
-
-        # 0. Envia info de resolução para o cliente (uma vez)
-        info = json.dumps({
-            "type": "screen_info",
-            "width": server_w,
-            "height": server_h,
-        }).encode("utf-8")
-        send_frame(conn, info)
-        
-        print(f"[+] Enviando frames em resolução: {server_w}x{server_h}")
-
-        # Loop de captura com mss
-        if use_mss:
-            while True:
-                try:
-                    frame, _, _ = capture_screen_mss(sct)
-                    
-                    # Comprime em JPEG
-                    ok, buffer = cv2.imencode(
-                        ".jpg",
-                        frame,
-                        [cv2.IMWRITE_JPEG_QUALITY, 50],
-                    )
-                    if not ok:
-                        continue
+        while True:
+            data = recv_control()
+            if not data:
+                return
+            msg = json.loads(bytes(data).decode("utf-8"))
+            handler = handlers.get(msg.get("type"))
+            if handler is not None:
+                handler(msg)
+    except (ConnectionError, OSError, ValueError, KeyError, TypeError):
+        return
 
-                    jpeg_bytes = buffer.tobytes()
-                    send_frame(conn, jpeg_bytes)
-                
-                except Exception as e:
-                    print(f"[!] Erro ao capturar/enviar com mss: {e}")
-                    break
-        
-        # Loop de captura com PIL
-        elif use_pil:
-            while True:
-                try:
-                    frame, w, h = capture_screen_pil()
-                    
-                    # Se a captura é em pixels FÍSICOS mas server_w/h são LÓGICOS, redimensiona
-                    if w != server_w or h != server_h:
-                        frame = cv2.resize(frame, (server_w, server_h), interpolation=cv2.INTER_LINEAR)
-                    
-                    # Comprime em JPEG
-                    ok, buffer = cv2.imencode(
-                        ".jpg",
-                        frame,
-                        [cv2.IMWRITE_JPEG_QUALITY, 50],
-                    )
-                    if not ok:
-                        continue
 
-                    jpeg_bytes = buffer.tobytes()
-                    send_frame(conn, jpeg_bytes)
-                
-                except Exception as e:
-                    print(f"[!] Erro ao capturar/enviar com PIL: {e}")
+# ==========================
+# Streams de vídeo (um por monitor assinado)
+# ==========================
+
+class VideoConnection:
+    """
+    O que os streams de vídeo de uma conexão compartilham: o envio (um de
+    cada vez, pelo TCP ou pelo UDP), a sessão, o primeiro frame e o fim.
+    """
+
+    def __init__(self, send, addr, session: Session):
+        self.addr = addr
+        self.session = session
+        self.connected = time.perf_counter()
+        self.closed = threading.Event()  # erro no envio, ou o cliente saiu
+        self.error = None
+        self._send = send
+        self._lock = threading.Lock()
+        self._waiting_first = True
+
+    def send(self, msg_type: int, body, stream=None) -> float:
+        """
+        Envia uma mensagem (num MSG_STREAM, se stream não é None) e devolve o
+        tempo bloqueado no envio, sem contar a espera pelos outros streams.
+        """
+        if stream is not None:
+            msg_type, body = MSG_STREAM, pack_stream(stream, msg_type, body)
+        with self._lock:
+            started = time.perf_counter()
+            # Depois do hello no UDP_PORT, o vídeo sai por UDP (o controle segue no TCP)
+            udp = self.session.udp
+            (udp.send_message if udp is not None else self._send)(msg_type, body)
+            return time.perf_counter() - started
+
+    def frame_sent(self) -> None:
+        if self._waiting_first:
+            self._waiting_first = False
+            first_frame(self.connected, self.addr)
+
+    def close(self, error=None) -> None:
+        if error is not None and self.error is None:
+            self.error = error
+        self.closed.set()
+
+
+class VideoStream:
+    """
+    Um stream de vídeo de uma conexão: encoder, pipeline e thread de envio
+    próprios sobre o WarmCapture de um monitor. Os streams de uma conexão
+    capturam e codificam em paralelo, e só o que o cliente assinou roda.
+
+    stream_id None é o stream original, de uma tela só: mensagens sem
+    envelope, como sempre. Com id (o número do monitor), as mensagens vão
+    num MSG_STREAM; com STREAM_THUMBNAIL no id, é a miniatura do monitor,
+    reduzida a THUMBNAIL_SIZE e capturada a THUMBNAIL_FPS.
+    """
+
+    def __init__(self, connection: VideoConnection, warm: WarmCapture, stream_id=None):
+        self.connection = connection
+        self.warm = warm
+        self.stream_id = stream_id
+        self.thumbnail = stream_id is not None and bool(stream_id & STREAM_THUMBNAIL)
+        self.capture = self.encoder = self.pipeline = None
+        self.flow = FlowControl() if FLOW_CONTROL else None
+        self.shm = None              # ShmWriter, com o vídeo na memória compartilhada
+        self._shm_wanted = False
+        self._controller = self._stripes = self._recorder = None
+        self._reannounce = threading.Event()
+        self._thread = None
+
+    def _info(self, width: int, height: int, **extra) -> bytes:
+        if self.stream_id is not None:
+            # Posição do monitor na área de trabalho: o cliente traduz o mouse com ela
+            capture = self.capture
+            extra.update(monitor=capture.monitor, left=capture.left, top=capture.top)
+        return screen_info(width, height, self.connection.session.token, **extra)
+
+    def _send(self, msgs) -> None:
+        connection = self.connection
+        for msg_type, body in msgs:
+            elapsed = connection.send(msg_type, body, self.stream_id)
+            if self._recorder is not None:
+                self._recorder.write(msg_type, body)
+            if msg_type != MSG_INFO:
+                connection.frame_sent()
+                # Tempo bloqueado no send = backpressure do cliente/rede
+                metrics.observe("send_ms", elapsed * 1000)
+                metrics.count("frames_sent")
+                metrics.count("bytes_sent", len(body))
+                # No UDP frames se perdem sem ack: a numeração só vale no TCP
+                flow = self.flow if connection.session.udp is None else None
+                if flow is not None:
+                    flow.sent(len(body))
+                if self._controller is not None and (flow is None or not flow.active):
+                    # Com acks, a vazão vem deles (ack()): o send quase não bloqueia mais
+                    self._controller.record_send(len(body), elapsed)
+
+    def start(self, **info) -> None:
+        """
+        Abre a captura, envia o screen_info (com info) e o último keyframe do
+        monitor, e começa a capturar e enviar em threads próprias.
+        """
+        connection, session = self.connection, self.connection.session
+        capture = self.capture = self.warm.open()
+        server_w, server_h = capture.width, capture.height
+        suffix = ""
+        if self.stream_id is not None:
+            suffix = f"-{'t' if self.thumbnail else 'm'}{capture.monitor}"
+        # Grava as mensagens já codificadas, como saem para o cliente
+        self._recorder = open_recorder(connection.addr, session, suffix)
+
+        # 0. Envia info de resolução para o cliente e, se houver, o último
+        # keyframe: a tela aparece antes do pipeline produzir o primeiro frame
+        try:
+            self._send([(MSG_INFO, self._info(server_w, server_h, **info))])
+            keyframe = None if self.thumbnail else self.warm.keyframe(server_w, server_h)
+            if keyframe is not None:
+                self._send([keyframe])
+                metrics.count("cached_keyframes")
+        except Exception:
+            if self._recorder is not None:
+                self._recorder.close()
+            raise
+
+        if self.thumbnail:
+            # Miniatura: tamanho e ritmo fixos, qualidade fixa
+            scheduler = FrameScheduler(THUMBNAIL_FPS, THUMBNAIL_FPS, IDLE_FPS)
+        else:
+            self._controller = AdaptiveController(quality=JPEG_QUALITY) if ADAPTIVE_MODE else None
+            scheduler = FrameScheduler(TARGET_FPS, MAX_FPS, IDLE_FPS) if PACING_MODE else None
+            print(f"[+] Enviando frames de {capture.name} em resolução: {server_w}x{server_h}")
+        self._stripes = StripeEncoder(ENCODE_WORKERS) if PARALLEL_ENCODE else None
+        encoder = self.encoder = StreamEncoder(
+            server_w, server_h, quality=JPEG_QUALITY, delta=DELTA_MODE,
+            controller=self._controller, stripes=self._stripes,
+            content=CONTENT_MODE, cache=CACHE_MODE, motion=MOTION_MODE,
+            refine=REFINE_MODE and not self.thumbnail)
+        if self.thumbnail:
+            encoder.set_viewport(*THUMBNAIL_SIZE)
+        if self._recorder is not None:
+            encoder.disable_cache()  # keyframes autocontidos: a busca começa em qualquer um
+
+        # Captura e codificação rodam em threads próprias; _run só envia
+        self.pipeline = FramePipeline(capture.grab, self._encode, capture.close, scheduler,
+                                      self._has_credit, self._refine_pending)
+        session.streams[self.stream_id] = self
+        if session.udp is not None:
+            encoder.set_lossy()  # o hello chegou antes do encoder existir
+        self.pipeline.start()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _has_credit(self, timeout: float) -> bool:
+        shm = self.shm
+        if shm is not None and self._shm_wanted:
+            return shm.wait_space(timeout)  # o crédito é um slot que o cliente não segura
+        if self.flow is None or self.connection.session.udp is not None:
+            return True  # no UDP frames se perdem sem ack; o ritmo do UdpSender limita a fila
+        return self.flow.wait(timeout)
+
+    def _refine_pending(self) -> bool:
+        # Frames crus já chegam na qualidade máxima: nada a refinar
+        return self.shm is None and self.encoder.refine_pending()
+
+    def use_shm(self, enabled: bool) -> None:
+        """
+        O cliente, na mesma máquina, pediu os frames crus por memória
+        compartilhada (ou desistiu: o segmento não abriu do lado dele). A
+        troca acontece na thread de codificação, no próximo frame.
+        """
+        local = is_local(self.connection.addr[0], SHM_TRUSTED)
+        if enabled and not (SHM_ENABLED and HAS_SHM and local):
+            return  # de outra máquina o segmento nem existiria para o cliente
+        if enabled and (self.thumbnail or self._recorder is not None
+                        or self.connection.session.udp is not None):
+            return  # miniatura (reduzida), gravação e UDP continuam codificados
+        self._shm_wanted = enabled
+        self.pipeline.request_frame()
+
+    def _switch_shm(self, frame) -> list:
+        """Abre, troca ou fecha o anel conforme o pedido; as mensagens a anunciar."""
+        shm, addr = self.shm, self.connection.addr
+        if shm is not None and (not self._shm_wanted or not shm.fits(frame)):
+            shm.close()
+            self.shm = None
+            if not self._shm_wanted:
+                # De volta ao socket: o delta recomeça num frame completo
+                self.encoder.request_keyframe()
+                print(f"[+] Vídeo de {addr} de volta ao socket")
+                return []
+        if self._shm_wanted and self.shm is None:
+            try:
+                self.shm = ShmWriter(frame.nbytes)
+            except OSError as e:
+                print(f"[!] Memória compartilhada indisponível para {addr}: {e}")
+                self._shm_wanted = False
+                return []
+            print(f"[+] Vídeo por memória compartilhada para {addr} ({self.shm.name})")
+            # Pelo socket, na ordem dos frames: o cliente abre o anel e passa a ler dele
+            return [(MSG_INFO, json.dumps(self.shm.info()).encode("utf-8"))]
+        return []
+
+    def ack(self, frame: int, decode_ms=None) -> None:
+        """O cliente decodificou até o frame (numeração implícita do stream)."""
+        if self.flow is None or self.connection.session.udp is not None:
+            return
+        delivered = self.flow.ack(frame, decode_ms)
+        if delivered is not None and self._controller is not None:
+            self._controller.record_send(*delivered)
+
+    def _encode(self, frame):
+        encoder = self.encoder
+        msgs = []
+        h, w = frame.shape[:2]
+        if (w, h) != (encoder.server_w, encoder.server_h):
+            # Resolução mudou: o cliente recomeça na tela inteira, no tamanho novo
+            encoder.set_screen(w, h)
+            msgs.append((MSG_INFO, self._info(w, h)))
+        elif self._reannounce.is_set():
+            # Pedido de keyframe no UDP: o screen_info pode ter sido perdido
+            msgs.append((MSG_INFO, self._info(w, h)))
+        self._reannounce.clear()
+        if not self.thumbnail:
+            self.warm.remember(frame)
+        if self._shm_wanted or self.shm is not None:
+            msgs += self._switch_shm(frame)
+        if self.shm is not None:
+            # Cliente local: o frame cru vai para o anel, sem encode nem socket
+            with metrics.timer("shm_write_ms"):
+                written = self.shm.write(frame)
+            if written:
+                self.connection.frame_sent()
+            return msgs or None
+        return msgs + (encoder.encode(frame) or []) or None
+
+    def _run(self) -> None:
+        connection, pipeline = self.connection, self.pipeline
+        try:
+            while not connection.closed.is_set():
+                # Com timeout para ver o fim da conexão mesmo com a tela parada
+                msgs = pipeline.get(1.0)
+                if msgs is None and pipeline.encoded.closed:
                     break
+                self._send(msgs or ())
+                if self._recorder is not None and self._recorder.keyframe_due():
+                    self.encoder.request_keyframe()  # ponto de busca periódico na gravação
+        except (ConnectionError, OSError) as e:
+            connection.close(e)
+        except Exception as e:
+            print(f"[!] Erro ao capturar/codificar com {self.capture.name}: {e}")
+            if self.stream_id is None:
+                connection.close()
+        finally:
+            if connection.session.streams.get(self.stream_id) is self:
+                del connection.session.streams[self.stream_id]
+            pipeline.close()
+            # Sem deixar encode/resize rodando sobre o pool que fecha a seguir
+            pipeline.join(timeout=1.0)
+            if not self.thumbnail:
+                # O último frame vira o keyframe da próxima conexão
+                self.warm.store_keyframe(self._stripes)
+            if self._stripes is not None:
+                self._stripes.close()
+            if self._recorder is not None:
+                self._recorder.close()
+            if self.shm is not None:
+                self.shm.close()
+
+    def request_keyframe(self) -> None:
+        # Com a tela parada o frame nem chegaria ao codificador
+        self.encoder.request_keyframe()
+        if self.connection.session.udp is not None:
+            self._reannounce.set()
+        self.pipeline.request_frame()
+
+    def set_viewport(self, width: int, height: int, zoom=None) -> None:
+        if self.thumbnail:
+            return  # a miniatura tem tamanho fixo
+        # Janela (e zoom) do cliente: o próximo frame já sai no tamanho novo
+        self.encoder.set_viewport(width, height, zoom)
+        self.pipeline.request_frame()
+
+    def close(self) -> None:
+        """Para o stream; a thread de envio libera o resto ao sair."""
+        self.pipeline.close()
+        if self.flow is not None:
+            self.flow.close()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout: float = None) -> None:
+        self._thread.join(timeout)
+
+
+def stream_video(send, addr, recv_control=None, session=None, capture=None) -> None:
+    """
+    Captura a tela e envia screen_info + frames usando send(tipo, corpo).
+    Funciona tanto sobre um socket dedicado quanto sobre um canal multiplexado.
+    Se recv_control for dado, mensagens de controle do cliente são lidas
+    numa thread à parte. capture é um WarmCapture ou um CaptureBackend já
+    aberto (o benchmark passa uma fonte sintética); por padrão usa
+    warm_capture, o backend de CAPTURE_BACKEND mantido entre conexões.
+
+    A conexão começa com o stream original (monitor principal). O
+    screen_info dele lista os monitores; com um "subscribe" o cliente troca
+    esse stream pelos monitores que quer ver, inteiros ou em miniatura, cada
+    um num VideoStream (e o custo acompanha o que é assinado).
+    """
+    session = session or new_session()
+    connection = VideoConnection(send, addr, session)
+    if isinstance(capture, WarmCapture) or capture is None:
+        warm = capture or warm_capture
+    else:
+        warm = WarmCapture(backend=capture)
+    streams = {}  # id -> VideoStream
+    lock = threading.Lock()
+    try:
+        primary = VideoStream(connection, warm)
+        if warm.backend is not None and warm is not warm_capture:
+            # Fonte dada por quem chamou (benchmark): é o único monitor
+            monitors = [warm.open().geometry()]
+        else:
+            monitors = list_monitors(warm.spec or CAPTURE_BACKEND)
+        primary.start(monitors=monitors)
+        streams[None] = primary
+        indexes = {m["index"] for m in monitors}
+
+        def on_stream(handler):
+            # Mensagens de controle valem para o stream no campo "stream" (sem = o original)
+            def dispatch(msg):
+                stream = streams.get(msg.get("stream"))
+                if stream is not None:
+                    handler(stream, msg)
+            return dispatch
+
+        def subscribe(msg):
+            wanted = [int(m) for m in msg.get("monitors") or ()]
+            wanted += [int(m) | STREAM_THUMBNAIL for m in msg.get("thumbnails") or ()]
+            wanted = [sid for sid in wanted if sid & ~STREAM_THUMBNAIL in indexes]
+            with lock:
+                for sid in [sid for sid in streams if sid not in wanted]:
+                    streams.pop(sid).close()
+                for sid in wanted:
+                    if sid in streams:
+                        continue
+                    monitor = sid & ~STREAM_THUMBNAIL
+                    stream = VideoStream(connection, warm if monitor == 1 else monitor_capture(monitor), sid)
+                    try:
+                        stream.start()
+                    except (ConnectionError, OSError) as e:
+                        connection.close(e)
+                        return
+                    except Exception as e:
+                        print(f"[!] Monitor {monitor} não pôde ser capturado: {e}")
+                        continue
+                    streams[sid] = stream
+
+        handlers = {
+            "keyframe_request": on_stream(lambda stream, msg: stream.request_keyframe()),
+            "decode_reduce": on_stream(
+                lambda stream, msg: stream.encoder.set_client_reduce(int(msg["reduce"]))),
+            "viewport": on_stream(
+                lambda stream, msg: stream.set_viewport(msg["width"], msg["height"], msg.get("zoom"))),
+            "subscribe": subscribe,
+            "ack": on_stream(lambda stream, msg: stream.ack(msg["frame"], msg.get("decode_ms"))),
+            "shm": on_stream(lambda stream, msg: stream.use_shm(bool(msg.get("enabled", True)))),
+        }
+
+        def control():
+            control_loop(recv_control, handlers)
+            if session.udp is not None or not streams:
+                # Com o vídeo no UDP, o fim do controle (TCP) é o sinal de que o cliente saiu
+                connection.close()
+
+        if recv_control is not None:
+            threading.Thread(target=control, daemon=True).start()
+
+        # Esta thread só manda as estatísticas e espera o fim: os streams se enviam
+        while not connection.closed.wait(STATS_INTERVAL or 1.0):
+            if recv_control is None and not primary.running:
+                break  # sem controle, o stream original é a conexão toda
+            if STATS_INTERVAL is not None:
+                connection.send(MSG_INFO, json.dumps({
+                    "type": "stats",
+                    "metrics": metrics.snapshot(),
+                }).encode("utf-8"))
+        if connection.error is not None:
+            raise connection.error
 
     except (ConnectionError, OSError) as e:
         print(f"[!] Conexão de vídeo com {addr} encerrada: {e}")
@@ -223,92 +679,268 @@ def capture_and_send_loop(conn: socket.socket, addr):
     except Exception as e:
         print(f"[!] Erro inesperado no vídeo com {addr}: {e}")
     finally:
-        if sct:
-            sct.close()
+        connection.close()
+        with lock:
+            running = list(streams.values())
+            streams.clear()
+        for stream in running:
+            stream.close()
+        for stream in running:
+            stream.join(timeout=2.0)
+        end_session(session)
+
+
+def capture_and_send_loop(conn: socket.socket, addr):
+    """Captura a tela e envia frames JPEG + info de resolução."""
+    print(f"[+] Cliente conectado (vídeo): {addr}")
+    try:
+        # O cliente manda controle pelo mesmo socket, no sentido contrário
+        stream_video(
+            lambda msg_type, body: send_message(conn, msg_type, body),
+            addr,
+            lambda: recv_frame(conn),
+        )
+    finally:
         conn.close()
         print(f"[-] Cliente desconectado (vídeo): {addr}")
 
 
+BUTTONS = {
+    BTN_LEFT: Button.left,
+    BTN_RIGHT: Button.right,
+    BTN_MIDDLE: Button.middle,
+} if HAS_PYNPUT else {}
+
+
+def apply_events(events) -> None:
+    """Aplica uma sequência de eventos de mouse/teclado na máquina local."""
+    events = coalesce_moves(events)
+    for kind, arg, x, y, _ in events:
+        if kind in (EV_MOVE, EV_BUTTON):
+            virtual_pointer.move(x, y)  # o cursor das fontes sintéticas (e sem pynput)
+    if not HAS_PYNPUT:
+        return
+    for kind, arg, x, y, code in events:
+        if kind == EV_MOVE:
+            # As coordenadas já vêm escaladas corretamente do cliente
+            # porque o cliente usa as dimensões do frame recebido (e, com
+            # vários monitores, soma a posição do monitor na área de trabalho)
+            mouse.position = (x, y)
+
+        elif kind == EV_BUTTON:
+            button = BUTTONS.get(arg & ~BUTTON_PRESS)
+            if button is None:
+                continue
+            if arg & BUTTON_PRESS:
+                mouse.press(button)
+            else:
+                mouse.release(button)
+
+        elif kind == EV_SCROLL:
+            mouse.scroll(x, y)
+
+        elif kind == EV_KEY:
+            key = chr(code)
+            if arg:
+                keyboard.press(key)
+            else:
+                keyboard.release(key)
 
-def handle_input_conn(conn: socket.socket, addr, capture_mode: str = "unknown"):
-    """Recebe comandos de mouse/teclado do cliente e aplica na máquina."""
-    print(f"[INPUT] Cliente conectado (input): {addr}")
-    try:
-        while True:
-            data = recv_frame(conn)
-            if not data:
-                print("[INPUT] Conexão encerrada.")
-                break
 
-            msg = json.loads(data.decode("utf-8"))
-            etype = msg.get("type")
+def pointer_position():
+    """Posição do ponteiro do host na área de trabalho (sem pynput, a do virtual)."""
+    if not HAS_PYNPUT:
+        return virtual_pointer.position
+    x, y = mouse.position
+    return int(x), int(y)
 
-            if etype == "mouse_move":
-                x, y = msg["x"], msg["y"]
-                # As coordenadas já vêm escaladas corretamente do cliente
-                # porque o cliente usa as dimensões do frame recebido
-                mouse.position = (int(x), int(y))
 
-            elif etype == "mouse_click":
-                button = Button.left if msg["button"] == "left" else Button.right
-                if msg["action"] == "press":
-                    mouse.press(button)
-                else:
-                    mouse.release(button)
+def open_cursor_tracker(send):
+    """
+    CursorTracker do host enviando por send(tipo, corpo), ou None se
+    CURSOR_CHANNEL está desligado. Com uma fonte sintética, o cursor é o
+    ponteiro virtual (o que o input do cliente moveu).
+    """
+    if not CURSOR_CHANNEL:
+        return None
+    if CAPTURE_BACKEND.startswith(("synthetic:", "replay:")):
+        source = CursorSource(lambda: virtual_pointer.position)
+    else:
+        source = CursorSource(pointer_position, image=CAPTURE_BACKEND in ("auto", "mss"))
+    return CursorTracker(send, source)
 
-            elif etype == "mouse_scroll":
-                dx, dy = msg["dx"], msg["dy"]
-                mouse.scroll(dx, dy)
 
-            elif etype == "key_press":
-                key = msg["key"]
-                keyboard.press(key)
+def serve_input(next_frame, has_pending, on_input=None) -> None:
+    """
+    Lê frames de input com next_frame() e aplica os eventos.
+    has_pending() diz se já há outro frame esperando, para juntar tudo
+    antes de aplicar: movimentos atrasados são fundidos e não atrasam cliques.
+    on_input() é chamado depois de cada lote aplicado (acorda a captura).
+    """
+    while True:
+        data = next_frame()
+        if not data:
+            print("[INPUT] Conexão encerrada.")
+            return
+
+        events = unpack_events(data)
+        while len(events) < INPUT_DRAIN_LIMIT and has_pending():
+            data = next_frame()
+            if not data:
+                break
+            events.extend(unpack_events(data))
 
-            elif etype == "key_release":
-                key = msg["key"]
-                keyboard.release(key)
+        metrics.count("input_events", len(events))
+        apply_events(events)
+        if on_input is not None:
+            on_input()
+        if not data:
+            print("[INPUT] Conexão encerrada.")
+            return
+
+
+def handle_input_conn(conn: socket.socket, addr, capture_mode: str = "unknown"):
+    """
+    Recebe comandos de mouse/teclado do cliente e aplica na máquina. Se o
+    hello pedir "cursor", o mesmo socket leva o cursor no sentido contrário.
+    """
+    print(f"[INPUT] Cliente conectado (input): {addr}")
+    tracker = None
+    try:
+        # Primeira mensagem: token da sessão de vídeo correspondente
+        data = recv_frame(conn)
+        hello = json.loads(data.decode("utf-8")) if data else {}
+        session = get_session(hello.get("token")) if hello.get("type") == "hello" else None
+        if session is None:
+            print(f"[INPUT] Token de sessão inválido de {addr}, recusando.")
+            return
+        if hello.get("cursor"):
+            # Posições do cursor são pequenas: sem Nagle elas saem na hora
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            tracker = open_cursor_tracker(lambda msg_type, body: send_message(conn, msg_type, body))
+
+        reader = FrameReader(conn, initial_size=4096)
+        serve_input(reader.read_frame, lambda: bool(select.select([conn], [], [], 0)[0]),
+                    session.wake)
 
     except Exception as e:
         print("[INPUT] Erro:", e)
     finally:
+        if tracker is not None:
+            tracker.close()
         conn.close()
         print(f"[INPUT] Cliente desconectado (input): {addr}")
 
 
+def handle_mux_conn(conn: socket.socket, addr):
+    """
+    Modo multiplexado: vídeo, input e controle numa conexão só.
+    O pareamento é implícito, então não há hello/token no input.
+    """
+    print(f"[MUX] Cliente conectado: {addr}")
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    mux = MuxConnection(conn)
+    video = mux.channel(CH_VIDEO)
+    inputs = mux.channel(CH_INPUT)
+    session = new_session()
+
+    def input_worker():
+        try:
+            serve_input(inputs.recv_frame, inputs.pending, session.wake)
+        except Exception as e:
+            print("[INPUT] Erro:", e)
+
+    threading.Thread(target=input_worker, daemon=True).start()
+    # Clientes que não conhecem CH_CURSOR descartam o canal
+    tracker = open_cursor_tracker(mux.channel(CH_CURSOR).send_message)
+    try:
+        stream_video(video.send_message, addr, mux.channel(CH_CONTROL).recv_frame, session)
+    finally:
+        if tracker is not None:
+            tracker.close()
+        mux.close()
+        print(f"[MUX] Cliente desconectado: {addr}")
+
+
+def serve_udp(sock: socket.socket) -> None:
+    """
+    Recebe os hellos do vídeo por UDP. O token (o mesmo do input) diz de
+    qual sessão é o endereço; os frames saem por este mesmo socket, então
+    passam pelo NAT do cliente que deixou o hello entrar.
+    """
+    while True:
+        try:
+            data, addr = sock.recvfrom(2048)
+        except ConnectionResetError:
+            continue  # ICMP de um envio anterior (Windows)
+        except OSError:
+            return
+        try:
+            hello = json.loads(data.decode("utf-8"))
+        except ValueError:
+            continue
+        if isinstance(hello, dict) and hello.get("type") == "udp_hello":
+            session = get_session(hello.get("token"))
+            if session is not None:
+                session.use_udp(sock, addr)
+
+
+def accept_loop(server_sock: socket.socket, handler):
+    """Aceita conexões num socket e atende cada uma numa thread."""
+    while True:
+        conn, addr = server_sock.accept()
+        t = threading.Thread(
+            target=handler,
+            args=(conn, addr),
+            daemon=True,
+        )
+        t.start()
+
+
 def start_server():
-    """Abre dois sockets: um para vídeo e outro para input, e aceita clientes."""
+    """Abre os sockets de vídeo, input e (opcionais) multiplexado e UDP, e aceita clientes."""
     video_sock = create_server_socket(HOST, PORT)
     input_sock = create_server_socket(HOST, INPUT_PORT)
+    mux_sock = create_server_socket(HOST, MUX_PORT) if MUX_ENABLED else None
+    udp_sock = create_udp_socket(HOST, UDP_PORT) if UDP_ENABLED else None
     print(f"[*] Servidor VÍDEO em {HOST}:{PORT}...")
     print(f"[*] Servidor INPUT em {HOST}:{INPUT_PORT}...")
+    if mux_sock is not None:
+        print(f"[*] Servidor MULTIPLEXADO em {HOST}:{MUX_PORT}...")
+    if udp_sock is not None:
+        print(f"[*] Vídeo UDP em {HOST}:{UDP_PORT}...")
+        threading.Thread(target=serve_udp, args=(udp_sock,), daemon=True).start()
+    if METRICS_PORT is not None:
+        metrics.serve_metrics(METRICS_HOST, METRICS_PORT)
+        print(f"[*] Métricas em http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    # Backend aberto (e um keyframe pronto) antes do primeiro cliente
+    threading.Thread(target=warm_capture.prime, daemon=True).start()
 
     try:
-        while True:
-            # Conexão de vídeo
-            conn, addr = video_sock.accept()
-            print("[VÍDEO] Cliente conectado", addr)
-            t = threading.Thread(
-                target=capture_and_send_loop,
-                args=(conn, addr),
-                daemon=True,
-            )
-            t.start()
-
-            # Conexão de input (mesmo cliente)
-            i_conn, i_addr = input_sock.accept()
-            print("[INPUT] Cliente conectado", i_addr)
-            ti = threading.Thread(
-                target=handle_input_conn,
-                args=(i_conn, i_addr),
+        # Vídeo e input são aceitos de forma independente; o pareamento
+        # é feito pelo token de sessão enviado no screen_info.
+        threading.Thread(
+            target=accept_loop,
+            args=(video_sock, capture_and_send_loop),
+            daemon=True,
+        ).start()
+        if mux_sock is not None:
+            threading.Thread(
+                target=accept_loop,
+                args=(mux_sock, handle_mux_conn),
                 daemon=True,
-            )
-            ti.start()
+            ).start()
+        accept_loop(input_sock, handle_input_conn)
 
     except KeyboardInterrupt:
         print("\n[!] Encerrando servidor...")
     finally:
         video_sock.close()
         input_sock.close()
+        if mux_sock is not None:
+            mux_sock.close()
+        if udp_sock is not None:
+            udp_sock.close()
 
 
 if __name__ == "__main__":
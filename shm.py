@@ -0,0 +1,246 @@
+# shm.py
+
+import ipaddress
+import secrets
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+try:
+    from multiprocessing import shared_memory
+    HAS_SHM = True
+except ImportError:
+    HAS_SHM = False
+
+# ==========================
+# Formato
+# ==========================
+# Cliente e servidor na mesma máquina (ou em containers que compartilham o
+# /dev/shm, com o endereço deles em server.SHM_TRUSTED) trocam os frames crus por um anel de SHM_SLOTS slots em memória
+# compartilhada, sem JPEG nem socket no caminho; o socket fica só com o
+# controle e o input. O segmento é:
+#   [escrito: 8][liberado: 8] ... até RING_HEADER
+#   slot i: [número: 8][altura: 4][largura: 4][canais: 4] ... até SLOT_HEADER + pixels
+# "escrito" é o número do último frame publicado (o frame n fica no slot
+# n % SHM_SLOTS) e "liberado" é o frame que o cliente está segurando. O
+# servidor só escreve o frame n se n - liberado < SHM_SLOTS, então o slot
+# que o cliente segura nunca é sobrescrito e ele lê direto dali, sem cópia.
+# Números de 8 bytes alinhados: a escrita de cada um é atômica.
+
+MSG_SHM = -2  # sinal local do ShmReader (nunca vai para a rede): frame novo no anel
+
+SHM_SLOTS = 3    # um segurado pelo cliente, um pronto e um sendo escrito
+SHM_POLL = 0.002  # s entre consultas do cliente ao número do último frame
+
+RING_HEADER = 64
+SLOT_HEADER = 64
+
+_created = set()  # segmentos criados por este processo (servidor e cliente juntos no benchmark)
+
+
+def is_local(host: str, trusted=()) -> bool:
+    """
+    True se host é esta máquina (loopback) ou está em trusted (endereços ou
+    sub-redes, ex.: "172.17.0.0/16"): vale tentar a memória compartilhada.
+    """
+    if host == "localhost":
+        return True
+    try:
+        address = ipaddress.ip_address(host)
+        return address.is_loopback or any(address in ipaddress.ip_network(net, strict=False)
+                                          for net in trusted)
+    except ValueError:
+        return False
+
+
+def _slot_stride(slot_size: int) -> int:
+    return SLOT_HEADER + -(-slot_size // 64) * 64
+
+
+class _Ring:
+    """Views sobre um segmento: os dois números do anel e o cabeçalho de cada slot."""
+
+    def __init__(self, shm, slots: int, slot_size: int):
+        self.shm = shm
+        self.name = shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = _slot_stride(slot_size)
+        self.seqs = np.ndarray((2,), dtype=np.uint64, buffer=shm.buf)  # escrito, liberado
+        self.headers = [np.ndarray((4,), dtype=np.uint32, buffer=shm.buf,
+                                   offset=RING_HEADER + i * self.stride + 8) for i in range(slots)]
+        self.numbers = [np.ndarray((1,), dtype=np.uint64, buffer=shm.buf,
+                                   offset=RING_HEADER + i * self.stride) for i in range(slots)]
+
+    def pixels(self, slot: int, height: int, width: int, channels: int) -> np.ndarray:
+        return np.ndarray((height, width, channels), dtype=np.uint8, buffer=self.shm.buf,
+                          offset=RING_HEADER + slot * self.stride + SLOT_HEADER)
+
+    def release_views(self) -> None:
+        self.seqs = self.headers = self.numbers = None
+
+
+# ==========================
+# Servidor: escrita no anel
+# ==========================
+
+class ShmWriter:
+    """
+    Anel de frames crus de um stream, criado pelo servidor para um cliente
+    local. write() copia o frame para o próximo slot e publica o número: é
+    todo o "encode" (uma cópia, em vez de JPEG + socket + decode).
+    wait_space() é o crédito do pipeline: sem slot livre o codificador
+    espera e a captura segue sobrescrevendo, como na janela do flow.py.
+    """
+
+    def __init__(self, slot_size: int, slots: int = SHM_SLOTS):
+        size = RING_HEADER + slots * _slot_stride(slot_size)
+        shm = shared_memory.SharedMemory(name="rs-" + secrets.token_hex(8), create=True, size=size)
+        _created.add(shm._name)
+        self._ring = _Ring(shm, slots, slot_size)
+        self._ring.seqs[:] = 0
+        self.name = shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.seq = 0
+
+    def info(self) -> dict:
+        """O que o cliente precisa para abrir o anel (vai no MSG_INFO "shm")."""
+        return {"type": "shm", "name": self.name, "slots": self.slots, "slot_size": self.slot_size}
+
+    def fits(self, frame: np.ndarray) -> bool:
+        return frame.nbytes <= self.slot_size
+
+    def _free(self) -> bool:
+        return self.seq + 1 - int(self._ring.seqs[1]) < self.slots
+
+    def wait_space(self, timeout: float) -> bool:
+        """Espera um slot que o cliente não esteja segurando; False se não veio em timeout."""
+        deadline = time.monotonic() + timeout
+        while not self._free():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(SHM_POLL)
+        return True
+
+    def write(self, frame: np.ndarray) -> bool:
+        """Copia o frame (h x w x canais, uint8) e o publica. False se não há slot livre."""
+        if not self._free():
+            return False
+        ring = self._ring
+        seq = self.seq + 1
+        slot = seq % self.slots
+        h, w = frame.shape[:2]
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        np.copyto(ring.pixels(slot, h, w, channels), frame.reshape(h, w, channels))
+        ring.headers[slot][:3] = (h, w, channels)
+        ring.numbers[slot][0] = seq
+        ring.seqs[0] = seq  # publicado só depois dos pixels
+        self.seq = seq
+        metrics.count("shm_frames")
+        return True
+
+    def close(self) -> None:
+        """Fecha e apaga o segmento (o mapeamento do cliente continua valendo até ele fechar)."""
+        ring, self._ring = self._ring, None
+        if ring is None:
+            return
+        ring.release_views()
+        try:
+            ring.shm.close()
+        except BufferError:
+            pass
+        try:
+            ring.shm.unlink()
+        except FileNotFoundError:
+            pass
+        _created.discard(ring.shm._name)
+
+
+# ==========================
+# Cliente: leitura sem cópia
+# ==========================
+
+def _attach(name: str):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if shm._name in _created:
+            return shm  # o registro é de quem criou
+        # Antes do 3.13 quem só abre o segmento também o registra no
+        # resource_tracker, que o apagaria quando este processo saísse
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return shm
+
+
+class ShmReader:
+    """
+    Lado do cliente de um ShmWriter. Uma thread consulta o número do último
+    frame a cada SHM_POLL e chama notify() quando ele muda (o decode põe um
+    MSG_SHM na fila); acquire(), na thread do decode, pega o frame mais
+    novo como uma view do slot e o segura até o próximo acquire().
+
+    Levanta OSError (ou ValueError) se o segmento não abre: servidor em
+    outra máquina ou em outro namespace de IPC.
+    """
+
+    def __init__(self, info: dict, notify=None):
+        self._ring = _Ring(_attach(info["name"]), int(info["slots"]), int(info["slot_size"]))
+        self.name = self._ring.name
+        self.held = 0
+        self.frame = None  # view do frame segurado
+        self._closed = threading.Event()
+        if notify is not None:
+            threading.Thread(target=self._poll, args=(notify,), name="shm", daemon=True).start()
+
+    def _poll(self, notify) -> None:
+        seen = self.held
+        while not self._closed.wait(SHM_POLL):
+            try:
+                written = int(self._ring.seqs[0])
+            except (AttributeError, TypeError):
+                return  # fechado no meio da consulta
+            if written != seen:
+                seen = written
+                notify()
+
+    def acquire(self):
+        """View (h x w x canais) do frame mais novo, ou None se nada mudou."""
+        ring = self._ring
+        try:
+            written = int(ring.seqs[0])
+            if written == self.held:
+                return None
+            slot = written % ring.slots
+            # Segura o slot antes de ler: o servidor só o reescreve depois do
+            # frame written + slots, e isso exige liberado > written
+            ring.seqs[1] = written
+            self.held = written
+            if int(ring.numbers[slot][0]) != written:
+                return None  # anel de outro servidor (não deveria acontecer)
+            h, w, channels, _ = (int(v) for v in ring.headers[slot])
+            frame = ring.pixels(slot, h, w, channels)
+        except (AttributeError, TypeError):
+            return None  # fechado (close() em outra thread)
+        self.frame = frame if channels != 1 else frame[..., 0]
+        return self.frame
+
+    def close(self) -> None:
+        self._closed.set()
+        ring, self._ring = self._ring, None
+        self.frame = None
+        if ring is None:
+            return
+        ring.release_views()
+        try:
+            ring.shm.close()
+        except BufferError:
+            pass  # ainda há frames exibidos apontando para o segmento; o processo o solta ao sair
@@ -0,0 +1,82 @@
+# stripes.py
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from content import encode_jpeg, encode_region
+from protocol import MSG_JPEG, MSG_STRIPES, ENC_JPEG, pack_update
+
+# ==========================
+# Configuração
+# ==========================
+
+ENCODE_WORKERS = os.cpu_count() or 1  # threads do pool de JPEG
+STRIPE_ALIGN = 64        # altura das faixas em múltiplos disso (= TILE_SIZE)
+MIN_STRIPE_HEIGHT = 128  # faixas menores não compensam o cabeçalho extra do JPEG
+PARALLEL_MIN_PIXELS = 256 * 1024  # abaixo disso os retângulos do delta saem em série
+
+
+class StripeEncoder:
+    """
+    Codifica JPEG em paralelo num pool de threads (cv2.imencode libera o GIL).
+
+    - encode_frame(): quebra o frame em faixas horizontais, uma por worker,
+      e devolve um único MSG_STRIPES que o cliente remonta.
+    - encode_rects(): codifica retângulos (JPEG ou paleta) em paralelo quando
+      eles somam área suficiente para valer a troca de threads.
+
+    As faixas começam em múltiplos de STRIPE_ALIGN, então o decode reduzido
+    do cliente (1/2, 1/4, 1/8) cai em posições exatas e não há emenda
+    visível entre elas (os blocos do JPEG não cruzam a borda).
+    """
+
+    def __init__(self, workers: int = ENCODE_WORKERS):
+        self.workers = max(1, workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jpeg")
+
+    def stripe_bounds(self, height: int):
+        """Lista de (y, altura) das faixas para um frame dessa altura."""
+        stripe = -(-height // self.workers)
+        stripe = max(MIN_STRIPE_HEIGHT, -(-stripe // STRIPE_ALIGN) * STRIPE_ALIGN)
+        return [(y, min(stripe, height - y)) for y in range(0, height, stripe)]
+
+    def stripe_rects(self, frame: np.ndarray, quality: int, y0: int = 0):
+        """
+        Faixas JPEG do frame como retângulos (x, y, w, h, ENC_JPEG, dados),
+        com y deslocado por y0. None se algum encode falhou.
+        """
+        w = frame.shape[1]
+        bounds = self.stripe_bounds(frame.shape[0])
+        datas = list(self.pool.map(lambda b: encode_jpeg(frame[b[0]:b[0] + b[1]], quality), bounds))
+        if any(data is None for data in datas):
+            return None
+        return [(0, y0 + y, w, sh, ENC_JPEG, data) for (y, sh), data in zip(bounds, datas)]
+
+    def encode_frame(self, frame: np.ndarray, quality: int):
+        """Retorna (tipo, corpo) do frame completo, ou None se o encode falhou."""
+        h, w = frame.shape[:2]
+        if len(self.stripe_bounds(h)) == 1:
+            # Frame pequeno (ou um worker só): um JPEG comum basta
+            data = encode_jpeg(frame, quality)
+            return (MSG_JPEG, data) if data is not None else None
+
+        rects = self.stripe_rects(frame, quality)
+        return (MSG_STRIPES, pack_update(w, h, rects)) if rects is not None else None
+
+    def encode_rects(self, frame: np.ndarray, regions, quality: int) -> list:
+        """
+        regions: lista de (x, y, w, h, codificação). Retorna (codificação, dados)
+        na mesma ordem, como content.encode_region.
+        """
+        def encode(region):
+            x, y, w, h, enc = region
+            return encode_region(frame[y:y + h, x:x + w], enc, quality)
+
+        if sum(r[2] * r[3] for r in regions) < PARALLEL_MIN_PIXELS:
+            return [encode(region) for region in regions]
+        return list(self.pool.map(encode, regions))
+
+    def close(self):
+        self.pool.shutdown(wait=False)
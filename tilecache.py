@@ -0,0 +1,139 @@
+# tilecache.py
+
+import hashlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import metrics
+from protocol import ENC_STORE, unpack_update
+
+try:
+    import xxhash
+    HAS_XXHASH = True
+except ImportError:
+    HAS_XXHASH = False
+
+# ==========================
+# Configuração
+# ==========================
+
+CACHE_TILES = 4096  # slots (~48 MB no cliente com tiles 64x64 sem redução)
+SLOT_DTYPE = np.dtype(">u2")  # 2 bytes por slot, big-endian como o resto do protocolo
+
+
+def tile_hash(tile: np.ndarray) -> bytes:
+    """
+    Hash do conteúdo de um tile. xxh3 de 128 bits se o pacote xxhash
+    estiver instalado; senão SHA-1, que tem aceleração por hardware na
+    maioria das CPUs e é mais rápido que MD5/BLAKE2 aqui.
+    """
+    data = np.ascontiguousarray(tile)
+    if HAS_XXHASH:
+        return xxhash.xxh3_128_digest(data)
+    return hashlib.sha1(data).digest()
+
+
+# ==========================
+# Servidor: chave -> slot
+# ==========================
+
+class TileCache:
+    """
+    Lado do servidor: hash do conteúdo -> slot, em ordem LRU.
+
+    Quem escolhe os slots é o servidor: um tile novo vai para um slot livre
+    ou para o do tile usado há mais tempo, e a mensagem diz ao cliente em
+    qual slot guardá-lo (ENC_STORE). O cliente só obedece, então os dois
+    lados ficam sincronizados sem mensagem de eviction: sobrescrever o slot
+    já é a eviction. Basta o cliente aplicar todos os ENC_STORE, em ordem.
+    """
+
+    def __init__(self, capacity: int = CACHE_TILES):
+        self.capacity = capacity
+        self._slots = OrderedDict()
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def lookup(self, key: bytes):
+        """Slot do tile, se o cliente já o tem (e marca como usado agora)."""
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._slots.move_to_end(key)
+        return slot
+
+    def insert(self, key: bytes) -> int:
+        """Reserva um slot para um tile novo, despejando o mais antigo se cheio."""
+        if self._free:
+            slot = self._free.pop()
+        else:
+            _, slot = self._slots.popitem(last=False)
+            metrics.count("cache_evictions")
+        self._slots[key] = slot
+        return slot
+
+
+def slot_rects(slots: dict, enc: int, tile: int) -> list:
+    """
+    {(linha, coluna): slot} -> retângulos (x, y, w, h, enc, dados),
+    um por fileira de tiles vizinhos, com os slots em ordem.
+    """
+    rects = []
+    items = sorted(slots.items())
+    start = 0
+    for i in range(1, len(items) + 1):
+        if i < len(items):
+            (row, col), (prev_row, prev_col) = items[i][0], items[i - 1][0]
+            if row == prev_row and col == prev_col + 1:
+                continue
+        row, col = items[start][0]
+        data = np.array([slot for _, slot in items[start:i]], dtype=SLOT_DTYPE).tobytes()
+        rects.append((col * tile, row * tile, (i - start) * tile, tile, enc, data))
+        start = i
+    return rects
+
+
+# ==========================
+# Cliente: slot -> tile
+# ==========================
+
+class TileStore:
+    """
+    Lado do cliente: os tiles já decodificados, por slot.
+
+    Guardar o tile pronto (e não os bytes codificados) faz o acerto custar só
+    uma cópia e funciona para tiles que chegaram dentro de uma faixa ou de
+    uma corrida maior. Tiles guardados com outro fator de redução são
+    redimensionados ao colar.
+    """
+
+    def __init__(self):
+        self._tiles = {}
+        self.nbytes = 0
+
+    def apply(self, framebuffer: np.ndarray, x: int, y: int, w: int, h: int,
+              enc: int, data, reduce: int = 1) -> None:
+        """Aplica um retângulo ENC_CACHED ou ENC_STORE no framebuffer."""
+        side = h // reduce
+        x, y = x // reduce, y // reduce
+        for i, slot in enumerate(np.frombuffer(data, dtype=SLOT_DTYPE).tolist()):
+            target = framebuffer[y:y + side, x + i * side:x + (i + 1) * side]
+            if enc == ENC_STORE:
+                old = self._tiles.get(slot)
+                self.nbytes += target.nbytes - (old.nbytes if old is not None else 0)
+                self._tiles[slot] = target.copy()
+                continue
+            tile = self._tiles.get(slot)
+            if tile is None:
+                continue
+            if tile.shape != target.shape:
+                tile = cv2.resize(tile, (target.shape[1], target.shape[0]), interpolation=cv2.INTER_AREA)
+            target[:] = tile
+
+
+def has_stores(body) -> bool:
+    """True se o MSG_UPDATE/MSG_STRIPES guarda tiles (o cliente não pode pulá-lo)."""
+    return any(rect[4] == ENC_STORE for rect in unpack_update(body)[2])
@@ -0,0 +1,391 @@
+# udp.py
+
+import heapq
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import metrics
+from protocol import HAS_SENDMSG
+
+# ==========================
+# Formato
+# ==========================
+# Vídeo opcional por UDP: uma perda não trava os frames seguintes atrás da
+# retransmissão (head-of-line blocking do TCP). Input e controle continuam no TCP.
+#
+# Cada mensagem de vídeo (tipo + corpo) vira um frame com id próprio, quebrado
+# em fragmentos que cabem num datagrama:
+#   [seq: 4][frame: 4][tamanho: 4][índice: 2][fragmentos: 2][tipo: 1][flags: 1][grupo: 1] + dados
+# seq conta datagramas (para medir a perda); tamanho é o do corpo inteiro.
+# A cada "grupo" fragmentos vai um de paridade (FLAG_PARITY, índice = nº do
+# grupo): o XOR de todos eles, com o último completado com zeros. Ele
+# reconstrói qualquer fragmento do grupo que se perder sozinho. O tamanho do
+# grupo vai em cada datagrama, então cliente e servidor não precisam combinar.
+
+PACKET_HEADER = struct.Struct(">IIIHHBBB")
+FLAG_PARITY = 0x01
+
+DATAGRAM_SIZE = 1200  # cabe no MTU de Wi-Fi/VPN/IPv6 sem fragmentação IP
+PAYLOAD_SIZE = DATAGRAM_SIZE - PACKET_HEADER.size
+FEC_GROUP = 8         # fragmentos por paridade (0 = sem FEC); 12,5% a mais de banda
+PACE_MBPS = 200       # ritmo máximo de envio: rajadas maiores estouram os buffers do Wi-Fi
+PACE_BURST = 0.002    # s de adiantamento tolerados antes de dormir
+REASSEMBLY_TIMEOUT = 0.25  # s: frame incompleto há mais tempo que isso é dado como perdido
+REORDER_WAIT = 0.02   # s que um frame completo espera por um anterior ainda incompleto
+HELLO_INTERVAL = 0.3  # s entre hellos do cliente até o primeiro datagrama chegar
+HELLO_TIMEOUT = 3.0   # s sem resposta: o vídeo continua no TCP
+MAX_MESSAGE = 32 << 20  # bytes: cabeçalho com tamanho maior é descartado (nenhum frame chega perto)
+MAX_FRAGMENTS = -(-MAX_MESSAGE // PAYLOAD_SIZE)
+SOCKET_BUFFER = 4 << 20
+
+MSG_LOST = -1  # sinal local do UdpReceiver (nunca vai para a rede): mensagens perdidas
+
+
+def create_udp_socket(host: str = "0.0.0.0", port: int = 0) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+    sock.bind((host, port))
+    return sock
+
+
+def _group_xor(data: np.ndarray, count: int) -> np.ndarray:
+    """XOR de count fragmentos consecutivos de data (o último pode ser curto)."""
+    padded = np.zeros(count * PAYLOAD_SIZE, dtype=np.uint8)
+    padded[:len(data)] = data
+    return np.bitwise_xor.reduce(padded.reshape(count, PAYLOAD_SIZE), axis=0)
+
+
+# ==========================
+# Envio
+# ==========================
+
+class UdpSender:
+    """
+    Manda mensagens de vídeo para addr como datagramas com paridade.
+
+    send_message() tem a mesma assinatura do send do TCP e respeita o ritmo
+    de PACE_MBPS: os fragmentos saem espaçados em vez de numa rajada, e o
+    tempo gasto no envio continua dizendo ao AdaptiveController algo
+    parecido com a vazão do link.
+    """
+
+    def __init__(self, sock: socket.socket, addr, fec_group: int = FEC_GROUP,
+                 pace_mbps: float = PACE_MBPS):
+        self.sock = sock
+        self.addr = addr
+        self.fec_group = fec_group
+        self.rate = pace_mbps * 1e6 / 8  # bytes/s
+        self._seq = 0
+        self._frame = 0  # o primeiro frame é o 1: o receptor sabe se perdeu algum antes
+        self._next = time.perf_counter()
+
+    def send_message(self, msg_type: int, body) -> None:
+        view = memoryview(body).cast("B")
+        size = view.nbytes
+        count = max(1, -(-size // PAYLOAD_SIZE))
+        self._frame = (self._frame + 1) & 0xFFFFFFFF
+        group = self.fec_group
+        for i in range(count):
+            self._send(size, i, count, msg_type, 0, view[i * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE])
+            if group and (i % group == group - 1 or i == count - 1):
+                start = i // group * group
+                data = np.frombuffer(view[start * PAYLOAD_SIZE:(i + 1) * PAYLOAD_SIZE], dtype=np.uint8)
+                parity = _group_xor(data, i + 1 - start)[:min(PAYLOAD_SIZE, len(data))]
+                self._send(size, i // group, count, msg_type, FLAG_PARITY, parity)
+                metrics.count("udp_parity_sent")
+
+    def _send(self, size, index, count, msg_type, flags, data) -> None:
+        header = PACKET_HEADER.pack(self._seq, self._frame, size, index, count, msg_type, flags,
+                                    self.fec_group)
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        self._pace(len(header) + len(data))
+        try:
+            if HAS_SENDMSG:
+                self.sock.sendmsg([header, data], [], 0, self.addr)
+            else:
+                self.sock.sendto(header + bytes(data), self.addr)
+        except ConnectionRefusedError:
+            # ICMP de um envio anterior: o TCP é quem decide se o cliente saiu
+            pass
+        metrics.count("udp_packets_sent")
+
+    def _pace(self, nbytes: int) -> None:
+        now = time.perf_counter()
+        start = max(self._next, now)
+        self._next = start + nbytes / self.rate
+        if start - now > PACE_BURST:
+            time.sleep(start - now)
+
+
+# ==========================
+# Recepção
+# ==========================
+
+class _Partial:
+    """Frame em remontagem."""
+
+    __slots__ = ("msg_type", "size", "count", "group", "data", "have", "missing", "parity", "started")
+
+    def __init__(self, msg_type: int, size: int, count: int, group: int):
+        self.msg_type = msg_type
+        self.size = size
+        self.count = count
+        self.group = group  # fragmentos por paridade (0 = sem FEC)
+        self.data = bytearray(size)
+        self.have = bytearray(count)
+        self.missing = count
+        self.parity = {}  # grupo -> bytes
+        self.started = time.monotonic()
+
+
+class UdpReceiver:
+    """
+    Remonta as mensagens de um UdpSender.
+
+    recv_message() devolve (tipo, corpo) em ordem de frame, como o
+    recv_message do TCP, ou (None, b"") quando o socket fecha. Um frame
+    incompleto é descartado se um mais novo já está completo há
+    REORDER_WAIT (o que falta dele foi perdido, não só reordenado), ou depois
+    de REASSEMBLY_TIMEOUT: esperar mais só atrasaria os seguintes.
+    Nesse caso sai um (MSG_LOST, b"") antes do próximo frame, e os deltas
+    não valem mais até um frame completo.
+
+    Com server_addr, datagramas de qualquer outro endereço são ignorados; os
+    cabeçalhos são validados antes de alocar ou copiar qualquer coisa.
+    """
+
+    def __init__(self, sock: socket.socket, server_addr=None):
+        self.sock = sock
+        self.server = None
+        if server_addr is not None:
+            self.server = (socket.gethostbyname(server_addr[0]), server_addr[1])
+        self.packets = 0        # datagramas recebidos
+        self._buf = bytearray(65536)
+        self._partial = {}      # id do frame -> _Partial
+        self._done = {}         # id do frame -> _Partial completo esperando os anteriores
+        self._last = 0          # último frame entregue ou descartado
+        self._gap_since = None  # desde quando há frame completo esperando
+        self._ready = deque()
+        self._seq_range = None  # (menor, maior) seq vistos
+        sock.settimeout(REORDER_WAIT)
+
+    def recv_message(self):
+        while not self._ready:
+            self._expire()
+            try:
+                n, source = self.sock.recvfrom_into(self._buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                return None, b""
+            if self.server is not None and source[:2] != self.server:
+                metrics.count("udp_foreign_dropped")
+                continue
+            self._packet(memoryview(self._buf)[:n])
+        return self._ready.popleft()
+
+    def _packet(self, view: memoryview) -> None:
+        if len(view) < PACKET_HEADER.size:
+            return
+        seq, frame, size, index, count, msg_type, flags, group = PACKET_HEADER.unpack_from(view)
+        payload = view[PACKET_HEADER.size:]
+        # Cabeçalho validado antes de qualquer estado de remontagem: fragmento
+        # (ou grupo de paridade) além do fim, contagem absurda ou que não bate
+        # com o tamanho, dados maiores que um fragmento
+        if flags & FLAG_PARITY:
+            in_range = group and index * group < count
+        else:
+            in_range = index < count
+        if (not 0 < count <= MAX_FRAGMENTS or not in_range or size > MAX_MESSAGE
+                or count != max(1, -(-size // PAYLOAD_SIZE)) or len(payload) > PAYLOAD_SIZE):
+            metrics.count("udp_invalid_dropped")
+            return
+        self.packets += 1
+        first, last = self._seq_range or (seq, seq)
+        first, last = min(first, seq), max(last, seq)
+        self._seq_range = (first, last)
+        metrics.set_gauge("udp_loss_pct", 100 * max(0.0, 1 - self.packets / (last - first + 1)))
+
+        if frame <= self._last or frame in self._done:
+            return  # atrasado: o frame já saiu, foi descartado ou está completo
+        partial = self._partial.get(frame)
+        if partial is None:
+            partial = self._partial[frame] = _Partial(msg_type, size, count, group)
+        elif (partial.msg_type, partial.size, partial.group) != (msg_type, size, group):
+            metrics.count("udp_invalid_dropped")
+            return  # não bate com os fragmentos anteriores do frame
+        if flags & FLAG_PARITY:
+            partial.parity[index] = bytes(payload)
+            group = index
+        else:
+            if partial.have[index]:
+                return
+            offset = index * PAYLOAD_SIZE
+            length = min(len(payload), size - offset)
+            partial.data[offset:offset + length] = payload[:length]
+            partial.have[index] = 1
+            partial.missing -= 1
+            group = index // partial.group if partial.group else None
+
+        if group is not None and partial.missing:
+            self._repair(partial, group)
+        if not partial.missing:
+            self._done[frame] = self._partial.pop(frame)
+            self._release()
+
+    def _repair(self, partial: _Partial, group: int) -> None:
+        """Reconstrói o fragmento do grupo se só ele falta e a paridade chegou."""
+        parity = partial.parity.get(group)
+        start = group * partial.group
+        end = min(start + partial.group, partial.count)
+        missing = [i for i in range(start, end) if not partial.have[i]]
+        if parity is None or len(missing) != 1:
+            return
+        data = np.frombuffer(partial.data, dtype=np.uint8)[start * PAYLOAD_SIZE:end * PAYLOAD_SIZE]
+        # O fragmento que falta ainda é zero, então o XOR do grupo + paridade é ele
+        fragment = _group_xor(data, end - start)[:len(parity)] ^ np.frombuffer(parity, dtype=np.uint8)
+        index = missing[0]
+        offset = index * PAYLOAD_SIZE
+        length = max(0, min(len(fragment), partial.size - offset))
+        partial.data[offset:offset + length] = fragment[:length].tobytes()
+        partial.have[index] = 1
+        partial.missing -= 1
+        metrics.count("udp_recovered")
+
+    def _release(self, upto: int = 0) -> None:
+        """
+        Entrega os frames completos em ordem. Os que faltam até upto (e até o
+        frame completo mais antigo, se ele já esperou REORDER_WAIT) são
+        descartados, com um MSG_LOST antes do frame seguinte.
+        """
+        now = time.monotonic()
+        if self._done:
+            if self._last + 1 in self._done:
+                self._gap_since = None
+            elif self._gap_since is None:
+                self._gap_since = now
+            elif now - self._gap_since >= REORDER_WAIT:
+                upto = max(upto, min(self._done) - 1)
+        lost = 0
+        while self._last < upto or self._last + 1 in self._done:
+            frame = self._last = self._last + 1
+            partial = self._done.pop(frame, None)
+            if partial is None:
+                self._partial.pop(frame, None)
+                lost += 1
+                continue
+            if lost:
+                metrics.count("udp_frames_lost", lost)
+                self._ready.append((MSG_LOST, b""))
+                lost = 0
+            self._ready.append((partial.msg_type, partial.data))
+        if lost:
+            metrics.count("udp_frames_lost", lost)
+            self._ready.append((MSG_LOST, b""))
+        if not self._done:
+            self._gap_since = None
+        elif self._last + 1 not in self._done and self._gap_since is None:
+            self._gap_since = now
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        stale = [f for f, p in self._partial.items() if now - p.started > REASSEMBLY_TIMEOUT]
+        self._release(max(stale) if stale else 0)
+
+
+# ==========================
+# Handshake
+# ==========================
+
+def hello_message(token: str) -> bytes:
+    return json.dumps({"type": "udp_hello", "token": token}).encode("utf-8")
+
+
+def send_hellos(sock: socket.socket, server_addr, token: str, receiver: UdpReceiver) -> bool:
+    """
+    Manda hellos (o servidor aprende o endereço do cliente, inclusive atrás de
+    NAT) até o primeiro datagrama de vídeo chegar. False se não chegou nenhum.
+    """
+    deadline = time.monotonic() + HELLO_TIMEOUT
+    while time.monotonic() < deadline:
+        if receiver.packets:
+            return True
+        try:
+            sock.sendto(hello_message(token), server_addr)
+        except OSError:
+            return False
+        time.sleep(HELLO_INTERVAL)
+    return receiver.packets > 0
+
+
+# ==========================
+# Simulador de link (testes locais)
+# ==========================
+
+class LossyRelay:
+    """
+    Repassa datagramas entre um cliente e target perdendo uma fração loss
+    deles e atrasando cada um em delay ± jitter segundos (o que também
+    reordena). O cliente é quem manda o primeiro datagrama; o cliente usa
+    relay.addr no lugar do endereço do servidor.
+    """
+
+    def __init__(self, target, loss: float = 0.0, delay: float = 0.0,
+                 jitter: float = 0.0, seed: int = 0):
+        self.target = target
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.dropped = 0
+        self.sock = create_udp_socket("127.0.0.1", 0)
+        self.addr = self.sock.getsockname()
+        self._rng = random.Random(seed)
+        self._client = None
+        self._queue = []  # heap de (instante de entrega, ordem, dados, destino)
+        self._count = 0
+        self._closed = False
+        threading.Thread(target=self._loop, name="lossy-relay", daemon=True).start()
+
+    def _loop(self):
+        while not self._closed:
+            now = time.perf_counter()
+            while self._queue and self._queue[0][0] <= now:
+                _, _, data, dest = heapq.heappop(self._queue)
+                try:
+                    self.sock.sendto(data, dest)
+                except OSError:
+                    pass
+            wait = self._queue[0][0] - now if self._queue else 0.01
+            self.sock.settimeout(min(max(wait, 0.0002), 0.01))
+            try:
+                data, addr = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            if addr == self.target:
+                dest = self._client
+            else:
+                self._client, dest = addr, self.target
+            if dest is None or self._rng.random() < self.loss:
+                self.dropped += 1
+                continue
+            at = now + max(0.0, self.delay + self._rng.uniform(-self.jitter, self.jitter))
+            self._count += 1
+            heapq.heappush(self._queue, (at, self._count, data, dest))
+
+    def close(self):
+        self._closed = True
+        self.sock.close()